@@ -2,6 +2,16 @@
 # License, v. 2.0. If a copy of the MPL was not distributed with this file,
 # You can obtain one at http://mozilla.org/MPL/2.0/.
 
+from bisect import insort
+from collections import deque
+from itertools import chain, islice
+import logging as log
+
+try:
+    import numpy
+    from numpy.lib.stride_tricks import as_strided
+except ImportError:
+    numpy = None
 
 def analyze(data, weight_fn=None):
     """Returns the average and sample variance (s**2) of a list of floats.
@@ -45,8 +55,17 @@ def calc_t(w1, w2, weight_fn=None):
     if len(w1) == 0 or len(w2) == 0:
         return 0
 
-    s1 = analyze(w1, weight_fn)
-    s2 = analyze(w2, weight_fn)
+    return calc_t_stats(analyze(w1, weight_fn), analyze(w2, weight_fn))
+
+def calc_t_stats(s1, s2):
+    """Perform a Students t-test on two windows already summarized by analyze().
+
+    This lets callers that keep running statistics (see `RollingWindow`) skip
+    re-analyzing the underlying lists.
+    """
+    if s1['n'] == 0 or s2['n'] == 0:
+        return 0
+
     delta_s = s2['avg'] - s1['avg']
 
     if delta_s == 0:
@@ -56,7 +75,225 @@ def calc_t(w1, w2, weight_fn=None):
 
     return delta_s / (((s1['variance'] / s1['n']) + (s2['variance'] / s2['n'])) ** 0.5)
 
+class WindowStats(object):
+    """The statistics analyze() computes for one window, as fixed fields.
+
+    Supports item access (`stats['avg']`) like the dictionary analyze()
+    returns, so the two can be used interchangeably.
+    """
+    __slots__ = ('avg', 'n', 'variance')
+
+    def __init__(self, avg, n, variance):
+        self.avg = avg
+        self.n = n
+        self.variance = variance
+
+    def __getitem__(self, key):
+        try:
+            return getattr(self, key)
+        except AttributeError:
+            raise KeyError(key)
+
+    def __repr__(self):
+        return "<WindowStats avg=%r n=%r variance=%r>" % (self.avg, self.n,
+                                                          self.variance)
+
+class RollingWindow(object):
+    """A sliding window of floats that keeps the running sums analyze() needs.
+
+    The value at the front of the window (index 0) is the one closest to the
+    point being analyzed, so it gets the highest `linear_weights` weight.
+    Values can be added or removed at either end in constant time, and
+    `stats()` returns what `analyze()` would for the same list (as a
+    `WindowStats`), up to floating-point rounding.
+    """
+
+    def __init__(self):
+        self.values = deque()
+        # All sums are taken relative to `shift` (a value near the data) so
+        # that the variance doesn't suffer from catastrophic cancellation.
+        self.shift = 0.0
+        self.sum = 0.0
+        self.sum_sq = 0.0
+        # sum((n - i) * values[i]): the linear_weights numerator, times n
+        self.linear_sum = 0.0
+        self._updates = 0
+
+    @classmethod
+    def from_values(cls, values):
+        """Returns a window holding `values`, front first."""
+        w = cls()
+        w.values.extend(values)
+        w.resync()
+        return w
+
+    def copy(self):
+        w = RollingWindow()
+        w.values = deque(self.values)
+        (w.shift, w.sum, w.sum_sq, w.linear_sum, w._updates) = \
+            (self.shift, self.sum, self.sum_sq, self.linear_sum, self._updates)
+        return w
+
+    def __len__(self):
+        return len(self.values)
+
+    def append(self, value):
+        """Adds a value at the back (lowest weight) of the window."""
+        x = value - self.shift
+        self.linear_sum += self.sum + x
+        self.sum += x
+        self.sum_sq += x * x
+        self.values.append(value)
+        self._updated()
+
+    def appendleft(self, value):
+        """Adds a value at the front (highest weight) of the window."""
+        x = value - self.shift
+        self.linear_sum += (len(self.values) + 1) * x
+        self.sum += x
+        self.sum_sq += x * x
+        self.values.appendleft(value)
+        self._updated()
+
+    def pop(self):
+        """Removes and returns the value at the back of the window."""
+        value = self.values.pop()
+        x = value - self.shift
+        self.linear_sum -= self.sum
+        self.sum -= x
+        self.sum_sq -= x * x
+        self._updated()
+        return value
+
+    def popleft(self):
+        """Removes and returns the value at the front of the window."""
+        x = self.values[0] - self.shift
+        self.linear_sum -= len(self.values) * x
+        self.sum -= x
+        self.sum_sq -= x * x
+        value = self.values.popleft()
+        self._updated()
+        return value
+
+    def _updated(self):
+        # Rounding errors pile up as values slide through the window, so start
+        # over from exact sums once the whole window has been replaced (twice).
+        # This keeps every operation amortized O(1).
+        self._updates += 1
+        if self._updates > 2 * len(self.values):
+            self.resync()
+
+    def resync(self):
+        """Recomputes the running sums from the values in the window."""
+        n = len(self.values)
+        self.shift = self.values[0] if n > 0 else 0.0
+        xs = [v - self.shift for v in self.values]
+        self.sum = sum(xs)
+        self.sum_sq = sum(x * x for x in xs)
+        self.linear_sum = sum((n - i) * x for i, x in enumerate(xs))
+        self._updates = 0
+
+    def stats(self, weight_fn=None):
+        """Returns `analyze(list(self.values), weight_fn)` as a WindowStats.
+
+        Only `default_weights` and `linear_weights` can be computed from the
+        running sums; any other `weight_fn` falls back to `analyze`.
+        """
+        n = len(self.values)
+        if n == 0:
+            return WindowStats(0.0, 0, 0.0)
+
+        if weight_fn is None or weight_fn is default_weights:
+            x_avg = self.sum / n
+        elif weight_fn is linear_weights:
+            x_avg = self.linear_sum / (n * (n + 1) / 2.0)
+        else:
+            return WindowStats(**analyze(list(self.values), weight_fn))
+
+        if n > 1:
+            # sum((x - x_avg) ** 2), expanded in terms of the running sums
+            sq_dev = self.sum_sq - 2 * x_avg * self.sum + n * x_avg * x_avg
+            variance = max(sq_dev, 0.0) / (n - 1)
+        else:
+            variance = 0.0
+        return WindowStats(self.shift + x_avg, n, variance)
+
+def _windows(values, width):
+    """Returns a read-only (len(values) - width + 1, width) view of `values`
+    where row i is values[i:i+width]."""
+    stride = values.strides[0]
+    return as_strided(values, shape=(len(values) - width + 1, width),
+                      strides=(stride, stride))
+
+def _analyze_rows(windows, weight_fn):
+    """Vectorized analyze() over every row of a 2-d array of windows.
+
+    Returns arrays of the averages and variances, one entry per row.
+    """
+    n = windows.shape[1]
+    weights = numpy.array([weight_fn(i, n) for i in range(n)])
+    avg = windows.dot(weights) / weights.sum()
+    if n > 1:
+        variance = ((windows - avg[:, None]) ** 2).sum(axis=1) / (n - 1)
+    else:
+        variance = numpy.zeros(len(windows))
+    return avg, variance
+
+def batch_calc_t(values, back_window, fore_window):
+    """Computes the analyze_t() statistics for every window position at once.
+
+    Point i is compared against the `back_window` values before it (most
+    recent first) and the `fore_window` values starting at it, exactly as
+    analyze_t() does when every point is considered good.  Returns a list of
+    (historical_stats, forward_stats, t) tuples, with the stats as
+    WindowStats, one for each of the
+    len(values) - fore_window + 1 points that have a full forward window.
+
+    Requires numpy.
+    """
+    (j, k) = (back_window, fore_window)
+    x = numpy.asarray(values, dtype=float)
+    num_points = len(x) - k + 1
+    if num_points <= 0:
+        return []
+
+    fore = _windows(x, k)
+    fore_avg, fore_var = _analyze_rows(fore, default_weights)
+    fore_lavg, fore_lvar = _analyze_rows(fore, linear_weights)
+
+    t = numpy.zeros(num_points)
+    if 0 < j < num_points:
+        # Row i - j is the back window of point i, reversed so that the most
+        # recent value comes first.
+        back = _windows(x[:num_points - 1], j)[:, ::-1]
+        back_avg, back_var = _analyze_rows(back, default_weights)
+        back_lavg, back_lvar = _analyze_rows(back, linear_weights)
+
+        delta = fore_lavg[j:] - back_lavg
+        with numpy.errstate(divide='ignore', invalid='ignore'):
+            full_t = numpy.abs(delta / numpy.sqrt(back_lvar / j + fore_lvar[j:] / k))
+        full_t[(back_lvar == 0) & (fore_lvar[j:] == 0)] = float('inf')
+        full_t[delta == 0] = 0
+        t[j:] = full_t
+
+    retval = []
+    for i in range(num_points):
+        if i < j or j == 0:
+            # Not enough history yet for a full back window
+            historical_stats = WindowStats(**analyze(values[max(i-j, 0):i][::-1]))
+        else:
+            historical_stats = WindowStats(float(back_avg[i-j]), j,
+                                           float(back_var[i-j]))
+        forward_stats = WindowStats(float(fore_avg[i]), k, float(fore_var[i]))
+        retval.append((historical_stats, forward_stats, float(t[i])))
+    return retval
+
 class PerfDatum(object):
+    # A long series holds a lot of these, so don't give each one a __dict__
+    __slots__ = ('push_timestamp', 'value', 'buildid', 'testrun_timestamp',
+                 'testrun_id', 'machine_id', 'revision', 'run_number', 't',
+                 'state', 'historical_stats', 'forward_stats', 'last_other')
+
     def __init__(self, push_timestamp, value, testrun_timestamp=None,
                  buildid=None, testrun_id=None, machine_id=None,
                  revision=None, state='good'):
@@ -80,11 +317,56 @@ class PerfDatum(object):
         self.machine_id = machine_id
         # What revision this data is for
         self.revision = revision
+        # Which run of this build this was, if the source tells us
+        self.run_number = None
 
         # t-test score
         self.t = 0
         # Whether a machine issue or perf regression is found
         self.state = state
+        # WindowStats of the data before and after this point, and for machine
+        # issues the last good point from another machine; set by analyze_t
+        self.historical_stats = None
+        self.forward_stats = None
+        self.last_other = None
+
+    def to_dict(self):
+        """Returns the attributes of this point as a JSON-friendly dict."""
+        retval = {}
+        for cls in type(self).__mro__:
+            for name in getattr(cls, '__slots__', ()):
+                value = getattr(self, name, None)
+                if isinstance(value, WindowStats):
+                    value = {"avg": value.avg, "n": value.n,
+                             "variance": value.variance}
+                elif isinstance(value, PerfDatum):
+                    value = value.to_dict()
+                retval[name] = value
+        return retval
+
+    def copy(self):
+        """Returns a shallow copy of this point, of the same class."""
+        c = type(self).__new__(type(self))
+        for cls in type(self).__mro__:
+            for name in getattr(cls, '__slots__', ()):
+                if hasattr(self, name):
+                    setattr(c, name, getattr(self, name))
+        if hasattr(self, '__dict__'):
+            c.__dict__.update(self.__dict__)
+        return c
+
+    @classmethod
+    def from_dict(cls, obj):
+        """Rebuilds a point saved with to_dict()."""
+        d = cls.__new__(cls)
+        for name, value in obj.items():
+            if value is not None:
+                if name in ('historical_stats', 'forward_stats'):
+                    value = WindowStats(value['avg'], value['n'], value['variance'])
+                elif name == 'last_other':
+                    value = cls.from_dict(value)
+            setattr(d, str(name), value)
+        return d
 
     def __cmp__(self, o):
         return cmp(
@@ -112,6 +394,185 @@ class PerfDatum(object):
                                             self.machine_id)
 
 
+def is_regression(prev, d, next, t_threshold):
+    """Whether `d` looks like the cause of a regression, given the good points
+    on either side of it."""
+    if d.t <= t_threshold:
+        return False
+
+    # Check the adjacent points
+    if prev.t > d.t:
+        return False
+    if next.t > d.t:
+        return False
+
+    # This datapoint has a t value higher than the threshold and higher than
+    # either neighbor.
+    return True
+
+
+class PointScorer(object):
+    """Scores points one at a time, in order, the way analyze_t does.
+
+    All the state needed to score the next point is kept here and is bounded
+    by the window sizes (and the number of machines), so scoring can be
+    paused, copied, saved with get_state() and resumed later.
+    """
+
+    def __init__(self, back_window=12, fore_window=12, machine_threshold=None,
+                 machine_history_size=None):
+        self.back_window = back_window
+        self.fore_window = fore_window
+        self.machine_threshold = machine_threshold
+        self.machine_history_size = machine_history_size
+
+        # The last j good values, most recent first
+        self.back = RollingWindow()
+        # How many good points there have been, and the last few of them
+        self.num_good = 0
+        self.first_good = None
+        if machine_threshold is None:
+            self.good_tail = deque(maxlen=3)
+        else:
+            self.good_tail = deque(maxlen=2*fore_window + 1)
+
+        # The last machine_history_size values from each machine
+        self.machine_values = {}
+        # For each machine, the most recent 2k good points from other machines
+        # as of the last time one of its points was scored, and how far into
+        # the good points that got.  At most one point from the machine itself
+        # can have been added since, so catching up costs O(k) per point.
+        self.others = {}
+        self.others_seen = {}
+
+    def score(self, d, fore):
+        """Scores `d`, given a RollingWindow of the fore_window values
+        starting at it.
+
+        Sets the statistics and t-test score of `d`, marks it as a machine
+        issue if it looks like one, and returns whether it was considered
+        good.
+        """
+        j = self.back_window
+
+        d.historical_stats = self.back.stats()
+        d.forward_stats = fore.stats()
+
+        if len(self.back) >= j:
+            d.t = abs(calc_t_stats(self.back.stats(linear_weights),
+                                   fore.stats(linear_weights)))
+        else:
+            # Assume it's ok, we don't have enough data
+            d.t = 0
+
+        if self.machine_threshold is not None and self._isBadMachine(d):
+            # We think this machine is bad, so don't add its data to the set
+            # of good data
+            d.state = 'machine'
+            return False
+
+        self.num_good += 1
+        if self.first_good is None:
+            self.first_good = d
+        self.good_tail.append(d)
+        self.back.appendleft(d.value)
+        if len(self.back) > j:
+            self.back.pop()
+        return True
+
+    def _isBadMachine(self, d):
+        k = self.fore_window
+        machine_id = d.machine_id
+
+        if machine_id not in self.machine_values:
+            self.machine_values[machine_id] = deque(maxlen=self.machine_history_size)
+        my_data = self.machine_values[machine_id]
+        my_data.append(d.value)
+
+        if machine_id not in self.others:
+            self.others[machine_id] = deque(maxlen=k*2)
+        recent_others = self.others[machine_id]
+        new_others = []
+        # The very first good point is never compared against
+        tail_start = self.num_good - len(self.good_tail)
+        stop = max(self.others_seen.get(machine_id, 1), 1, tail_start)
+        l = self.num_good - 1
+        while len(new_others) < k*2 and l >= stop:
+            dl = self.good_tail[l - tail_start]
+            if dl.machine_id != machine_id:
+                new_others.append(dl)
+            l -= 1
+        new_others.reverse()
+        recent_others.extend(new_others)
+        self.others_seen[machine_id] = self.num_good
+
+        if len(recent_others) >= k*2 and len(my_data) >= self.machine_history_size:
+            m_t = calc_t([o.value for o in recent_others], list(my_data),
+                         linear_weights)
+        else:
+            m_t = 0
+
+        if abs(m_t) < self.machine_threshold:
+            return False
+
+        if recent_others:
+            d.last_other = recent_others[-1]
+        elif self.first_good is not None and self.first_good.machine_id != machine_id:
+            d.last_other = self.first_good
+        return True
+
+    def copy(self):
+        """Returns a scorer that carries on independently from this one."""
+        c = PointScorer(self.back_window, self.fore_window,
+                        self.machine_threshold, self.machine_history_size)
+        c.back = self.back.copy()
+        c.num_good = self.num_good
+        c.first_good = self.first_good
+        c.good_tail.extend(self.good_tail)
+        for machine_id, values in self.machine_values.items():
+            c.machine_values[machine_id] = deque(values, maxlen=values.maxlen)
+        for machine_id, others in self.others.items():
+            c.others[machine_id] = deque(others, maxlen=others.maxlen)
+        c.others_seen = dict(self.others_seen)
+        return c
+
+    def get_state(self):
+        """Returns the state of this scorer as JSON-friendly data."""
+        def datum(d):
+            return d.to_dict() if d is not None else None
+        return {
+            'back': list(self.back.values),
+            'num_good': self.num_good,
+            'first_good': datum(self.first_good),
+            'good_tail': [datum(d) for d in self.good_tail],
+            # Machine ids aren't necessarily strings, so no dicts here
+            'machine_values': [[m, list(v)] for m, v in self.machine_values.items()],
+            'others': [[m, [datum(d) for d in o]] for m, o in self.others.items()],
+            'others_seen': self.others_seen.items(),
+            }
+
+    def set_state(self, state, datum_class=None):
+        """Restores state saved by get_state(), making points with
+        `datum_class` (PerfDatum by default)."""
+        if datum_class is None:
+            datum_class = PerfDatum
+        def datum(obj):
+            return datum_class.from_dict(obj) if obj is not None else None
+        self.back = RollingWindow.from_values(state['back'])
+        self.num_good = state['num_good']
+        self.first_good = datum(state['first_good'])
+        self.good_tail.clear()
+        self.good_tail.extend(datum(d) for d in state['good_tail'])
+        self.machine_values = {}
+        for machine_id, values in state['machine_values']:
+            self.machine_values[machine_id] = deque(values, maxlen=self.machine_history_size)
+        self.others = {}
+        for machine_id, others in state['others']:
+            self.others[machine_id] = deque((datum(d) for d in others),
+                                            maxlen=2*self.fore_window)
+        self.others_seen = dict(state['others_seen'])
+
+
 class TalosAnalyzer:
     def __init__(self):
         # List of PerfDatum instances
@@ -120,92 +581,246 @@ class TalosAnalyzer:
 
     def addData(self, data):
         self.data.extend(data)
-        for d in data:
-            self.machine_history.setdefault(d.machine_id, []).append(d)
-
         self.data.sort()
-        for d in self.machine_history.values():
-            d.sort()
+
+        # Rebuild the per-machine histories from the sorted data
+        self.machine_history = {}
+        for d in self.data:
+            self.machine_history.setdefault(d.machine_id, []).append(d)
 
     def analyze_t(self, back_window=12, fore_window=12, t_threshold=7,
                   machine_threshold=None, machine_history_size=None):
         # Use T-Tests
         # Analyze test data using T-Tests, comparing data[i-j:i] to data[i:i+k]
         (j, k) = (back_window, fore_window)
-        good_data = []
-
         num_points = len(self.data) - k + 1
-        for i in range(num_points):
-            di = self.data[i]
-            jw = [d.value for d in good_data[-j:]]
-            kw = [d.value for d in self.data[i:i+k]]
-
-            # Reverse the backward data so that the current point is at the
-            # start of the window.
-            jw.reverse()
 
-            di.historical_stats = analyze(jw)
-            di.forward_stats = analyze(kw)
-
-            if len(jw) >= j:
-                di.t = abs(calc_t(jw, kw, linear_weights))
-            else:
-                # Assume it's ok, we don't have enough data
-                di.t = 0
-
-            if machine_threshold is None:
-                good_data.append(di)
-            else:
-                my_history = self.machine_history[di.machine_id]
-                my_history_index = my_history.index(di)
-                my_data = [d.value for d in self.machine_history[di.machine_id][my_history_index-machine_history_size+1:my_history_index+1]]
-                other_data = []
-                l = len(good_data)-1
-                while len(other_data) < k*2 and l > 0:
-                    dl = good_data[l]
-                    if dl.machine_id != di.machine_id:
-                        other_data.insert(0, dl.value)
-                    l -= 1
-
-                if len(other_data) >= k*2 and len(my_data) >= machine_history_size:
-                    m_t = calc_t(other_data, my_data, linear_weights)
-                else:
-                    m_t = 0
-
-                if abs(m_t) >= machine_threshold:
-                    l = len(good_data)-1
-                    while l >= 0:
-                        dl = good_data[l]
-                        if dl.machine_id != di.machine_id:
-                            di.last_other = dl
-                            break
-                        l -= 1
-                    # We think this machine is bad, so don't add its data to the
-                    # set of good data
-                    di.state = 'machine'
-                else:
-                    good_data.append(di)
+        if machine_threshold is None and numpy is not None:
+            good_data = self._calc_t_numpy(j, k)
+        else:
+            good_data = self._calc_t(j, k, machine_threshold,
+                                     machine_history_size)
 
         # Now that the t-test scores are calculated, go back through the data to
         # find where regressions most likely happened.
         for i in range(1, len(good_data) - 1):
-            di = good_data[i]
-            if di.t <= t_threshold:
-                continue
-
-            # Check the adjacent points
-            prev = good_data[i-1]
-            if prev.t > di.t:
-                continue
-            next = good_data[i+1]
-            if next.t > di.t:
-                continue
-
-            # This datapoint has a t value higher than the threshold and higher
-            # than either neighbor.  Mark it as the cause of a regression.
-            di.state = 'regression'
+            if is_regression(good_data[i-1], good_data[i], good_data[i+1],
+                             t_threshold):
+                good_data[i].state = 'regression'
 
         # Return all but the first and last points whose scores we calculated,
         # since we can only produce a final decision for a point whose scores
         # were compared to both of its neighbors.
         return self.data[1:num_points-1]
+
+    def _calc_t_numpy(self, j, k):
+        """Scores every point with batch_calc_t; all points are good."""
+        values = [d.value for d in self.data]
+        scores = batch_calc_t(values, j, k)
+        for di, (historical_stats, forward_stats, t) in zip(self.data, scores):
+            di.historical_stats = historical_stats
+            di.forward_stats = forward_stats
+            di.t = t
+        return self.data[:len(scores)]
+
+    def _calc_t(self, j, k, machine_threshold, machine_history_size):
+        """Scores each point in turn, setting aside data from bad machines.
+
+        Returns the list of points that were considered good.
+        """
+        scorer = PointScorer(j, k, machine_threshold, machine_history_size)
+        good_data = []
+
+        # The fore window holds data[i:i+k] and slides along with i, so its
+        # statistics are updated rather than recomputed for every point.
+        fore = RollingWindow()
+        for d in self.data[:k-1]:
+            fore.append(d.value)
+
+        for i in range(len(self.data) - k + 1):
+            di = self.data[i]
+            fore.append(self.data[i+k-1].value)
+            if scorer.score(di, fore):
+                good_data.append(di)
+            fore.popleft()
+
+        return good_data
+
+
+class StreamingTalosAnalyzer(object):
+    """Runs the analyze_t algorithm incrementally over a growing series.
+
+    New points are passed to add() as they come in; it returns the points
+    whose final state ('good', 'regression' or 'machine') became known,
+    in push order.  A point is scored once `fore_window` points (including
+    itself) are available, and a good point is final once the next good point
+    has been scored.  Only the points needed for that, plus `history_size`
+    already scored points, are kept.
+
+    Points that arrive out of order are fine as long as they are newer than
+    the oldest retained point: the retained points from there on are
+    rescored, and any already-returned point whose state changed is returned
+    again.  Older points are dropped.
+
+    get_state() and from_state() save and restore everything, so a series
+    can be picked up where the last run left off.
+    """
+
+    def __init__(self, back_window=12, fore_window=12, t_threshold=7,
+                 machine_threshold=None, machine_history_size=None,
+                 history_size=None, datum_class=PerfDatum):
+        self.back_window = back_window
+        self.fore_window = fore_window
+        self.t_threshold = t_threshold
+        self.machine_threshold = machine_threshold
+        self.machine_history_size = machine_history_size
+        if history_size is None:
+            history_size = 2 * (back_window + fore_window)
+        self.history_size = history_size
+        self.datum_class = datum_class
+
+        self.scorer = PointScorer(back_window, fore_window, machine_threshold,
+                                  machine_history_size)
+        # Scorer state from just before self.history[0]
+        self.checkpoint = self.scorer.copy()
+
+        # Scored points, whether each one's state is final, and how many of
+        # them have been returned from add()
+        self.history = []
+        self.final = []
+        self.num_emitted = 0
+        # Index in self.history of the last good point, if it's there
+        self.last_good = None
+        # Points waiting for enough newer points to be scored
+        self.pending = []
+
+    def add(self, data):
+        """Adds new points to the series, and returns the points whose state
+        became final as a result."""
+        # What we've told the caller already, before any late points are
+        # slotted in among those points
+        already_emitted = dict((id(d), d.state) for d in self.history[:self.num_emitted])
+        rescore = False
+        for d in sorted(data):
+            if self.history and d < self.history[-1]:
+                if d < self.history[0]:
+                    log.warning("Dropping %s, which is older than the retained history", d)
+                    continue
+                insort(self.history, d)
+                rescore = True
+            else:
+                insort(self.pending, d)
+
+        if rescore:
+            # Start over from the checkpoint
+            for d in self.history:
+                d.state = 'good'
+                d.last_other = None
+            self.pending = self.history + self.pending
+            self.history = []
+            self.final = []
+            self.num_emitted = 0
+            self.last_good = None
+            self.scorer = self.checkpoint.copy()
+
+        self._scorePending()
+
+        emitted = []
+        while self.num_emitted < len(self.history) and self.final[self.num_emitted]:
+            d = self.history[self.num_emitted]
+            if already_emitted.get(id(d)) != d.state:
+                emitted.append(d)
+            self.num_emitted += 1
+
+        self._trimHistory()
+        return emitted
+
+    def _scorePending(self):
+        k = self.fore_window
+        fore = RollingWindow()
+        for d in self.pending[:k-1]:
+            fore.append(d.value)
+
+        i = 0
+        while i + k <= len(self.pending):
+            d = self.pending[i]
+            fore.append(self.pending[i+k-1].value)
+            good = self.scorer.score(d, fore)
+            fore.popleft()
+
+            self.history.append(d)
+            # Machine issues are final as soon as they're scored; good points
+            # have to wait to be compared with the next good point.
+            self.final.append(not good)
+            if good:
+                if self.last_good is not None:
+                    prev = self.history[self.last_good]
+                    tail = self.scorer.good_tail
+                    if self.scorer.num_good >= 3 and \
+                            is_regression(tail[-3], prev, d, self.t_threshold):
+                        prev.state = 'regression'
+                    self.final[self.last_good] = True
+                self.last_good = len(self.history) - 1
+            i += 1
+        del self.pending[:i]
+
+    def _trimHistory(self):
+        # Let the history grow to twice its size before trimming, so the
+        # checkpoint is brought forward in batches
+        excess = min(len(self.history) - self.history_size, self.num_emitted)
+        if len(self.history) < 2 * self.history_size or excess <= 0:
+            return
+
+        k = self.fore_window
+        for i in range(excess):
+            fore = RollingWindow.from_values(
+                d.value for d in islice(chain(self.history[i:], self.pending), k))
+            # Score a copy, so that points that have been emitted keep what
+            # they were emitted with
+            self.checkpoint.score(self.history[i].copy(), fore)
+
+        del self.history[:excess]
+        del self.final[:excess]
+        self.num_emitted -= excess
+        if self.last_good is not None:
+            self.last_good -= excess
+            if self.last_good < 0:
+                self.last_good = None
+
+    def get_state(self):
+        """Returns the state of this analyzer as JSON-friendly data."""
+        return {
+            'params': self.params(),
+            'scorer': self.scorer.get_state(),
+            'checkpoint': self.checkpoint.get_state(),
+            'history': [d.to_dict() for d in self.history],
+            'final': self.final,
+            'num_emitted': self.num_emitted,
+            'last_good': self.last_good,
+            'pending': [d.to_dict() for d in self.pending],
+            }
+
+    def params(self):
+        """The settings that affect the analysis results."""
+        return {
+            'back_window': self.back_window,
+            'fore_window': self.fore_window,
+            't_threshold': self.t_threshold,
+            'machine_threshold': self.machine_threshold,
+            'machine_history_size': self.machine_history_size,
+            }
+
+    @classmethod
+    def from_state(cls, state, history_size=None, datum_class=PerfDatum):
+        """Creates an analyzer from state saved by get_state()."""
+        params = state['params']
+        a = cls(history_size=history_size, datum_class=datum_class,
+                **dict((str(k), v) for k, v in params.items()))
+        a.scorer.set_state(state['scorer'], datum_class)
+        a.checkpoint.set_state(state['checkpoint'], datum_class)
+        a.history = [datum_class.from_dict(d) for d in state['history']]
+        a.final = state['final']
+        a.num_emitted = state['num_emitted']
+        a.last_good = state['last_good']
+        a.pending = [datum_class.from_dict(d) for d in state['pending']]
+        return a
@@ -0,0 +1,409 @@
+# This Source Code Form is subject to the terms of the Mozilla Public
+# License, v. 2.0. If a copy of the MPL was not distributed with this file,
+# You can obtain one at http://mozilla.org/MPL/2.0/.
+import os, time
+import heapq
+from multiprocessing.pool import ThreadPool
+import logging as log
+try:
+    import simplejson as json
+except ImportError:
+    import json
+
+from analyze import PerfDatum, StreamingTalosAnalyzer
+
+# Bump this whenever the layout of the cache files changes
+CACHE_FORMAT = 1
+
+# How often to rewrite a series' data log to drop points that have aged out
+COMPACT_INTERVAL = 24*3600
+
+# How long to trust a cached bug, and how long to wait before looking for a bug
+# we couldn't get again
+BUG_TTL = 7*24*3600
+BUG_MISSING_TTL = 3600
+
+# How long to remember that we warned about a bad machine
+MACHINE_WARNING_TTL = 7*24*3600
+
+# Which fields of a bug to keep
+BUG_FIELDS = ('id', 'summary', 'status', 'resolution')
+
+# How many bugs to ask for per request, and how many requests to have going
+# at once
+BUG_CHUNK_SIZE = 50
+BUG_THREADS = 4
+
+
+class SeriesState:
+    """What we remember about a TestSeries between runs."""
+    def __init__(self, analyzer, last_run=0, last_time=0, last_good=None,
+                 compacted=0):
+        # StreamingTalosAnalyzer holding the in-progress analysis
+        self.analyzer = analyzer
+        # Highest test run id and test run time we've fetched
+        self.last_run = last_run
+        self.last_time = last_time
+        # The most recent point that was found to be good
+        self.last_good = last_good
+        # When the data log was last compacted
+        self.compacted = compacted
+
+
+class SeriesCache:
+    """On-disk cache of per-series data and analysis state.
+
+    Each series gets two files in `dirname`: a small JSON header with the
+    SeriesState, rewritten on every save, and an append-only log of the points
+    whose analysis is final, one JSON object per line.  Both are thrown away
+    if `params` (the analysis settings) differ from the ones they were written
+    with.
+    """
+
+    def __init__(self, dirname, params):
+        self.dirname = dirname
+        self.params = dict(params, format=CACHE_FORMAT)
+
+    def _basename(self, series):
+        return os.path.join(self.dirname, "%s-%s-%s" % (series.branch_id,
+                            series.os_id, series.test_id))
+
+    def load(self, series):
+        """Returns the cached SeriesState for `series`, or None if there isn't
+        a usable one."""
+        fn = self._basename(series) + ".json"
+        if not os.path.exists(fn):
+            return None
+
+        try:
+            header = json.load(open(fn))
+            if header['params'] != self.params:
+                log.info("Analysis settings changed, discarding cached state for %s", series)
+                self.remove(series)
+                return None
+
+            analyzer = StreamingTalosAnalyzer.from_state(header['analyzer'])
+            if header['last_good']:
+                last_good = PerfDatum.from_dict(header['last_good'])
+            else:
+                last_good = None
+            return SeriesState(analyzer, header['last_run'],
+                               header['last_time'], last_good,
+                               header['compacted'])
+        except KeyboardInterrupt:
+            raise
+        except:
+            log.exception("Couldn't load cached state from %s", fn)
+            self.remove(series)
+            return None
+
+    def save(self, series, state, new_points, cutoff):
+        """Saves `state`, appending `new_points` to the data log and dropping
+        logged points from before `cutoff` once a day."""
+        base = self._basename(series)
+        if not os.path.exists(self.dirname):
+            os.makedirs(self.dirname)
+
+        if new_points:
+            fp = open(base + ".log", "a")
+            for d in new_points:
+                fp.write(json.dumps(d.to_dict(), separators=(',', ':')))
+                fp.write("\n")
+            fp.close()
+
+        if state.compacted < time.time() - COMPACT_INTERVAL:
+            self.compact(series, cutoff)
+            state.compacted = time.time()
+
+        header = {
+            'params': self.params,
+            'analyzer': state.analyzer.get_state(),
+            'last_run': state.last_run,
+            'last_time': state.last_time,
+            'last_good': state.last_good.to_dict() if state.last_good else None,
+            'compacted': state.compacted,
+            }
+        tmp = base + ".json.tmp"
+        json.dump(header, open(tmp, "w"), separators=(',', ':'))
+        os.rename(tmp, base + ".json")
+
+    def loadData(self, series):
+        """Returns the logged points for `series`, oldest first."""
+        fn = self._basename(series) + ".log"
+        if not os.path.exists(fn):
+            return []
+
+        # A point can be logged twice if we were interrupted between writing
+        # the log and the header; the later copy wins.
+        points = {}
+        for line in open(fn):
+            d = PerfDatum.from_dict(json.loads(line))
+            points[(d.testrun_id, d.testrun_timestamp, d.machine_id)] = d
+        return sorted(points.values())
+
+    def compact(self, series, cutoff):
+        """Drops logged points that were run before `cutoff`."""
+        fn = self._basename(series) + ".log"
+        if not os.path.exists(fn):
+            return
+
+        tmp = fn + ".tmp"
+        fp = open(tmp, "w")
+        for line in open(fn):
+            if json.loads(line)['testrun_timestamp'] >= cutoff:
+                fp.write(line)
+        fp.close()
+        os.rename(tmp, fn)
+
+    def remove(self, series):
+        base = self._basename(series)
+        for fn in (base + ".json", base + ".log"):
+            if os.path.exists(fn):
+                os.unlink(fn)
+
+
+class BugCache:
+    """Cache of bug summaries, kept in the JSON file `filename` between runs
+    (if given).
+
+    `fetch` is called with a list of bug numbers, and returns the ones it
+    could get, keyed by bug number.  Bugs that couldn't be fetched are
+    remembered as missing for BUG_MISSING_TTL.
+    """
+
+    def __init__(self, filename, fetch):
+        self.filename = filename
+        self.fetch = fetch
+        # bug number (as a string, like in the file) -> (fetch time, bug or
+        # None)
+        self.bugs = {}
+
+    def load(self):
+        if not self.filename or not os.path.exists(self.filename):
+            return
+        try:
+            self.bugs = dict((k, tuple(v)) for k, v in json.load(open(self.filename)).items())
+        except KeyboardInterrupt:
+            raise
+        except:
+            log.exception("Couldn't load bugs from %s", self.filename)
+            self.bugs = {}
+
+    def save(self):
+        if not self.filename:
+            return
+        now = time.time()
+        bugs = dict((k, v) for k, v in self.bugs.items() if not self._expired(v, now))
+        tmp = self.filename + ".tmp"
+        json.dump(bugs, open(tmp, "w"), separators=(',', ':'))
+        os.rename(tmp, self.filename)
+
+    def _expired(self, entry, now):
+        fetched, bug = entry
+        if bug is None:
+            return fetched < now - BUG_MISSING_TTL
+        return fetched < now - BUG_TTL
+
+    def prefetch(self, bug_nums):
+        """Fetches whichever of `bug_nums` aren't cached yet, BUG_CHUNK_SIZE at
+        a time on up to BUG_THREADS threads."""
+        now = time.time()
+        todo = sorted(set(str(b) for b in bug_nums
+                          if str(b) not in self.bugs or self._expired(self.bugs[str(b)], now)))
+        if not todo:
+            return
+
+        log.debug("Fetching %i bugs", len(todo))
+        chunks = [todo[i:i+BUG_CHUNK_SIZE] for i in range(0, len(todo), BUG_CHUNK_SIZE)]
+        if len(chunks) > 1:
+            pool = ThreadPool(min(BUG_THREADS, len(chunks)))
+            try:
+                results = pool.map(self.fetch, chunks)
+            finally:
+                pool.terminate()
+        else:
+            results = map(self.fetch, chunks)
+
+        for chunk, bugs in zip(chunks, results):
+            bugs = dict((str(k), v) for k, v in bugs.items())
+            for bug_num in chunk:
+                bug = bugs.get(bug_num)
+                if bug is not None:
+                    bug = dict((f, bug[f]) for f in BUG_FIELDS if f in bug)
+                self.bugs[bug_num] = (now, bug)
+
+    def get(self, bug_num):
+        """Returns the bug `bug_num`, or None if it couldn't be fetched."""
+        self.prefetch([bug_num])
+        return self.bugs[str(bug_num)][1]
+
+
+class WarningSet:
+    """The (buildid, timestamp) pairs we've sent warnings for on one series.
+
+    Supports `in` and append() like the plain lists processSeries used to
+    be given, but with hashed lookups, and keeps its WarningStore up to date.
+    """
+
+    def __init__(self, store, key):
+        self.store = store
+        self.key = key
+        self.items = set()
+
+    def __contains__(self, item):
+        return tuple(item) in self.items
+
+    def __iter__(self):
+        return iter(self.items)
+
+    def __len__(self):
+        return len(self.items)
+
+    def __eq__(self, o):
+        return self.items == set(tuple(i) for i in o)
+
+    def __ne__(self, o):
+        return not self == o
+
+    def append(self, item):
+        item = tuple(item)
+        if item not in self.items:
+            self.store._add(self.key, item)
+
+
+class WarningStore:
+    """Which warnings we've already sent, kept between runs in the log file
+    `filename`.
+
+    Warnings are grouped by (branch, os, test) into WarningSets, and also
+    kept in a heap by time so that old ones can be expired without looking
+    at the rest.  save() only appends what's been added since the last
+    save; the log is rewritten without its expired entries once those
+    outnumber the live ones.
+    """
+
+    def __init__(self, filename):
+        self.filename = filename
+        # (branch, os, test) -> WarningSet
+        self.warnings = {}
+        # machine name -> when we last warned about it
+        self.bad_machines = {}
+        # (timestamp, key, item) for every warning
+        self._expiry = []
+        # Log records added since the last save, and how many records are in
+        # the log file
+        self._new = []
+        self._logged = 0
+
+    def __eq__(self, o):
+        return self._live() == o._live() and self.bad_machines == o.bad_machines
+
+    def __ne__(self, o):
+        return not self == o
+
+    def _live(self):
+        return dict((k, v.items) for k, v in self.warnings.items() if v.items)
+
+    def series(self, branch, os_name, test_name):
+        """Returns the WarningSet for a series."""
+        key = (branch, os_name, test_name)
+        if key not in self.warnings:
+            self.warnings[key] = WarningSet(self, key)
+        return self.warnings[key]
+
+    def _add(self, key, item, record=True):
+        warnings = self.series(*key)
+        if item in warnings.items:
+            return
+        warnings.items.add(item)
+        heapq.heappush(self._expiry, (item[1], key, item))
+        if record:
+            self._new.append(["w"] + list(key) + list(item))
+
+    def machineWarned(self, machine_name, since):
+        """Returns whether we warned about `machine_name` after `since`."""
+        return self.bad_machines.get(machine_name, 0) > since
+
+    def warnMachine(self, machine_name, when, record=True):
+        self.bad_machines[machine_name] = when
+        if record:
+            self._new.append(["m", machine_name, when])
+
+    def expire(self, cutoff):
+        """Forgets the warnings for points from before `cutoff`."""
+        while self._expiry and self._expiry[0][0] < cutoff:
+            timestamp, key, item = heapq.heappop(self._expiry)
+            log.debug("Removing warning %s since it's before cutoff (%s)", item, cutoff)
+            warnings = self.warnings[key]
+            warnings.items.discard(item)
+            if not warnings.items:
+                del self.warnings[key]
+
+        machine_cutoff = time.time() - MACHINE_WARNING_TTL
+        for machine_name, when in self.bad_machines.items():
+            if when < machine_cutoff:
+                del self.bad_machines[machine_name]
+
+    def load(self, cutoff):
+        """Loads the warnings for points from `cutoff` on."""
+        if os.path.exists(self.filename):
+            for line in open(self.filename):
+                self._logged += 1
+                record = json.loads(line)
+                if record[0] == "w":
+                    if record[5] >= cutoff:
+                        self._add(tuple(record[1:4]), tuple(record[4:6]), record=False)
+                elif record[0] == "m":
+                    self.warnMachine(record[1], record[2], record=False)
+        self.expire(cutoff)
+
+    def importJson(self, filename, cutoff):
+        """Adds the warnings from `filename`, in the format older versions
+        used."""
+        history = json.load(open(filename))
+        for branch, oses in history.items():
+            if branch == 'bad_machines':
+                for machine_name, when in oses.items():
+                    self.warnMachine(machine_name, when)
+                continue
+            if branch == 'inactive_machines':
+                continue
+            for os_name, tests in oses.items():
+                for test_name, values in tests.items():
+                    for buildid, timestamp in values:
+                        if timestamp >= cutoff:
+                            self._add((branch, os_name, test_name), (buildid, timestamp))
+
+    def save(self):
+        live = sum(len(v) for v in self.warnings.values()) + len(self.bad_machines)
+        if self._logged + len(self._new) > 2 * live + 1000:
+            self.compact()
+            return
+
+        if self._new:
+            fp = open(self.filename, "a")
+            for record in self._new:
+                fp.write(json.dumps(record, separators=(',', ':')))
+                fp.write("\n")
+            fp.close()
+            self._logged += len(self._new)
+            self._new = []
+
+    def compact(self):
+        """Rewrites the log with just the live entries."""
+        records = []
+        for key, warnings in sorted(self.warnings.items()):
+            for item in sorted(warnings.items):
+                records.append(["w"] + list(key) + list(item))
+        for machine_name, when in sorted(self.bad_machines.items()):
+            records.append(["m", machine_name, when])
+
+        tmp = self.filename + ".tmp"
+        fp = open(tmp, "w")
+        for record in records:
+            fp.write(json.dumps(record, separators=(',', ':')))
+            fp.write("\n")
+        fp.close()
+        os.rename(tmp, self.filename)
+        self._logged = len(records)
+        self._new = []
@@ -1,14 +1,27 @@
 # This Source Code Form is subject to the terms of the Mozilla Public
 # License, v. 2.0. If a copy of the MPL was not distributed with this file,
 # You can obtain one at http://mozilla.org/MPL/2.0/.
+import os, time
+import hashlib
+import tempfile
 import sqlalchemy as sa
 from sqlalchemy.ext.sqlsoup import SqlSoup
-from sqlalchemy.pool import SingletonThreadPool
+from sqlalchemy.pool import QueuePool
+try:
+    import simplejson as json
+except ImportError:
+    import json
 
 from analyze import PerfDatum
 
 import logging as log
 
+# How long the preloaded machines table is trusted before it's reloaded
+MACHINES_TTL = 3600
+# Looking up a machine that isn't in the table reloads it, but no more often
+# than this many seconds
+MACHINES_RELOAD_INTERVAL = 60
+
 class TestSeries:
     def __init__(self, branch_id, branch_name, os_id, os_name, test_id, test_name, test_shortname):
         self.branch_id = branch_id
@@ -32,14 +45,41 @@ db = None
 goodNameClause = None
 
 
-def connect(url):
+def connect(url, machines_snapshot=None, pool_size=5, max_overflow=10):
+    """Connects to the graph server database at `url` and preloads the
+    machines table, from `machines_snapshot` if it's fresh enough.  The
+    snapshot's name gets a hash of `url` added, so that configurations for
+    different databases can share a cache directory.
+
+    Up to `pool_size` + `max_overflow` connections are opened, so that
+    several threads can run queries at once.
+    """
     global db
-    engine = sa.create_engine(url, pool_recycle=30, echo_pool=True, poolclass=SingletonThreadPool)
+    engine = sa.create_engine(url, pool_recycle=30, poolclass=QueuePool,
+                              pool_size=pool_size, max_overflow=max_overflow)
     db = SqlSoup(engine)
 
+    # SqlSoup reflects tables the first time they're used, which isn't thread
+    # safe, so get that out of the way now
+    for table in ('test_runs', 'builds', 'machines', 'tests', 'branches', 'os_list'):
+        getattr(db, table)
+
     global goodNameClause
     goodNameClause = db.machines.is_active == 1
 
+    global _machines_snapshot, _machines_loaded
+    _machines_snapshot = machines_snapshot and snapshotFilename(machines_snapshot, url)
+    _machines_loaded = 0
+    loadMachines()
+
+
+def dispose():
+    """Closes all pooled connections, e.g. before forking worker processes."""
+    if db is not None:
+        db.bind.dispose()
+    for statusdb in _statusdbs.values():
+        statusdb.bind.dispose()
+
 
 def getTestData(series, start_time, data_type):
     if not data_type:
@@ -64,12 +104,61 @@ def getTestData(series, start_time, data_type):
     for row in q.execute():
         if row[data_type] is None:
             continue
-        t = row.date_run
-        d = PerfDatum(row.id, row.machine_id, row.date_run, row[data_type], row.ref_build_id, t, row.ref_changeset)
-        d.run_number = row.run_number
-        data.append(d)
+        data.append(_makeDatum(row, data_type))
     return data
 
+def _makeDatum(row, data_type):
+    t = row.date_run
+    d = PerfDatum(t, row[data_type], testrun_timestamp=row.date_run,
+                  buildid=row.ref_build_id, testrun_id=row.id,
+                  machine_id=row.machine_id, revision=row.ref_changeset)
+    d.run_number = row.run_number
+    return d
+
+def getTestDataForSeries(series_list, start_time, data_type):
+    """Like getTestData, but for many series at once.
+
+    Yields a (series, data) tuple for each series in `series_list`, ordered
+    by (branch_id, os_id, test_id).  There's one query for each branch and
+    OS, covering all of its tests in `series_list`, so only the series that
+    were asked for are fetched, and only one query's worth of rows is held in
+    memory at a time.  With drivers that support it, such as psycopg2, the
+    rows are also read through a server-side cursor.
+    """
+    if not data_type:
+        data_type = 'average'
+
+    wanted = dict(((s.branch_id, s.os_id, s.test_id), s) for s in series_list)
+    tests = {}
+    for branch_id, os_id, test_id in wanted:
+        tests.setdefault((branch_id, os_id), set()).add(test_id)
+
+    for branch_id, os_id in sorted(tests):
+        q = sa.select(
+            [db.test_runs.id, db.test_runs.machine_id, db.builds.ref_build_id,
+                db.test_runs.date_run, db.test_runs.average, db.test_runs.geomean,
+                db.builds.ref_changeset, db.test_runs.run_number,
+                db.test_runs.test_id],
+            sa.and_(
+            db.test_runs.test_id.in_(tests[branch_id, os_id]),
+            db.builds.branch_id == branch_id,
+            db.machines.os_id == os_id,
+            db.test_runs.machine_id == db.machines.id,
+            db.test_runs.build_id == db.builds.id,
+            db.test_runs.date_run > start_time,
+            goodNameClause,
+            )).order_by(db.test_runs.test_id)
+
+        rows = iter(q.execution_options(stream_results=True).execute())
+        row = next(rows, None)
+        for test_id in sorted(tests[branch_id, os_id]):
+            data = []
+            while row is not None and row.test_id <= test_id:
+                if row.test_id == test_id and row[data_type] is not None:
+                    data.append(_makeDatum(row, data_type))
+                row = next(rows, None)
+            yield wanted[branch_id, os_id, test_id], data
+
 def getTestSeries(branches, start_date, test_names, last_run=None):
     # Find all the Branch/OS/Test combinations
     if len(test_names) > 0:
@@ -123,26 +212,87 @@ def getMachinesForTest(series):
     return _machines_cache[key]
 
 
-_name_cache = {}
+# machine id -> (name, os_id, is_active), for every machine in the database
+_machines = {}
+# When _machines was loaded from the database
+_machines_loaded = 0
+# Where to keep a copy of _machines between runs
+_machines_snapshot = None
+
+
+def snapshotFilename(machines_snapshot, url):
+    """Returns where to keep the snapshot of the machines table of the
+    database at `url`, given the configured `machines_snapshot`."""
+    root, ext = os.path.splitext(machines_snapshot)
+    return "%s-%s%s" % (root, hashlib.sha1(url).hexdigest()[:12], ext)
+
+
+def loadMachines(force=False):
+    """(Re)loads the machines table if it's more than MACHINES_TTL seconds
+    old, or with `force`, more than MACHINES_RELOAD_INTERVAL seconds old.
+
+    The table is read from the snapshot file if that's recent enough, and
+    otherwise queried in full and written out to the snapshot.
+    """
+    global _machines, _machines_loaded
+    now = time.time()
+    if _machines_loaded > now - (MACHINES_RELOAD_INTERVAL if force else MACHINES_TTL):
+        return
+
+    if not force and _machines_snapshot and os.path.exists(_machines_snapshot):
+        try:
+            snapshot = json.load(open(_machines_snapshot))
+            if snapshot['loaded'] > now - MACHINES_TTL:
+                _machines = dict((int(k), tuple(v)) for k, v in snapshot['machines'].items())
+                _machines_loaded = snapshot['loaded']
+                log.debug("Loaded %i machines from %s", len(_machines), _machines_snapshot)
+                return
+        except KeyboardInterrupt:
+            raise
+        except:
+            log.exception("Couldn't load machines from %s", _machines_snapshot)
+
+    t = time.time()
+    q = sa.select([db.machines.id, db.machines.name, db.machines.os_id,
+                   db.machines.is_active])
+    _machines = dict((row.id, (row.name, row.os_id, row.is_active))
+                     for row in q.execute())
+    _machines_loaded = now
+    log.debug("%.2f to load %i machines", time.time() - t, len(_machines))
+
+    if _machines_snapshot:
+        # Worker processes can be doing this at the same time, so each
+        # writes its own temporary file
+        fd, tmp = tempfile.mkstemp(dir=os.path.dirname(_machines_snapshot) or '.',
+                                   prefix=os.path.basename(_machines_snapshot) + ".")
+        fp = os.fdopen(fd, "w")
+        json.dump({'loaded': _machines_loaded, 'machines': _machines},
+                  fp, separators=(',', ':'))
+        fp.close()
+        os.rename(tmp, _machines_snapshot)
 
 
 def getMachineName(machine_id):
-    if machine_id in _name_cache:
-        return _name_cache[machine_id]
+    loadMachines()
+    if machine_id not in _machines:
+        # Added since we loaded the table, unless that was just now
+        loadMachines(force=True)
+        if machine_id not in _machines:
+            # Don't go looking for it again until the next reload
+            _machines[machine_id] = (None, None, None)
+    return _machines[machine_id][0]
+
+# statusdb url -> SqlSoup
+_statusdbs = {}
 
-    m = db.machines.filter_by(id=machine_id).one()
-    if m:
-        _name_cache[machine_id] = m.name
-        return m.name
-    else:
-        _name_cache[machine_id] = None
-        return None
 
 def getInactiveMachines(statusdb_url, initial_time, start_time, end_time):
     """Returns a list of slave machines that have been active between
     initial_time and end_time, but haven't been active between start_time and
     end_time"""
-    db = SqlSoup(statusdb_url)
+    if statusdb_url not in _statusdbs:
+        _statusdbs[statusdb_url] = SqlSoup(statusdb_url)
+    db = _statusdbs[statusdb_url]
 
     q = sa.select([db.slaves.id, db.slaves.name], sa.and_(
         sa.not_(sa.exists(
@@ -7,8 +7,11 @@ try:
 except ImportError:
     import json
 
-import urllib
+import re
+from array import array
+from itertools import izip
 from analyze import PerfDatum
+from analyze_http import HTTPCache
 
 
 class TestSeries:
@@ -27,15 +30,193 @@ class TestSeries:
         return hash((self.branch_id, self.os_id, self.test_id))
 
 
+class SeriesCatalog:
+    """Test series indexed by branch, test and os name, so that looking up
+    the series for one of them doesn't mean going through all of them."""
+
+    fields = ('branch_name', 'test_name', 'os_name')
+
+    def __init__(self, series=()):
+        self.series = []
+        self._seen = set()
+        # field -> name -> series with that name, in the order they were added
+        self._index = dict((field, {}) for field in self.fields)
+        for s in series:
+            self.add(s)
+
+    def add(self, series):
+        """Adds `series` if it isn't already there, and returns whether it
+        was added."""
+        if series in self._seen:
+            return False
+        self._seen.add(series)
+        self.series.append(series)
+        for field in self.fields:
+            self._index[field].setdefault(getattr(series, field), []).append(series)
+        return True
+
+    def __len__(self):
+        return len(self.series)
+
+    def __iter__(self):
+        return iter(self.series)
+
+    def __contains__(self, series):
+        return series in self._seen
+
+    def names(self, field):
+        """Returns the distinct values of `field`."""
+        return sorted(self._index[field])
+
+    def find(self, branch_name=None, test_name=None, os_name=None):
+        """Returns the series with all of the given names, in the order they
+        were added."""
+        wanted = [(field, name) for field, name in
+                  zip(self.fields, (branch_name, test_name, os_name)) if name is not None]
+        if not wanted:
+            return list(self.series)
+
+        # Start from the shortest list, and check the other names on that
+        candidates = [(self._index[field].get(name, []), field) for field, name in wanted]
+        candidates.sort(key=lambda c: len(c[0]))
+        retval = candidates[0][0]
+        for field, name in wanted:
+            if field != candidates[0][1]:
+                retval = [s for s in retval if getattr(s, field) == name]
+        return list(retval)
+
+
+class PerfSeries:
+    """The runs of one test series, kept column by column rather than as a
+    PerfDatum per run, so that a long series takes a few flat arrays."""
+
+    def __init__(self):
+        self.testrun_ids = array('l')
+        self.timestamps = array('l')
+        self.values = array('d')
+        # These can be null, so they can't go in an array
+        self.machine_ids = []
+        self.run_numbers = []
+        self.buildids = []
+        self.revisions = []
+
+    def __len__(self):
+        return len(self.values)
+
+    def perfData(self):
+        """Returns the runs as a list of PerfDatum."""
+        retval = []
+        for testrun_id, timestamp, value, machine_id, buildid, revision, run_number in izip(
+                self.testrun_ids, self.timestamps, self.values, self.machine_ids,
+                self.buildids, self.revisions, self.run_numbers):
+            d = PerfDatum(timestamp, value, testrun_timestamp=timestamp,
+                          buildid=buildid, testrun_id=testrun_id,
+                          machine_id=machine_id, revision=revision)
+            d.run_number = run_number
+            retval.append(d)
+        return retval
+
+
+_test_runs_start = re.compile(r'"test_runs"\s*:\s*\[')
+_row_separator = re.compile(r'[\s,]*')
+
+
+def iter_test_runs(fp, chunk_size=65536):
+    """Yields the rows of the "test_runs" array in the test/runs payload read
+    from `fp`, in lists of as many rows as were read in one go, without
+    parsing the whole payload first."""
+    decoder = json.JSONDecoder()
+    buf = ''
+    while True:
+        chunk = fp.read(chunk_size)
+        buf += chunk
+        m = _test_runs_start.search(buf)
+        if m:
+            break
+        if not chunk:
+            return
+        # Keep enough to find the key if it's split across chunks
+        buf = buf[-32:]
+
+    pos = m.end()
+    # Rows before this offset have to be parsed one at a time
+    single_until = pos
+    eof = False
+    while True:
+        pos = _row_separator.match(buf, pos).end()
+        if buf[pos:pos+1] == ']':
+            return
+
+        # Parse all the whole rows we have in one go.  If the last "],[" in
+        # the buffer is inside a string rather than between two rows, the
+        # rows before it won't parse, and we go through them one by one
+        end = buf.rfind('],[', pos)
+        if end != -1 and end > single_until:
+            try:
+                rows = json.loads('[' + buf[pos:end+1] + ']')
+            except ValueError:
+                single_until = end
+            else:
+                yield rows
+                pos = end + 2
+                continue
+
+        try:
+            row, pos = decoder.raw_decode(buf, pos)
+        except ValueError:
+            # Every row is an array, so a row that's cut off at the end of
+            # the buffer can't be mistaken for a whole one
+            if eof:
+                raise
+            chunk = fp.read(chunk_size)
+            eof = not chunk
+            single_until -= pos
+            buf = buf[pos:] + chunk
+            pos = 0
+            continue
+        yield [row]
+
+
+def load_test_runs(fp, data_type='average'):
+    """Reads a test/runs payload from `fp` into a PerfSeries, leaving out
+    runs without a value.  `data_type` is 'average', or 'geomean' for
+    payloads that have it."""
+    column = 7 if data_type == 'geomean' else 3
+    series = PerfSeries()
+    columns = (series.testrun_ids, series.timestamps, series.values,
+               series.machine_ids, series.buildids, series.revisions,
+               series.run_numbers)
+    for rows in iter_test_runs(fp):
+        rows = [(r[0], r[2], r[column], r[6], r[1][1], r[1][2], r[4])
+                for r in rows if len(r) > column and r[column] is not None]
+        for col, values in izip(columns, izip(*rows)):
+            col.extend(values)
+    return series
+
+
 class GraphAPISource:
-    def __init__(self, baseurl):
+    """Gets test series and their data from the graph server's api.
+
+    `cache` is the HTTPCache to fetch through; by default responses are
+    gzipped but not kept.
+    """
+
+    def __init__(self, baseurl, cache=None):
         self.baseurl = baseurl
+        self.http = cache or HTTPCache()
+
+    @classmethod
+    def from_config(cls, config):
+        """Returns a GraphAPISource for the api of the graph server at
+        base_graph_url, caching responses as the [cache] section of `config`
+        says; see HTTPCache.from_config."""
+        return cls(config.get('main', 'base_graph_url') + "/api", HTTPCache.from_config(config))
 
     def getTestSeries(self, branches, test_names):
         url = "%s/%s" % (self.baseurl, "test")
         try:
             log.debug("Getting %s", url)
-            req = urllib.urlopen(url)
+            req = self.http.open(url)
             tests = json.load(req)
         except KeyboardInterrupt:
             raise
@@ -47,78 +228,65 @@ class GraphAPISource:
             log.warn("Test status not ok: %s", tests['stat'])
             return []
 
+        return self.seriesFromTests(tests, branches, test_names)
+
+    def seriesFromTests(self, tests, branches, test_names):
+        """Returns the TestSeries on `branches` for `test_names` (or all
+        tests) in the /test catalog `tests`."""
+        branches = set(branches)
+        test_names = set(test_names or ())
+        branch_map = tests['branchMap']
+        platform_map = tests['platformMap']
+
         retval = []
+        seen = set()
         for test_id, test in tests['testMap'].items():
             test_name = test['name']
             if test_names and test_name not in test_names:
                 continue
 
-            for branch_id in test['branchIds']:
-                branch_info = tests['branchMap'][str(branch_id)]
-                if branch_info['name'] not in branches or str(branch_id) not in tests['branchMap']:
-                    continue
+            # Skip NoChrome and Fast Cycle tests
+            if "NoChrome" in test_name or "Fast Cycle" in test_name:
+                continue
 
-                for os_id in test['platformIds']:
-                    if str(os_id) not in tests['platformMap']:
-                        continue
-                    os_info = tests['platformMap'][str(os_id)]
+            platforms = [(os_id, platform_map[str(os_id)]['name'])
+                         for os_id in test['platformIds'] if str(os_id) in platform_map]
 
-                    # Skip NoChrome tests
-                    if "NoChrome" in test_name:
-                        continue
+            for branch_id in test['branchIds']:
+                branch_info = branch_map.get(str(branch_id))
+                if branch_info is None or branch_info['name'] not in branches:
+                    continue
 
-                    # Skip Fast Cycle tests
-                    if "Fast Cycle" in test_name:
+                for os_id, os_name in platforms:
+                    key = (branch_id, os_id, test_id)
+                    if key in seen:
                         continue
-
-                    series = TestSeries(branch_id, branch_info['name'],
-                                        os_id, os_info['name'],
-                                        test_id, test_name)
-                    if series not in retval:
-                        retval.append(series)
+                    seen.add(key)
+                    retval.append(TestSeries(branch_id, branch_info['name'],
+                                             os_id, os_name, test_id, test_name))
 
         return retval
 
     def getTestData(self, series):
         base = self.baseurl
-        retval = []
-        seen = {}
         test_id = series.test_id
         branch_id = series.branch_id
         os_id = series.os_id
         url = "%(base)s/test/runs?id=%(test_id)s&branchid=%(branch_id)s&platformid=%(os_id)s" % locals()
         try:
             log.debug("Getting %s", url)
-            req = urllib.urlopen(url)
-            results = json.load(req)
+            req = self.http.open(url)
+            series = load_test_runs(req)
         except KeyboardInterrupt:
             raise
         except:
             log.exception("Couldn't load or parse %s", url)
             return []
 
-        if 'test_runs' not in results:
+        if not series:
             log.debug("No data from %s", url)
             return []
 
-        for item in results['test_runs']:
-            testrunid, build, date, average, run_number, annotations, machine_id, row_geo = item
-            if average is None:
-                continue
-
-            d = PerfDatum(testrunid, machine_id, date, average, build[1], date, build[2])
-            d.run_number = run_number
-            retval.append(d)
-            t = (d.buildid, date, average, machine_id)
-            #if t in seen:
-                #if seen[t].run_number == run_number:
-                    #continue
-                #log.error("%s %s %s", seen[t], seen[t].machine_id, seen[t].run_number)
-                #log.error("%s %s %s", d, d.machine_id, d.run_number)
-                #log.error(url)
-            #else:
-                #seen[t] = d
-
-        return retval
+        return series.perfData()
 
         # TODO: emulate methods getMachinesForTest and getMachineName from analyze_db
@@ -0,0 +1,421 @@
+# This Source Code Form is subject to the terms of the Mozilla Public
+# License, v. 2.0. If a copy of the MPL was not distributed with this file,
+# You can obtain one at http://mozilla.org/MPL/2.0/.
+import os, time, socket, threading
+import httplib, urlparse
+import gzip, hashlib
+from cStringIO import StringIO
+import logging as log
+from Queue import Queue
+try:
+    import simplejson as json
+except ImportError:
+    import json
+
+
+class HTTPError(Exception):
+    def __init__(self, url, code, body):
+        Exception.__init__(self, "HTTP %i fetching %s" % (code, url))
+        self.url = url
+        self.code = code
+        self.body = body
+
+
+class ConnectionPool:
+    """Keeps HTTP connections open between requests, so that fetching many
+    urls from the same host doesn't pay for a new connection each time.
+
+    Any number of threads can share a ConnectionPool; each request checks out
+    its own connection.  Connections aren't shared with forked processes.
+    """
+
+    def __init__(self, timeout=60, retries=3, backoff=1.0):
+        self.timeout = timeout
+        # How many times to retry a request that failed in a way that might
+        # work the next time, and how long to wait before the first retry
+        self.retries = retries
+        self.backoff = backoff
+        # (scheme, host) -> idle connections
+        self._idle = {}
+        self._lock = threading.Lock()
+        self._pid = os.getpid()
+
+    def _checkout(self, scheme, netloc):
+        with self._lock:
+            if self._pid != os.getpid():
+                self._idle = {}
+                self._pid = os.getpid()
+            idle = self._idle.get((scheme, netloc))
+            if idle:
+                return idle.pop()
+        if scheme == 'https':
+            return httplib.HTTPSConnection(netloc, timeout=self.timeout)
+        return httplib.HTTPConnection(netloc, timeout=self.timeout)
+
+    def _checkin(self, scheme, netloc, conn):
+        with self._lock:
+            if self._pid == os.getpid():
+                self._idle.setdefault((scheme, netloc), []).append(conn)
+
+    def close(self):
+        """Closes all the idle connections."""
+        with self._lock:
+            for idle in self._idle.values():
+                for conn in idle:
+                    conn.close()
+            self._idle = {}
+
+    def request(self, url, headers=None):
+        """Makes one GET request for `url`, and returns (status, headers,
+        body)."""
+        scheme, netloc, path, query, fragment = urlparse.urlsplit(url)
+        path = path or '/'
+        if query:
+            path += '?' + query
+
+        while True:
+            conn = self._checkout(scheme, netloc)
+            reused = conn.sock is not None
+            try:
+                conn.request('GET', path, headers=headers or {})
+                resp = conn.getresponse()
+                body = resp.read()
+            except (httplib.HTTPException, socket.error):
+                conn.close()
+                if reused:
+                    # The server probably closed it while it was idle
+                    continue
+                raise
+
+            if resp.will_close:
+                conn.close()
+            else:
+                self._checkin(scheme, netloc, conn)
+            return resp.status, dict(resp.getheaders()), body
+
+    def fetch(self, url, headers=None):
+        """Returns (status, headers, body) for `url`.
+
+        Connection errors and 5xx responses are retried with exponential
+        backoff; other failures raise HTTPError straight away.  A 304 Not
+        Modified response counts as a success.
+        """
+        delay = self.backoff
+        for attempt in range(self.retries + 1):
+            try:
+                status, resp_headers, body = self.request(url, headers)
+            except (httplib.HTTPException, socket.error), e:
+                if attempt == self.retries:
+                    raise
+                log.debug("Error fetching %s (%s), retrying in %.1fs", url, e, delay)
+            else:
+                if 200 <= status < 300 or status == 304:
+                    return status, resp_headers, body
+                if status < 500 or attempt == self.retries:
+                    raise HTTPError(url, status, body)
+                log.debug("HTTP %i fetching %s, retrying in %.1fs", status, url, delay)
+            time.sleep(delay)
+            delay *= 2
+
+    def get(self, url, headers=None):
+        """Returns the body of `url`, retrying as fetch() does."""
+        return self.fetch(url, headers)[2]
+
+
+class HTTPCache:
+    """Fetches urls through a ConnectionPool, asking for gzipped responses,
+    and keeps the responses in `cache_dir` if it's given.
+
+    A cached response is used as is for `ttl` seconds.  After that it's
+    revalidated with If-None-Match/If-Modified-Since, so an unchanged
+    response isn't downloaded again.  Once the cache holds more than
+    `max_size` bytes, the responses used longest ago are removed.
+    """
+
+    def __init__(self, cache_dir=None, pool=None, ttl=1800, max_size=100 * 1024 * 1024):
+        self.cache_dir = cache_dir
+        self.pool = pool or ConnectionPool()
+        self.ttl = ttl
+        self.max_size = max_size
+        # How many bytes the cache holds, as of the last evict() and counting
+        # what's been stored since; None until evict() has looked
+        self._size = None
+
+    @classmethod
+    def from_config(cls, config, pool=None):
+        """Returns an HTTPCache set up by the http_cache (a directory),
+        http_cache_ttl (seconds) and http_cache_size (megabytes) options in
+        the [cache] section of `config`."""
+        kwargs = {}
+        if config.has_option('cache', 'http_cache'):
+            kwargs['cache_dir'] = config.get('cache', 'http_cache')
+        if config.has_option('cache', 'http_cache_ttl'):
+            kwargs['ttl'] = config.getint('cache', 'http_cache_ttl')
+        if config.has_option('cache', 'http_cache_size'):
+            kwargs['max_size'] = config.getint('cache', 'http_cache_size') * 1024 * 1024
+        return cls(pool=pool, **kwargs)
+
+    def _filename(self, url):
+        return os.path.join(self.cache_dir, hashlib.sha1(url).hexdigest())
+
+    def _load(self, url):
+        """Returns the cache entry for `url` and its gzipped body, opened but
+        not read, or (None, None)."""
+        fn = self._filename(url)
+        try:
+            entry = json.load(open(fn + ".json"))
+            if entry.get('url') != url:
+                return None, None
+            return entry, open(fn + ".gz", "rb")
+        except (IOError, ValueError):
+            return None, None
+
+    def _store(self, url, entry, body):
+        if not os.path.exists(self.cache_dir):
+            os.makedirs(self.cache_dir)
+        fn = self._filename(url)
+        # Write the body first; an entry without a body is never used
+        if body is not None:
+            open(fn + ".gz.tmp", "wb").write(body)
+            os.rename(fn + ".gz.tmp", fn + ".gz")
+        json.dump(entry, open(fn + ".json.tmp", "w"))
+        os.rename(fn + ".json.tmp", fn + ".json")
+        if body is not None:
+            if self._size is None or self._size + len(body) > self.max_size:
+                self.evict()
+            else:
+                self._size += len(body)
+
+    def _touch(self, url):
+        # The body's mtime is when it was last used, for evict()
+        try:
+            os.utime(self._filename(url) + ".gz", None)
+        except OSError:
+            pass
+
+    def evict(self):
+        """Removes the responses used longest ago until the cache fits in
+        `max_size`."""
+        entries = []
+        total = 0
+        for fn in os.listdir(self.cache_dir):
+            if not fn.endswith(".gz"):
+                continue
+            path = os.path.join(self.cache_dir, fn)
+            try:
+                st = os.stat(path)
+            except OSError:
+                continue
+            entries.append((st.st_mtime, st.st_size, path))
+            total += st.st_size
+
+        entries.sort()
+        while total > self.max_size and entries:
+            mtime, size, path = entries.pop(0)
+            log.debug("Evicting %s from the http cache", path)
+            for p in (path[:-len(".gz")] + ".json", path):
+                try:
+                    os.unlink(p)
+                except OSError:
+                    pass
+            total -= size
+        self._size = total
+
+    def _compress(self, data):
+        buf = StringIO()
+        f = gzip.GzipFile(fileobj=buf, mode="wb")
+        f.write(data)
+        f.close()
+        return buf.getvalue()
+
+    def get(self, url):
+        """Returns the body of `url`, from the cache if it's still good."""
+        return self.open(url).read()
+
+    def open(self, url):
+        """Returns a file-like object for the body of `url`, from the cache if
+        it's still good.  Gzipped bodies are decompressed as they're read."""
+        entry = cached = None
+        if self.cache_dir:
+            entry, cached = self._load(url)
+            if entry and time.time() - entry['fetched'] < self.ttl:
+                self._touch(url)
+                return gzip.GzipFile(fileobj=cached)
+
+        headers = {'Accept-Encoding': 'gzip'}
+        if entry:
+            if entry.get('etag'):
+                headers['If-None-Match'] = entry['etag']
+            if entry.get('last_modified'):
+                headers['If-Modified-Since'] = entry['last_modified']
+
+        try:
+            status, resp_headers, resp_body = self.pool.fetch(url, headers)
+        except:
+            if cached:
+                cached.close()
+            raise
+        if status == 304 and entry:
+            log.debug("%s hasn't changed", url)
+            entry['fetched'] = time.time()
+            self._store(url, entry, None)
+            self._touch(url)
+            return gzip.GzipFile(fileobj=cached)
+        if cached:
+            cached.close()
+
+        compressed = None
+        if resp_headers.get('content-encoding') == 'gzip':
+            compressed = resp_body
+
+        if self.cache_dir and status == 200:
+            entry = {
+                'url': url,
+                'fetched': time.time(),
+                'etag': resp_headers.get('etag'),
+                'last_modified': resp_headers.get('last-modified'),
+                }
+            # We keep bodies gzipped, whether or not they came that way
+            self._store(url, entry, compressed or self._compress(resp_body))
+
+        if compressed is None:
+            return StringIO(resp_body)
+        return gzip.GzipFile(fileobj=StringIO(compressed))
+
+
+class RateLimited(IOError):
+    """Raised by a UrlShortener's `shorten` function when the service wants
+    us to slow down."""
+
+
+class TokenBucket:
+    """Allows `rate` operations per second on average, in bursts of up to
+    `burst`."""
+
+    def __init__(self, rate, burst):
+        self.rate = float(rate)
+        self.burst = burst
+        self.tokens = burst
+        self.updated = time.time()
+        self._lock = threading.Lock()
+
+    def _refill(self):
+        now = time.time()
+        self.tokens = min(self.burst, self.tokens + (now - self.updated) * self.rate)
+        self.updated = now
+
+    def take(self):
+        """Takes a token if there is one, and returns 0.  Otherwise returns
+        how many seconds until there will be one."""
+        with self._lock:
+            self._refill()
+            if self.tokens >= 1:
+                self.tokens -= 1
+                return 0
+            return (1 - self.tokens) / self.rate
+
+    def pause(self, seconds):
+        """Hands out no tokens for the next `seconds`."""
+        with self._lock:
+            self._refill()
+            self.tokens = min(self.tokens, 0) - seconds * self.rate
+
+
+class UrlShortener:
+    """Shortens urls on a background thread, no faster than `rate` per
+    second, and remembers the short urls in the JSON file `filename` (if
+    given).
+
+    `shorten` is called with a long url, and returns the short one or raises
+    RateLimited.  shorten() never waits for more than `timeout` seconds, and
+    gives back the long url if it has to give up.
+    """
+
+    # How long to back off for when we're told we're being rate limited
+    RATE_LIMIT_PAUSE = 30
+
+    def __init__(self, shorten, filename=None, rate=1.0, burst=5, timeout=5):
+        self._shorten = shorten
+        self.filename = filename
+        self.timeout = timeout
+        self.bucket = TokenBucket(rate, burst)
+        # long url -> short url
+        self.urls = {}
+        # Urls waiting for the background thread
+        self.pending = set()
+        self._queue = Queue()
+        self._cond = threading.Condition()
+        self._thread = None
+
+    def load(self):
+        if not self.filename or not os.path.exists(self.filename):
+            return
+        try:
+            self.urls = json.load(open(self.filename))
+        except KeyboardInterrupt:
+            raise
+        except:
+            log.exception("Couldn't load short urls from %s", self.filename)
+            self.urls = {}
+
+    def save(self):
+        if not self.filename:
+            return
+        with self._cond:
+            urls = dict(self.urls)
+        tmp = self.filename + ".tmp"
+        json.dump(urls, open(tmp, "w"), separators=(',', ':'))
+        os.rename(tmp, self.filename)
+
+    def prefetch(self, urls):
+        """Starts shortening `urls` in the background."""
+        with self._cond:
+            for url in urls:
+                if url not in self.urls and url not in self.pending:
+                    self.pending.add(url)
+                    self._queue.put(url)
+            if self.pending and not self._thread:
+                self._thread = threading.Thread(target=self._work)
+                self._thread.daemon = True
+                self._thread.start()
+
+    def shorten(self, url, timeout=None):
+        """Returns the short version of `url`, or `url` itself if it can't be
+        had within `timeout` seconds."""
+        if timeout is None:
+            timeout = self.timeout
+        deadline = time.time() + timeout
+        self.prefetch([url])
+        with self._cond:
+            while url not in self.urls and url in self.pending:
+                remaining = deadline - time.time()
+                if remaining <= 0:
+                    log.debug("Gave up waiting for a short url for %s", url)
+                    break
+                self._cond.wait(remaining)
+            return self.urls.get(url, url)
+
+    def _work(self):
+        while True:
+            url = self._queue.get()
+            wait = self.bucket.take()
+            while wait:
+                time.sleep(wait)
+                wait = self.bucket.take()
+
+            try:
+                short_url = self._shorten(url)
+            except RateLimited:
+                log.debug("Rate limited, waiting %is", self.RATE_LIMIT_PAUSE)
+                self.bucket.pause(self.RATE_LIMIT_PAUSE)
+                self._queue.put(url)
+                continue
+            except:
+                log.exception("Unable to shorten url %s", url)
+                short_url = None
+
+            with self._cond:
+                if short_url:
+                    self.urls[url] = short_url
+                self.pending.discard(url)
+                self._cond.notify_all()
@@ -0,0 +1,146 @@
+# This Source Code Form is subject to the terms of the Mozilla Public
+# License, v. 2.0. If a copy of the MPL was not distributed with this file,
+# You can obtain one at http://mozilla.org/MPL/2.0/.
+import os, time
+import email.utils
+from email.mime.text import MIMEText
+from smtplib import SMTP, SMTPServerDisconnected
+import logging as log
+try:
+    import simplejson as json
+except ImportError:
+    import json
+
+
+class Outbox:
+    """Collects the emails sent during a run, so that they can all be
+    delivered over one SMTP connection once the run is done.
+
+    Messages with the same sender, subject, body and headers are merged into
+    one message to all of their recipients.  If `spool_dir` is given, each
+    message is written there as soon as it's added, and only removed once
+    it's been delivered, so messages from a run that died are delivered by
+    the next one.  While a message is being sent its spool file is renamed to
+    .sending.  If a run dies while sending, the next run can't tell whether
+    the message went out.  So rather than risk sending it twice, it logs a
+    warning and renames the file to .unconfirmed for someone to look at.
+    """
+
+    def __init__(self, spool_dir=None, host='localhost', port=25):
+        self.spool_dir = spool_dir
+        self.host = host
+        self.port = port
+        # Messages added since we started, by Message-ID
+        self.messages = {}
+
+    def _filename(self, message, ext=".json"):
+        # Message-IDs look like <...@host>
+        return os.path.join(self.spool_dir, message['id'].strip("<>") + ext)
+
+    def _spool(self, message):
+        if not os.path.exists(self.spool_dir):
+            os.makedirs(self.spool_dir)
+        fn = self._filename(message)
+        json.dump(message, open(fn + ".tmp", "w"))
+        os.rename(fn + ".tmp", fn)
+
+    def add(self, fromaddr, subject, msg, addrs, headers={}):
+        for message in self.messages.values():
+            if (message['from'], message['subject'], message['body'], message['headers']) == \
+                    (fromaddr, subject, msg, headers):
+                message['to'].extend(a for a in addrs if a not in message['to'])
+                break
+        else:
+            message = {
+                'id': email.utils.make_msgid('phanalyzer'),
+                'date': time.time(),
+                'from': fromaddr,
+                'to': list(addrs),
+                'subject': subject,
+                'body': msg,
+                'headers': dict(headers),
+                }
+            self.messages[message['id']] = message
+
+        if self.spool_dir:
+            self._spool(message)
+
+    def pending(self):
+        """Returns the messages waiting to be delivered, oldest first."""
+        messages = dict(self.messages)
+        if self.spool_dir and os.path.exists(self.spool_dir):
+            for fn in os.listdir(self.spool_dir):
+                if fn.endswith(".sending"):
+                    path = os.path.join(self.spool_dir, fn)
+                    log.warning("A run died while sending %s, which may or may not have "
+                                "gone out; not sending it again", path)
+                    os.rename(path, path[:-len(".sending")] + ".unconfirmed")
+                    continue
+                if not fn.endswith(".json"):
+                    continue
+                try:
+                    message = json.load(open(os.path.join(self.spool_dir, fn)))
+                except:
+                    log.exception("Couldn't load spooled message %s", fn)
+                    continue
+                messages.setdefault(message['id'], message)
+        return sorted(messages.values(), key=lambda m: (m['date'], m['id']))
+
+    def format(self, message):
+        # Convert to ascii
+        m = MIMEText(message['body'].encode('ascii', 'replace'), "plain", "ascii")
+        m['Date'] = email.utils.formatdate(message['date'])
+        m['Message-ID'] = message['id']
+        m['To'] = ", ".join(message['to'])
+        m['Subject'] = message['subject']
+        for k, v in message['headers'].items():
+            m[k] = v
+        return m.as_string()
+
+    def _remove(self, message):
+        self.messages.pop(message['id'], None)
+        if self.spool_dir:
+            for ext in (".json", ".sending"):
+                if os.path.exists(self._filename(message, ext)):
+                    os.unlink(self._filename(message, ext))
+
+    def _send(self, s, message):
+        """Sends `message` over the connection `s`, marking it as being sent
+        in the spool until it's known whether it went out."""
+        spooled = self.spool_dir and os.path.exists(self._filename(message))
+        if spooled:
+            os.rename(self._filename(message), self._filename(message, ".sending"))
+        try:
+            s.sendmail(message['from'], message['to'], self.format(message))
+        except:
+            # It was refused or never got there, so it can be sent again
+            if spooled:
+                os.rename(self._filename(message, ".sending"), self._filename(message))
+            raise
+        self._remove(message)
+
+    def deliver(self):
+        """Sends all the pending messages over one connection.  Messages that
+        couldn't be sent are left in the spool."""
+        messages = self.pending()
+        if not messages:
+            return
+
+        log.info("Sending %i messages", len(messages))
+        s = None
+        try:
+            for message in messages:
+                if s is None:
+                    s = SMTP(self.host, self.port)
+                try:
+                    self._send(s, message)
+                except SMTPServerDisconnected:
+                    # Try again on a new connection
+                    s = SMTP(self.host, self.port)
+                    self._send(s, message)
+        finally:
+            if s is not None:
+                try:
+                    s.quit()
+                except SMTPServerDisconnected:
+                    pass
@@ -0,0 +1,422 @@
+# This Source Code Form is subject to the terms of the Mozilla Public
+# License, v. 2.0. If a copy of the MPL was not distributed with this file,
+# You can obtain one at http://mozilla.org/MPL/2.0/.
+import os, time
+import sqlite3
+from multiprocessing.pool import ThreadPool
+import logging as log
+try:
+    import simplejson as json
+except ImportError:
+    import json
+
+from analyze_http import ConnectionPool, HTTPError
+
+# How many changesets to ask the push log about per request, and how many
+# requests to have going at once
+PUSHLOG_CHUNK_SIZE = 50
+PUSHLOG_THREADS = 8
+
+# How long to remember that a changeset isn't in the push log
+PUSHLOG_MISSING_TTL = 7*24*3600
+
+# How many values to put in one "IN (...)" clause; SQLite allows 999
+# parameters per statement
+QUERY_CHUNK_SIZE = 500
+
+SCHEMA = """
+CREATE TABLE IF NOT EXISTS changesets (
+    branch TEXT NOT NULL,
+    shortrev TEXT NOT NULL,
+    push_id INTEGER,
+    position INTEGER,
+    date INTEGER,
+    pusher TEXT,
+    author TEXT,
+    comments TEXT,
+    PRIMARY KEY (branch, shortrev)
+);
+CREATE INDEX IF NOT EXISTS changesets_push_id ON changesets (branch, push_id);
+
+CREATE TABLE IF NOT EXISTS missing (
+    branch TEXT NOT NULL,
+    shortrev TEXT NOT NULL,
+    checked INTEGER NOT NULL,
+    PRIMARY KEY (branch, shortrev)
+);
+
+CREATE TABLE IF NOT EXISTS ranges (
+    branch TEXT NOT NULL,
+    from_rev TEXT NOT NULL,
+    to_rev TEXT NOT NULL,
+    first_push INTEGER,
+    last_push INTEGER,
+    PRIMARY KEY (branch, from_rev, to_rev)
+);
+"""
+
+CHANGESET_FIELDS = ('push_id', 'position', 'date', 'pusher', 'author', 'comments')
+
+
+class PushLog:
+    """Cache of what we've learned from the push logs.
+
+    Everything is kept in an SQLite database indexed by branch and short
+    revision, and by push id.  Nothing is read until it's asked for, and
+    what's learned during a run is held in memory and only written out by
+    save(), so worker processes can use a PushLog without writing to the
+    database.
+    """
+
+    def __init__(self, filename, base_url):
+        # Older versions kept everything in one big JSON file, which load()
+        # imports into a new database next to it
+        self.json_filename = None
+        if filename:
+            root, ext = os.path.splitext(filename)
+            if ext == ".json":
+                filename = root + ".sqlite"
+            for candidate in (root + ".json",
+                              os.path.join(os.path.dirname(filename), "pushlog.json")):
+                if os.path.exists(candidate):
+                    self.json_filename = candidate
+                    break
+        self.filename = filename
+        self.base_url = base_url
+        self.http = ConnectionPool(timeout=60)
+        self._db = None
+        self._pid = None
+        # What's been learned since the last save; branch -> shortrev ->
+        # changeset info, branch -> shortrev -> time, and (branch, from_rev,
+        # to_rev) -> (first_push, last_push)
+        self.new = {}
+        self.new_missing = {}
+        self.new_ranges = {}
+
+    @property
+    def db(self):
+        # Forked processes can't share the parent's connection
+        if self._pid != os.getpid():
+            self._db = sqlite3.connect(self.filename or ":memory:")
+            self._db.row_factory = sqlite3.Row
+            self._db.executescript(SCHEMA)
+            self._pid = os.getpid()
+        return self._db
+
+    def load(self):
+        if not self.json_filename or not os.path.exists(self.json_filename):
+            return
+        if self.db.execute("SELECT 1 FROM changesets LIMIT 1").fetchone():
+            return
+
+        log.info("Importing push dates from %s into %s", self.json_filename, self.filename)
+        try:
+            pushes = json.load(open(self.json_filename))
+        except:
+            log.exception("Couldn't load push dates from %s", self.json_filename)
+            return
+
+        for branch, changes in pushes.items():
+            for shortrev, change in changes.items():
+                if shortrev == "missing":
+                    self.new_missing.setdefault(branch, {}).update(change)
+                elif shortrev != "ranges":
+                    self.new.setdefault(branch, {})[shortrev] = change
+        self.save()
+
+    def save(self):
+        db = self.db
+        for branch, changes in self.new.items():
+            db.executemany("INSERT OR REPLACE INTO changesets VALUES (?, ?, ?, ?, ?, ?, ?, ?)",
+                    [(branch, shortrev) + tuple(change.get(f) for f in CHANGESET_FIELDS)
+                     for shortrev, change in changes.items()])
+        for branch, missing in self.new_missing.items():
+            db.executemany("INSERT OR REPLACE INTO missing VALUES (?, ?, ?)",
+                    [(branch, shortrev, checked) for shortrev, checked in missing.items()])
+        db.executemany("INSERT OR REPLACE INTO ranges VALUES (?, ?, ?, ?, ?)",
+                [key + value for key, value in self.new_ranges.items()])
+        db.commit()
+        self.new = {}
+        self.new_missing = {}
+        self.new_ranges = {}
+
+    def _query(self, sql, branch, shortrevs):
+        """Runs `sql` with "?" for the branch and "%s" for a list of short
+        revisions, for all of `shortrevs`."""
+        shortrevs = list(shortrevs)
+        for i in range(0, len(shortrevs), QUERY_CHUNK_SIZE):
+            chunk = shortrevs[i:i+QUERY_CHUNK_SIZE]
+            for row in self.db.execute(sql % ", ".join("?" * len(chunk)), [branch] + chunk):
+                yield row
+
+    def _lookup(self, branch, shortrevs):
+        """Returns the changeset info for `shortrevs` we know about, keyed by
+        short revision."""
+        new = self.new.get(branch, {})
+        retval = dict((r, new[r]) for r in shortrevs if r in new)
+        sql = "SELECT * FROM changesets WHERE branch = ? AND shortrev IN (%s)"
+        for row in self._query(sql, branch, [r for r in shortrevs if r not in new]):
+            retval[row['shortrev']] = dict((f, row[f]) for f in CHANGESET_FIELDS)
+        return retval
+
+    def _missing(self, branch, shortrevs, since):
+        """Returns which of `shortrevs` were found to be missing from the push
+        log after `since`."""
+        new = self.new_missing.get(branch, {})
+        retval = set(r for r in shortrevs if new.get(r, 0) > since)
+        sql = "SELECT shortrev FROM missing WHERE branch = ? AND checked > %f AND shortrev IN (%%s)" % since
+        for row in self._query(sql, branch, [r for r in shortrevs if r not in retval]):
+            retval.add(row['shortrev'])
+        return retval
+
+    def _handleJson(self, branch, data):
+        if isinstance(data, dict):
+            new = self.new.setdefault(branch, {})
+            for push_id, push in data.items():
+                pusher = push['user']
+                for position, change in enumerate(push['changesets']):
+                    shortrev = change["node"][:12]
+                    new[shortrev] = {
+                            "push_id": int(push_id),
+                            "position": position,
+                            "date": push['date'],
+                            "comments": change['desc'],
+                            "author": change['author'],
+                            "pusher": pusher,
+                            }
+
+    def _fetchChangesets(self, repo_path, chunk):
+        """Returns (data, missing) for the changesets in `chunk`, where `data`
+        is a list of json-pushes results and `missing` the changesets the push
+        log doesn't know about.
+
+        The push log rejects the whole request if any one changeset is
+        unknown, so rejected chunks are split up until the unknown ones are
+        found.  Chunks that couldn't be fetched for other reasons are left out
+        of both.
+        """
+        changesets = ["changeset=%s" % c for c in chunk]
+        url = "%s/%s/json-pushes?full=1&%s" % (self.base_url, repo_path, "&".join(changesets))
+        try:
+            return [json.loads(self.http.get(url))], []
+        except HTTPError, e:
+            if e.code >= 500:
+                log.error("Error fetching %s: %s", url, e)
+                return [], []
+            if len(chunk) == 1:
+                return [], chunk
+        except KeyboardInterrupt:
+            raise
+        except:
+            log.exception("Error fetching %s", url)
+            return [], []
+
+        half = len(chunk) / 2
+        data, missing = self._fetchChangesets(repo_path, chunk[:half])
+        more_data, more_missing = self._fetchChangesets(repo_path, chunk[half:])
+        return data + more_data, missing + more_missing
+
+    def getPushDates(self, branch, repo_path, changesets):
+        retval = {}
+        now = time.time()
+
+        # Pad with zeros to work around bug where revisions with leading
+        # zeros have it stripped
+        changesets = [c.zfill(12) for c in changesets]
+        known = self._lookup(branch, set(c[:12] for c in changesets))
+        missing = self._missing(branch, set(c[:12] for c in changesets
+                                            if c[:12] not in known),
+                                now - PUSHLOG_MISSING_TTL)
+
+        to_query = []
+        for c in changesets:
+            shortrev = c[:12]
+            if shortrev in known:
+                retval[c] = known[shortrev]['date']
+            elif shortrev not in missing:
+                to_query.append(c)
+
+        if len(to_query) > 0:
+            log.debug("Fetching %i changesets", len(to_query))
+            chunks = [to_query[i:i+PUSHLOG_CHUNK_SIZE]
+                      for i in range(0, len(to_query), PUSHLOG_CHUNK_SIZE)]
+            fetch = lambda chunk: self._fetchChangesets(repo_path, chunk)
+            if len(chunks) > 1:
+                pool = ThreadPool(min(PUSHLOG_THREADS, len(chunks)))
+                try:
+                    results = pool.map(fetch, chunks)
+                finally:
+                    pool.terminate()
+            else:
+                results = map(fetch, chunks)
+
+            for data, not_found in results:
+                for d in data:
+                    self._handleJson(branch, d)
+                for c in not_found:
+                    log.debug("%s not found in push log", c[:12])
+                    self.new_missing.setdefault(branch, {})[c[:12]] = now
+
+            new = self.new.get(branch, {})
+            for c in to_query:
+                shortrev = c[:12]
+                try:
+                    retval[c] = new[shortrev]['date']
+                except KeyError:
+                    log.debug("%s not found in push data", shortrev)
+                    continue
+        return retval
+
+    def _pushRange(self, branch, first_push, last_push):
+        """Returns the short revisions pushed to `branch` in pushes
+        `first_push` through `last_push`, in push order."""
+        changes = {}
+        for row in self.db.execute("""SELECT shortrev, push_id, position FROM changesets
+                WHERE branch = ? AND push_id BETWEEN ? AND ?""", (branch, first_push, last_push)):
+            changes[row['shortrev']] = (row['push_id'], row['position'])
+        for shortrev, change in self.new.get(branch, {}).items():
+            if change.get('push_id') is not None and first_push <= change['push_id'] <= last_push:
+                changes[shortrev] = (change['push_id'], change['position'])
+        return sorted(changes, key=changes.get)
+
+    def _cachedRange(self, branch, from_, to_):
+        key = (branch, from_, to_)
+        if key in self.new_ranges:
+            return self.new_ranges[key]
+        row = self.db.execute("""SELECT first_push, last_push FROM ranges
+                WHERE branch = ? AND from_rev = ? AND to_rev = ?""", key).fetchone()
+        if row:
+            return row['first_push'], row['last_push']
+        return None
+
+    def _presentPushes(self, branch, first_push, last_push):
+        """Returns the ids of the pushes from `first_push` through `last_push`
+        that we have changesets for."""
+        retval = set(row[0] for row in self.db.execute("""SELECT DISTINCT push_id FROM changesets
+                WHERE branch = ? AND push_id BETWEEN ? AND ?""", (branch, first_push, last_push)))
+        for change in self.new.get(branch, {}).values():
+            if change.get('push_id') is not None and first_push <= change['push_id'] <= last_push:
+                retval.add(change['push_id'])
+        return retval
+
+    def _fetchPushes(self, repo_path, first_push, last_push):
+        """Returns the json-pushes result for pushes `first_push` through
+        `last_push`, or None if it couldn't be fetched."""
+        url = "%s/%s/json-pushes?full=1&startID=%i&endID=%i" % (self.base_url, repo_path, first_push - 1, last_push)
+        try:
+            return json.loads(self.http.get(url))
+        except KeyboardInterrupt:
+            raise
+        except:
+            log.exception("couldn't fetch %s", url)
+            return None
+
+    def prefetchRanges(self, branch, repo_path, ranges):
+        """Makes sure the pushes for each (from_, to_) in `ranges` are cached,
+        so that getPushRange can answer from the cache.
+
+        Only the pushes we don't have yet are fetched, by push id, with
+        overlapping ranges sharing the requests for the pushes they have in
+        common.
+        """
+        revs = set(r for pair in ranges for r in pair if r)
+        self.getPushDates(branch, repo_path, revs)
+        known = self._lookup(branch, set(r.zfill(12)[:12] for r in revs))
+
+        push_ranges = {}
+        for from_, to_ in ranges:
+            if not from_ or not to_:
+                continue
+            from_change = known.get(from_.zfill(12)[:12])
+            to_change = known.get(to_.zfill(12)[:12])
+            if not from_change or not to_change or \
+                    from_change.get('push_id') is None or to_change.get('push_id') is None:
+                continue
+            push_ranges[(branch, from_, to_)] = (from_change['push_id'] + 1, to_change['push_id'])
+        if not push_ranges:
+            return
+
+        wanted = set()
+        for first_push, last_push in push_ranges.values():
+            wanted.update(range(first_push, last_push + 1))
+        missing = sorted(wanted - self._presentPushes(branch, min(wanted or [0]), max(wanted or [0])))
+
+        gaps = []
+        for push_id in missing:
+            if gaps and gaps[-1][1] == push_id - 1:
+                gaps[-1][1] = push_id
+            else:
+                gaps.append([push_id, push_id])
+
+        if gaps:
+            log.debug("Fetching %i pushes in %i requests", len(missing), len(gaps))
+            fetch = lambda gap: self._fetchPushes(repo_path, *gap)
+            if len(gaps) > 1:
+                pool = ThreadPool(min(PUSHLOG_THREADS, len(gaps)))
+                try:
+                    results = pool.map(fetch, gaps)
+                finally:
+                    pool.terminate()
+            else:
+                results = map(fetch, gaps)
+
+            failed = []
+            for gap, data in zip(gaps, results):
+                if data is None:
+                    failed.append(gap)
+                else:
+                    self._handleJson(branch, data)
+        else:
+            failed = []
+
+        for key, (first_push, last_push) in push_ranges.items():
+            if not [gap for gap in failed if gap[0] <= last_push and gap[1] >= first_push]:
+                self.new_ranges[key] = (first_push, last_push)
+
+    def getPushRange(self, branch, repo_path, from_, to_):
+        cached = self._cachedRange(branch, from_, to_)
+        if not cached:
+            self.prefetchRanges(branch, repo_path, [(from_, to_)])
+            cached = self._cachedRange(branch, from_, to_)
+        if cached:
+            if cached[0] is None:
+                return []
+            return self._pushRange(branch, *cached)
+
+        # We don't know where the ends of the range were pushed, so let the
+        # push log work it out
+        log.debug("Fetching changesets from %s to %s", from_, to_)
+        base_url = self.base_url
+        url = "%s/%s/json-pushes?full=1&fromchange=%s&tochange=%s" % (base_url, repo_path, from_, to_)
+        try:
+            raw_data = self.http.get(url)
+        except KeyboardInterrupt:
+            raise
+        except:
+            log.exception("couldn't fetch %s", url)
+            return []
+
+        try:
+            data = json.loads(raw_data)
+            self._handleJson(branch, data)
+            push_ids = [int(push_id) for push_id in data]
+            if push_ids:
+                self.new_ranges[(branch, from_, to_)] = (min(push_ids), max(push_ids))
+                return self._pushRange(branch, min(push_ids), max(push_ids))
+            self.new_ranges[(branch, from_, to_)] = (None, None)
+            return []
+        except:
+            log.exception("Error parsing %s", raw_data)
+            return []
+
+    def getPushes(self, branch, revs):
+        """Returns the cached push info for `revs`, keyed by short revision."""
+        return self._lookup(branch, set(rev.zfill(12)[:12] for rev in revs if rev))
+
+    def addPushes(self, branch, pushes):
+        """Adds push info returned by getPushes to the cache."""
+        self.new.setdefault(branch, {}).update(pushes)
+
+    def getChange(self, branch, rev):
+        shortrev = rev[:12]
+        return self._lookup(branch, [shortrev])[shortrev]
@@ -2,10 +2,14 @@
 
 from influxdb.influxdb08 import InfluxDBClient
 from analyze import PerfDatum, TalosAnalyzer
+from bisect import bisect_right
+import logging as log
 import json
 import re
 import sys
 import os
+import multiprocessing
+from multiprocessing.pool import ThreadPool
 import requests
 
 ALERT_HOST = os.getenv('ALERT_HOST', 'localhost')
@@ -13,6 +17,21 @@ ALERT_PORT = os.getenv('ALERT_PORT', '3000')
 BRANCH = os.getenv('BRANCH', 'master')
 DEVICE = os.getenv('DEVICE', 'flame-kk')
 MEMORY = os.getenv('MEMORY', '319')
+# Comma-separated lists of devices, branches and memory sizes; every
+# combination of them is analyzed
+DEVICES = os.getenv('DEVICES', DEVICE).split(',')
+BRANCHES = os.getenv('BRANCHES', BRANCH).split(',')
+MEMORIES = os.getenv('MEMORIES', MEMORY).split(',')
+# Post the results for all the combinations in one request, as a list
+BATCH_POST = bool(os.getenv('BATCH_POST'))
+# How many combinations to fetch data for at once
+FETCH_THREADS = int(os.getenv('FETCH_THREADS', '4'))
+# How many apps to analyze at once
+JOBS = int(os.getenv('JOBS', multiprocessing.cpu_count()))
+# JSON file to keep revision info in between runs
+REVINFO_CACHE = os.getenv('REVINFO_CACHE')
+# How far back we look for data, in days
+HISTORY_DAYS = 7
 
 
 RAPTOR_APPS = [ ('Clock', 'clock.gaiamobile.org'),
@@ -29,39 +48,150 @@ RAPTOR_APPS = [ ('Clock', 'clock.gaiamobile.org'),
                 ('Video', 'video.gaiamobile.org') ]
 
 class B2GPerfDatum(PerfDatum):
+    __slots__ = ('gaia_revision',)
 
     def __init__(self, push_timestamp, value, gaia_revision=None, **kwargs):
         PerfDatum.__init__(self, push_timestamp, value, **kwargs)
         self.gaia_revision = gaia_revision
 
-def get_revinfo(client):
-    query = "select time, text from events where device='%s' and branch='%s' and memory='%s' and time > now() - 7d group by time(1000u) order asc;" % (DEVICE, BRANCH, MEMORY)
-    results = client.query(query)
+class RevInfo:
+    """The Gaia and Gecko revisions that were being tested over time, from
+    the events for one device, branch and memory configuration."""
 
-    revinfo = {}
-    for (timestamp, sequence_number, text) in results[0]['points']:
-        (gaia_revision, gecko_revision) = re.match("^Gaia: (.*)<br/>Gecko: (.*)$", text).groups()
-        revinfo[timestamp] = (gaia_revision, gecko_revision)
+    def __init__(self, timestamps=None, revisions=None):
+        # Sorted event times, and the (gaia_revision, gecko_revision) from
+        # each event
+        self.timestamps = timestamps or []
+        self.revisions = revisions or []
 
-    return revinfo
+    def __len__(self):
+        return len(self.timestamps)
 
-def get_alerts(client, revinfo, appname, context):
-    numbers = client.query("select time, percentile(value, 95) from coldlaunch.visuallyLoaded where appName = '%s' and context = '%s' and device='%s' and branch='%s' and memory='%s' and time > now() - 7d group by time(1000u) order asc;" % (appname, context, DEVICE, BRANCH, MEMORY))
+    def last(self):
+        """Returns the time of the newest event, or None."""
+        return self.timestamps[-1] if self.timestamps else None
 
+    def add(self, timestamp, gaia_revision, gecko_revision):
+        i = bisect_right(self.timestamps, timestamp)
+        self.timestamps.insert(i, timestamp)
+        self.revisions.insert(i, (gaia_revision, gecko_revision))
+
+    def prune(self, days=HISTORY_DAYS):
+        """Forgets events more than `days` older than the newest one, except
+        the last of them, which data from the start of the window needs."""
+        if not self.timestamps:
+            return
+        i = bisect_right(self.timestamps, self.timestamps[-1] - days * 86400) - 1
+        if i > 0:
+            del self.timestamps[:i]
+            del self.revisions[:i]
+
+    def lookup(self, timestamp):
+        """Returns the revisions from the last event at or before
+        `timestamp`, or None if there wasn't one."""
+        i = bisect_right(self.timestamps, timestamp)
+        if i == 0:
+            return None
+        return self.revisions[i-1]
+
+    def update(self, client, device, branch, memory):
+        """Fetches the events since the newest one we have."""
+        if self.timestamps:
+            since = "%is" % self.last()
+        else:
+            since = "now() - %id" % HISTORY_DAYS
+        query = "select time, text from events where device='%s' and branch='%s' and memory='%s' and time > %s group by time(1000u) order asc;" % (device, branch, memory, since)
+        results = client.query(query)
+
+        new = 0
+        for series in results:
+            for (timestamp, sequence_number, text) in series['points']:
+                if self.timestamps and timestamp <= self.last():
+                    continue
+                (gaia_revision, gecko_revision) = re.match("^Gaia: (.*)<br/>Gecko: (.*)$", text).groups()
+                self.add(timestamp, gaia_revision, gecko_revision)
+                new += 1
+        log.debug("%i new events for %s/%s/%s", new, device, branch, memory)
+        self.prune()
+
+class RevInfoCache:
+    """RevInfo for each device, branch and memory configuration, kept in
+    the JSON file `filename` between runs (if given)."""
+
+    def __init__(self, filename=None):
+        self.filename = filename
+        # "device/branch/memory" -> RevInfo
+        self.configs = {}
+
+    def load(self):
+        if not self.filename or not os.path.exists(self.filename):
+            return
+        try:
+            configs = json.load(open(self.filename))
+            self.configs = dict((key, RevInfo(c['timestamps'], [tuple(r) for r in c['revisions']]))
+                                for key, c in configs.items())
+        except KeyboardInterrupt:
+            raise
+        except:
+            log.exception("Couldn't load revision info from %s", self.filename)
+            self.configs = {}
+
+    def save(self):
+        if not self.filename:
+            return
+        configs = dict((key, {'timestamps': r.timestamps, 'revisions': r.revisions})
+                       for key, r in self.configs.items())
+        tmp = self.filename + ".tmp"
+        json.dump(configs, open(tmp, "w"), separators=(',', ':'))
+        os.rename(tmp, self.filename)
+
+    def get(self, client, device, branch, memory):
+        """Returns the up to date RevInfo for the configuration."""
+        key = "%s/%s/%s" % (device, branch, memory)
+        revinfo = self.configs.setdefault(key, RevInfo())
+        revinfo.update(client, device, branch, memory)
+        return revinfo
+
+def get_configs():
+    """Returns the (device, branch, memory) combinations to analyze."""
+    return [(device, branch, memory) for device in DEVICES
+                                     for branch in BRANCHES
+                                     for memory in MEMORIES]
+
+def get_revinfo(client, cache=None, device=DEVICE, branch=BRANCH, memory=MEMORY):
+    if cache is None:
+        cache = RevInfoCache()
+    return cache.get(client, device, branch, memory)
+
+def get_all_points(client, device=DEVICE, branch=BRANCH, memory=MEMORY):
+    """Returns the (timestamp, value) points for every app, keyed by
+    (appname, context), from one query."""
+    results = client.query("select time, percentile(value, 95) from coldlaunch.visuallyLoaded where device='%s' and branch='%s' and memory='%s' and time > now() - %id group by time(1000u), appName, context order asc;" % (device, branch, memory, HISTORY_DAYS))
+
+    points = {}
+    for series in results:
+        columns = series['columns']
+        time_col = columns.index('time')
+        value_col = columns.index('percentile')
+        app_col = columns.index('appName')
+        context_col = columns.index('context')
+        for p in series['points']:
+            points.setdefault((p[app_col], p[context_col]), []).append((p[time_col], p[value_col]))
+
+    for app_points in points.values():
+        app_points.sort()
+    return points
+
+def find_alerts(points, revinfo):
     perf_data = []
-    values = []
     ret = []
 
-    if not numbers:
-        return ret
-
-    for (timestamp, value) in numbers[0]['points']:
-        if not timestamp in revinfo:
+    for (timestamp, value) in points:
+        revisions = revinfo.lookup(timestamp)
+        if revisions is None:
             continue
-        else:
-            gaia_rev = revinfo[timestamp][0]
-            gecko_rev = revinfo[timestamp][1]
-            perf_data.append(B2GPerfDatum(timestamp, value, gaia_revision=gaia_rev, revision=gecko_rev))
+        (gaia_rev, gecko_rev) = revisions
+        perf_data.append(B2GPerfDatum(timestamp, value, gaia_revision=gaia_rev, revision=gecko_rev))
 
     ta = TalosAnalyzer()
     ta.addData(perf_data)
@@ -80,6 +210,87 @@ def get_alerts(client, revinfo, appname, context):
 
     return ret
 
+def _find_alerts(args):
+    return find_alerts(*args)
+
+def get_alerts(client, revinfo, appname, context, device=DEVICE, branch=BRANCH, memory=MEMORY):
+    numbers = client.query("select time, percentile(value, 95) from coldlaunch.visuallyLoaded where appName = '%s' and context = '%s' and device='%s' and branch='%s' and memory='%s' and time > now() - %id group by time(1000u) order asc;" % (appname, context, device, branch, memory, HISTORY_DAYS))
+
+    if not numbers:
+        return []
+
+    return find_alerts(numbers[0]['points'], revinfo)
+
+def get_sweep_results(client, configs, apps_to_process, jobs=JOBS,
+                      revinfo_cache=None, fetch_threads=FETCH_THREADS):
+    """Returns a result dict for each (device, branch, memory) in
+    `configs`, with the alerts for each of `apps_to_process`.
+
+    The data for up to `fetch_threads` configurations is fetched at once,
+    then up to `jobs` apps are analyzed in parallel, whichever
+    configuration they're from.  A configuration whose data can't be
+    fetched gets no results and an 'error'.
+    """
+    if revinfo_cache is None:
+        revinfo_cache = RevInfoCache()
+
+    def fetch(config):
+        (device, branch, memory) = config
+        try:
+            return (get_revinfo(client, revinfo_cache, device, branch, memory),
+                    get_all_points(client, device, branch, memory))
+        except Exception, e:
+            log.exception("Couldn't fetch data for %s/%s/%s", device, branch, memory)
+            return e
+
+    if fetch_threads > 1 and len(configs) > 1:
+        pool = ThreadPool(min(fetch_threads, len(configs)))
+        try:
+            fetched = pool.map(fetch, configs)
+        finally:
+            pool.terminate()
+    else:
+        fetched = [fetch(config) for config in configs]
+
+    todo = []
+    for (i, f) in enumerate(fetched):
+        if isinstance(f, Exception):
+            continue
+        (revinfo, points) = f
+        for app_to_process in apps_to_process:
+            for (appname, context) in RAPTOR_APPS:
+                if re.sub('[ -]', '', appname.lower()) == app_to_process:
+                    todo.append((i, app_to_process, (points.get((appname, context), []), revinfo)))
+
+    if jobs > 1 and len(todo) > 1:
+        pool = multiprocessing.Pool(min(jobs, len(todo)))
+        try:
+            alerts = pool.map(_find_alerts, [args for (i, app, args) in todo])
+            pool.close()
+        finally:
+            pool.terminate()
+            pool.join()
+    else:
+        alerts = [_find_alerts(args) for (i, app, args) in todo]
+
+    results = [{ 'branch': branch,
+                 'device': device,
+                 'memory': memory,
+                 'results': {} } for (device, branch, memory) in configs]
+    for (result, f) in zip(results, fetched):
+        if isinstance(f, Exception):
+            result['error'] = str(f)
+    for ((i, app, args), app_alerts) in zip(todo, alerts):
+        results[i]['results'][app] = app_alerts
+    return results
+
+def get_results(client, apps_to_process, jobs=JOBS, revinfo_cache=None,
+                device=DEVICE, branch=BRANCH, memory=MEMORY):
+    """Returns the alerts for each of `apps_to_process`, fetching the data
+    for all of them at once and analyzing up to `jobs` apps in parallel."""
+    return get_sweep_results(client, [(device, branch, memory)], apps_to_process,
+                             jobs, revinfo_cache)[0]['results']
+
 def cli():
     if len(sys.argv) < 4:
         print "USAGE: %s <host> <username> <password> [APP1] [APP2] ..." % sys.argv[0]
@@ -92,29 +303,37 @@ def cli():
     if not apps_to_process:
         apps_to_process = all_raptor_apps
 
-    client = InfluxDBClient(host, 8086, username, password, 'raptor')
-    revinfo = get_revinfo(client)
-
-    resultdict = ({
-        'branch': BRANCH,
-        'device': DEVICE,
-        'memory': MEMORY,
-        'results': {}
-    })
     for app_to_process in apps_to_process:
         if app_to_process not in all_raptor_apps:
             print "ERROR: App %s does not exist?!" % app_to_process
             sys.exit(1)
-        for (appname, context) in RAPTOR_APPS:
-            if re.sub('[ -]', '', appname.lower()) == app_to_process:
-                resultdict['results'][app_to_process] = get_alerts(client, revinfo, appname, context)
+
+    client = InfluxDBClient(host, 8086, username, password, 'raptor')
+    revinfo_cache = RevInfoCache(REVINFO_CACHE)
+    revinfo_cache.load()
+
+    results = get_sweep_results(client, get_configs(), apps_to_process,
+                                revinfo_cache=revinfo_cache)
+    revinfo_cache.save()
+    # Don't post empty results for configurations we know nothing about
+    results = [r for r in results if 'error' not in r]
+    if not results:
+        print "ERROR: Couldn't fetch data for any configuration"
+        sys.exit(1)
 
     url = 'http://%s:%s/' % (ALERT_HOST, ALERT_PORT)
     headers = {'Content-Type': 'application/json'}
-    req = requests.post(url, data=json.dumps(resultdict), headers=headers)
+    if BATCH_POST:
+        payloads = [results]
+    else:
+        payloads = results
+    # One connection for all the posts
+    session = requests.Session()
+    for payload in payloads:
+        req = session.post(url, data=json.dumps(payload), headers=headers)
 
-    print req.status_code
-    print req.content
+        print req.status_code
+        print req.content
 
 if __name__ == "__main__":
     cli()
@@ -0,0 +1,87 @@
+# This Source Code Form is subject to the terms of the Mozilla Public
+# License, v. 2.0. If a copy of the MPL was not distributed with this file,
+# You can obtain one at http://mozilla.org/MPL/2.0/.
+import re
+
+
+class PatternRule:
+    """Matches names against a list of regexps, like calling re.search with
+    each of them, but with one compiled regexp and remembering the answer for
+    each name."""
+
+    def __init__(self, patterns, flags=0):
+        self.patterns = list(patterns)
+        if self.patterns:
+            self.regexp = re.compile("|".join("(?:%s)" % p for p in self.patterns), flags)
+        else:
+            self.regexp = None
+        self._matches = {}
+
+    def __call__(self, name):
+        try:
+            return self._matches[name]
+        except KeyError:
+            match = self.regexp is not None and self.regexp.search(name) is not None
+            self._matches[name] = match
+            return match
+
+
+def split_patterns(value, keep_empty=False):
+    retval = []
+    for i in value.split(','):
+        i = i.strip()
+        if i or keep_empty:
+            retval.append(i)
+    return retval
+
+
+class ConfigRules:
+    """The test name rules from an analysis config, worked out once.
+
+    `match_options` are the [main] options holding comma-separated regexps
+    that test names or subjects are checked against case-insensitively.
+    """
+
+    match_options = ('ignore_percentage_tests', 'high_percentage_tests',
+                     'reverse_tests', 'suppress_email_subjects')
+
+    def __init__(self, config):
+        self.config = config
+        self.options = {}
+        for option in self.match_options:
+            patterns = []
+            if config.has_option('main', option):
+                # An empty pattern matches everything, as it always has
+                patterns = split_patterns(config.get('main', option), keep_empty=True)
+            self.options[option] = PatternRule(patterns, re.I)
+
+        self.os_names = {}
+        if config.has_section('os'):
+            for os_name in config.options('os'):
+                self.os_names[os_name] = config.get('os', os_name)
+
+        self.dashboard_tests = set()
+        if config.has_option('dashboard', 'tests'):
+            for t in re.split(r"(?<!\\),", config.get("dashboard", "tests")):
+                self.dashboard_tests.add(t.replace("\\,", ",").strip())
+
+        # branch name -> PatternRule for the tests to skip on that branch
+        self._ignore_tests = {}
+
+    def matches(self, option, name):
+        """Returns whether `name` matches any of the patterns in `option`."""
+        return self.options[option](name)
+
+    def osName(self, os_name):
+        """Returns the friendly name for `os_name`."""
+        return self.os_names.get(self.config.optionxform(os_name), os_name)
+
+    def ignoreTest(self, branch_name, test_name):
+        """Returns whether `test_name` should be skipped on `branch_name`."""
+        if branch_name not in self._ignore_tests:
+            patterns = []
+            for section in ('main', branch_name):
+                if self.config.has_option(section, 'ignore_tests'):
+                    patterns.extend(split_patterns(self.config.get(section, 'ignore_tests')))
+            self._ignore_tests[branch_name] = PatternRule(patterns)
+        return self._ignore_tests[branch_name](test_name)
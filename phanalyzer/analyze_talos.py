@@ -6,16 +6,30 @@ import logging as log
 import cPickle as pickle
 from datetime import datetime
 import email.utils
-from smtplib import SMTP
 from email.mime.multipart import MIMEMultipart
-from email.mime.text import MIMEText
 import shutil
+import multiprocessing
+from multiprocessing.pool import ThreadPool
+from collections import deque
+from itertools import islice
 try:
     import simplejson as json
 except ImportError:
     import json
 
-from analyze import TalosAnalyzer
+from analyze import TalosAnalyzer, StreamingTalosAnalyzer
+from analyze_cache import SeriesCache, SeriesState, BugCache, WarningStore
+from analyze_pushlog import PushLog
+from analyze_http import UrlShortener, RateLimited
+from analyze_mail import Outbox
+from analyze_rules import ConfigRules
+
+# How far back before the newest cached test run to look for runs that were
+# reported late
+LATE_DATA_WINDOW = 24*3600
+
+# How many series to fetch data for in one query, for sources that can
+BULK_FETCH_SIZE = 100
 
 def bz_request(api, path, data=None, method=None, username=None, password=None):
     url = api + path
@@ -40,15 +54,17 @@ def bz_check_request(*args, **kw):
     except urllib2.HTTPError, e:
         assert 200 <= e.code < 300, e
 
-def bz_get_bug(api, bug_num):
+def bz_get_bugs(api, bug_nums):
+    """Returns the bugs in `bug_nums` that could be fetched, keyed by bug
+    number."""
     try:
-        bug = bz_request(api, "/bug/%s" % bug_num)
-        return bug
+        result = bz_request(api, "/bug?id=%s" % ",".join(str(b) for b in bug_nums))
+        return dict((str(bug['id']), bug) for bug in result.get('bugs', []))
     except KeyboardInterrupt:
         raise
     except:
-        log.exception("Error fetching bug %s" % bug_num)
-        return None
+        log.exception("Error fetching bugs %s" % ", ".join(str(b) for b in bug_nums))
+        return {}
 
 def bz_get_bug_comments(api, bug_num):
     try:
@@ -60,7 +76,9 @@ def bz_get_bug_comments(api, bug_num):
         log.exception("Error fetching comments for bug %s" % bug_num)
         return None
 
-def shorten(url, login, apiKey, max_tries=10, sleep_time=30):
+def bitly_shorten(url, login, apiKey):
+    """Asks bit.ly for a short version of `url` once, raising RateLimited if
+    it says we're asking too often."""
     params = {
             'login': login,
             'apiKey': apiKey,
@@ -70,30 +88,14 @@ def shorten(url, login, apiKey, max_tries=10, sleep_time=30):
     params = urllib.urlencode(params)
     api_url = "http://api.bit.ly/v3/shorten?%(params)s" % locals()
 
-    i = 0
-
-    while True:
-        i += 1
-        if i >= max_tries:
-            raise IOError("Too many retries")
-        data = json.load(urllib2.urlopen(api_url, timeout=60))
-        if data['status_code'] == 200:
-            return data['data']['url']
-        elif data['status_code'] == 403:
-            # We're being rate limited
-            time.sleep(sleep_time)
-            continue
-        else:
-            raise ValueError("Unknown error: %s" % data)
-
-def safe_shorten(url, login, apiKey):
-    try:
-        return shorten(url, login, apiKey)
-    except KeyboardInterrupt:
-        raise
-    except:
-        log.exception("Unable to shorten url %s", url)
-        return url
+    data = json.load(urllib2.urlopen(api_url, timeout=60))
+    if data['status_code'] == 200:
+        return data['data']['url']
+    elif data['status_code'] == 403:
+        # We're being rate limited
+        raise RateLimited(data['status_txt'])
+    else:
+        raise ValueError("Unknown error: %s" % data)
 
 def avg(l):
     return sum(l) / float(len(l))
@@ -113,141 +115,6 @@ def bugs_from_comments(comments):
             retval.append(int(m))
     return retval
 
-def send_msg(fromaddr, subject, msg, addrs, headers={}):
-    s = SMTP()
-    s.connect()
-
-    # Convert to ascii
-    msg = msg.encode('ascii', 'replace')
-
-    for addr in addrs:
-        m = MIMEText(msg, "plain", "ascii")
-        m['Date'] = email.utils.formatdate()
-        m['To'] = addr
-        m['Subject'] = subject
-        for k,v in headers.items():
-            m[k] = v
-
-        s.sendmail(fromaddr, [addr], m.as_string())
-    s.quit()
-
-class PushLog:
-    def __init__(self, filename, base_url):
-        self.filename = filename
-        self.base_url = base_url
-        self.pushes = {}
-
-    def load(self):
-        try:
-            if not os.path.exists(self.filename):
-                self.pushes = {}
-                return
-            self.pushes = json.load(open(self.filename))
-        except:
-            log.exception("Couldn't load push dates from %s", self.filename)
-            self.pushes = {}
-
-    def save(self):
-        tmp = self.filename + ".tmp"
-        json.dump(self.pushes, open(tmp, "w"), indent=2, sort_keys=True)
-        os.rename(tmp, self.filename)
-
-    def _handleJson(self, branch, data):
-        if isinstance(data, dict):
-            for push in data.values():
-                pusher = push['user']
-                for change in push['changesets']:
-                    shortrev = change["node"][:12]
-                    self.pushes[branch][shortrev] = {
-                            "date": push['date'],
-                            "comments": change['desc'],
-                            "author": change['author'],
-                            "pusher": pusher,
-                            }
-
-    def getPushDates(self, branch, repo_path, changesets):
-        to_query = []
-        retval = {}
-        if branch not in self.pushes:
-            self.pushes[branch] = {}
-
-        for c in changesets:
-            # Pad with zeros to work around bug where revisions with leading
-            # zeros have it stripped
-            while len(c) < 12:
-                c = "0" + c
-            shortrev = c[:12]
-            if shortrev not in self.pushes[branch]:
-                to_query.append(c)
-            else:
-                retval[c] = self.pushes[branch][shortrev]['date']
-
-        if len(to_query) > 0:
-            log.debug("Fetching %i changesets", len(to_query))
-            for i in range(0, len(to_query), 50):
-                chunk = to_query[i:i+50]
-                changesets = ["changeset=%s" % c for c in chunk]
-                base_url = self.base_url
-                url = "%s/%s/json-pushes?full=1&%s" % (base_url, repo_path, "&".join(changesets))
-                try:
-                    raw_data = urllib2.urlopen(url, timeout=300).read()
-                except:
-                    log.exception("Error fetching %s", url)
-                    continue
-
-                try:
-                    data = json.loads(raw_data)
-                    self._handleJson(branch, data)
-                except:
-                    log.exception("Error parsing %s", raw_data)
-                    raise
-
-                for c in chunk:
-                    shortrev = c[:12]
-                    try:
-                        retval[c] = self.pushes[branch][shortrev]['date']
-                    except KeyError:
-                        log.debug("%s not found in push data", shortrev)
-                        continue
-        return retval
-
-    def getPushRange(self, branch, repo_path, from_, to_):
-        key = "%s-%s" % (from_, to_)
-        if branch not in self.pushes:
-            self.pushes[branch] = {"ranges": {}}
-        elif "ranges" not in self.pushes[branch]:
-            self.pushes[branch]["ranges"] = {}
-        elif key in self.pushes[branch]["ranges"]:
-            return self.pushes[branch]["ranges"][key]
-
-        log.debug("Fetching changesets from %s to %s", from_, to_)
-        base_url = self.base_url
-        url = "%s/%s/json-pushes?full=1&fromchange=%s&tochange=%s" % (base_url, repo_path, from_, to_)
-        try:
-            raw_data = urllib2.urlopen(url, timeout=300).read()
-        except:
-            log.exception("couldn't fetch %s", url)
-            return []
-
-        try:
-            data = json.loads(raw_data)
-            self._handleJson(branch, data)
-            retval = []
-            pushes = data.items()
-            pushes.sort(key=lambda p:p[1]['date'])
-            for push_id, push in pushes:
-                for c in push['changesets']:
-                    retval.append(c['node'][:12])
-            self.pushes[branch]["ranges"][key] = retval
-            return retval
-        except:
-            log.exception("Error parsing %s", raw_data)
-            return []
-
-    def getChange(self, branch, rev):
-        shortrev = rev[:12]
-        return self.pushes[branch][rev]
-
 class AnalysisRunner:
     def __init__(self, options, config, data_type):
         self.options = options
@@ -266,8 +133,11 @@ class AnalysisRunner:
 
         self.loadWarningHistory()
 
+        self.rules = ConfigRules(config)
         self.dashboard_data = {}
-        self.bug_cache = {}
+        # Warnings to print and email once we've seen all the series; see
+        # flushWarnings
+        self.pending_warnings = []
 
         self.fore_window = config.getint('main', 'fore_window')
         self.back_window = config.getint('main', 'back_window')
@@ -275,71 +145,137 @@ class AnalysisRunner:
         self.machine_threshold = config.getfloat('main', 'machine_threshold')
         self.machine_history_size = config.getint('main', 'machine_history_size')
 
+        # How many threads fetch data ahead of the analysis
+        if config.has_option('main', 'fetch_threads'):
+            self.fetch_threads = config.getint('main', 'fetch_threads')
+        else:
+            self.fetch_threads = 0
+        self.fetch_pool = None
+
         # The id of the last test run we've looked at
         self.last_run = 0
         self._source = None
         self._pushlog = None
+        self._series_cache = None
+        self._bugs = None
+        self._shortener = None
+        self._outbox = None
 
     @property
     def pushlog(self):
         if not self._pushlog:
-            self._pushlog = PushLog(config.get('cache', 'pushlog'), config.get('main', 'base_hg_url'))
+            self._pushlog = PushLog(self.config.get('cache', 'pushlog'), self.config.get('main', 'base_hg_url'))
             self._pushlog.load()
         return self._pushlog
 
 
+    @property
+    def bugs(self):
+        if not self._bugs:
+            if self.config.has_option('cache', 'bugs'):
+                filename = self.config.get('cache', 'bugs')
+            else:
+                filename = None
+            api = self.config.get('main', 'bz_api')
+            self._bugs = BugCache(filename, lambda bug_nums: bz_get_bugs(api, bug_nums))
+            self._bugs.load()
+        return self._bugs
+
+    @property
+    def shortener(self):
+        if not self._shortener:
+            login = self.config.get('main', 'bitly_login')
+            apiKey = self.config.get('main', 'bitly_apiKey')
+            if self.config.has_option('cache', 'short_urls'):
+                filename = self.config.get('cache', 'short_urls')
+            else:
+                filename = None
+            kwargs = {}
+            if self.config.has_option('main', 'bitly_rate'):
+                kwargs['rate'] = self.config.getfloat('main', 'bitly_rate')
+            if self.config.has_option('main', 'bitly_timeout'):
+                kwargs['timeout'] = self.config.getfloat('main', 'bitly_timeout')
+            self._shortener = UrlShortener(lambda url: bitly_shorten(url, login, apiKey),
+                                           filename, **kwargs)
+            self._shortener.load()
+        return self._shortener
+
+    @property
+    def outbox(self):
+        if not self._outbox:
+            if self.config.has_option('cache', 'outbox'):
+                spool_dir = self.config.get('cache', 'outbox')
+            else:
+                spool_dir = None
+            kwargs = {}
+            if self.config.has_option('main', 'smtp_host'):
+                kwargs['host'] = self.config.get('main', 'smtp_host')
+            if self.config.has_option('main', 'smtp_port'):
+                kwargs['port'] = self.config.getint('main', 'smtp_port')
+            self._outbox = Outbox(spool_dir, **kwargs)
+        return self._outbox
+
     @property
     def source(self):
         if not self._source:
             import analyze_db as source
-            source.connect(config.get('main', 'dburl'))
+            if self.config.has_option('cache', 'machines'):
+                snapshot = self.config.get('cache', 'machines')
+            else:
+                snapshot = None
+            kwargs = {}
+            for option, arg in (('db_pool_size', 'pool_size'),
+                                ('db_max_overflow', 'max_overflow')):
+                if self.config.has_option('main', option):
+                    kwargs[arg] = self.config.getint('main', option)
+            source.connect(self.config.get('main', 'dburl'), snapshot, **kwargs)
             self._source = source
         return self._source
 
+    @property
+    def series_cache(self):
+        if not self._series_cache and self.config.has_option('cache', 'series_cache'):
+            params = self.newAnalyzer().params()
+            params['data_type'] = self.data_type
+            self._series_cache = SeriesCache(self.config.get('cache', 'series_cache'), params)
+        return self._series_cache
+
+    def newAnalyzer(self):
+        return StreamingTalosAnalyzer(self.back_window, self.fore_window,
+                self.threshold, machine_threshold=self.machine_threshold,
+                machine_history_size=self.machine_history_size)
+
     def loadWarningHistory(self):
         # Stop warning about stuff from a long time ago
         log.debug("Loading warning history")
         fn = self.config.get('cache', 'warning_history')
         cutoff = self.options.start_time
+        # Older versions kept the whole history in one JSON file, which is
+        # imported the first time we run with the log next to it
+        root, ext = os.path.splitext(fn)
+        if ext == ".json":
+            fn = root + ".log"
+        json_fn = None
+        for candidate in (root + ".json",
+                          os.path.join(os.path.dirname(fn), "warning_history.json")):
+            if os.path.exists(candidate):
+                json_fn = candidate
+                break
+
+        self.warning_history = WarningStore(fn)
         try:
-            if not os.path.exists(fn):
-                self.warning_history = {}
-                return
-            self.warning_history = json.load(open(fn))
-            # Purge old warnings
-            for branch, oses in self.warning_history.items():
-                if branch in ('inactive_machines', 'bad_machines'):
-                    continue
-                for os_name, tests in oses.items():
-                    for test_name, values in tests.items():
-                        for d in values[:]:
-                            buildid, timestamp = d
-                            if timestamp < cutoff:
-                                log.debug("Removing warning %s since it's before cutoff (%s)", d, cutoff)
-                                values.remove(d)
-                            else:
-                                # Convert to tuples
-                                values.remove(d)
-                                values.append((buildid, timestamp))
-
-                        if not values:
-                            log.debug("Removing empty warning list %s %s %s", branch, os_name, test_name)
-                            del tests[test_name]
-                    if not tests:
-                        log.debug("Removing empty os list %s %s", branch, os_name)
-                        del oses[os_name]
-                if not oses:
-                    log.debug("Removing empty branch list %s", branch)
-                    del self.warning_history[branch]
+            if json_fn and not os.path.exists(fn):
+                log.info("Importing warnings from %s into %s", json_fn, fn)
+                self.warning_history.importJson(json_fn, cutoff)
+                self.warning_history.compact()
+            else:
+                self.warning_history.load(cutoff)
         except:
             log.exception("Couldn't load warnings from %s", fn)
-            self.warning_history = {}
+            self.warning_history = WarningStore(fn)
 
     def saveWarningHistory(self):
-        fn = self.config.get('cache', 'warning_history')
-        tmp = fn + ".tmp"
-        json.dump(self.warning_history, open(tmp, "w"), indent=2, sort_keys=True)
-        os.rename(tmp, fn)
+        self.warning_history.save()
 
     def updateTimes(self, branch, data):
         # We want to fetch the changesets so we can order the data points by
@@ -355,9 +291,7 @@ class AnalysisRunner:
 
     def shorten(self, url):
         if self.config.has_option('main', 'bitly_login'):
-            login = self.config.get('main', 'bitly_login')
-            apiKey = self.config.get('main', 'bitly_apiKey')
-            return safe_shorten(url, login, apiKey)
+            return self.shortener.shorten(url)
         else:
             return url
 
@@ -388,13 +322,8 @@ class AnalysisRunner:
         return "http://bugzilla.mozilla.org/show_bug.cgi?id=%s" % bug_num
 
     def getBug(self, bug_num):
-        if bug_num in self.bug_cache:
-            return self.bug_cache[bug_num]
-
         if self.config.has_option('main', 'bz_api'):
-            bug = bz_get_bug(self.config.get('main', 'bz_api'), bug_num)
-            self.bug_cache[bug_num] = bug
-            return bug
+            return self.bugs.get(bug_num)
 
     def ignorePercentageForTest(self, test_name):
         return self.testMatchesOption(test_name, 'ignore_percentage_tests')
@@ -409,15 +338,7 @@ class AnalysisRunner:
         return self.testMatchesOption(subject, 'suppress_email_subjects')
 
     def testMatchesOption(self, test_name, option):
-        patterns = []
-        if self.config.has_option('main', option):
-            for i in self.config.get('main', option).split(','):
-                patterns.append(i.strip())
-
-        for text_exp in patterns:
-            if re.search(text_exp, test_name, re.I):
-                return True
-        return False
+        return self.rules.matches(option, test_name)
 
     def isImprovement(self, test_name, old, new):
         old_value = new.historical_stats['avg']
@@ -678,7 +599,7 @@ class AnalysisRunner:
                 headers['References'] = headers['In-Reply-To']
             else:
                 headers = {}
-            send_msg(self.config.get('main', 'from_email'), subject, msg, addresses, headers)
+            self.outbox.add(self.config.get('main', 'from_email'), subject, msg, addresses, headers)
 
     def outputDashboard(self):
         log.debug("Creating dashboard")
@@ -767,22 +688,58 @@ class AnalysisRunner:
 
     def handleData(self, series, d, state, skip, last_good):
         if not skip and state != "good" and not self.options.catchup and last_good is not None:
-            # Notify people of the warnings
+            # Notify people of the warnings once we've seen all the series
+            self.pending_warnings.append((series, d, state, last_good))
+
+    def flushWarnings(self):
+        """Prints and emails the warnings handleData has queued up.
+
+        The bugs mentioned in all of their changesets are fetched together
+        first, rather than one at a time as each message is written, and the
+        emails are all sent at the end.
+        """
+        warnings, self.pending_warnings = self.pending_warnings, []
+        if not warnings:
+            self.deliverMail()
+            return
+
+        if self.config.has_option('main', 'bitly_login'):
+            self.shortener.prefetch([self.makeChartUrl(series, d)
+                                     for series, d, state, last_good in warnings])
+
+        if self.config.has_option('main', 'bz_api'):
+            bug_nums = set()
+            for series, d, state, last_good in warnings:
+                if state == "machine" or not last_good.revision or not d.revision:
+                    continue
+                branch = series.branch_name
+                for rev in self.pushlog.getPushRange(branch, self.config.get(branch, 'repo_path'),
+                                                     from_=last_good.revision, to_=d.revision):
+                    bug_nums.update(bugs_from_comments(self.pushlog.getChange(branch, rev)['comments']))
+            self.bugs.prefetch(bug_nums)
+
+        for series, d, state, last_good in warnings:
             self.printWarning(series, d, state, last_good)
             self.emailWarning(series, d, state, last_good)
+        self.deliverMail()
+
+    def deliverMail(self):
+        try:
+            self.outbox.deliver()
+        except:
+            log.exception("Error sending mail")
+
+    def isDashboardSeries(self, s):
+        return s.test_name in self.rules.dashboard_tests
 
-    def handleDashboardSeries(self, s):
+    def handleDashboardSeries(self, s, data=None):
         # Add it to our dashboard data
         sevenDaysAgo = time.time() - 7*24*60*60
-        importantTests = []
-        for t in re.split(r"(?<!\\),", self.config.get("dashboard", "tests")):
-            t = t.replace("\\,", ",").strip()
-            importantTests.append(t)
-
-        if s.test_name not in importantTests:
+        if not self.isDashboardSeries(s):
             return
 
-        data = self.source.getTestData(s, sevenDaysAgo, self.data_type)
+        if data is None:
+            data = self.source.getTestData(s, sevenDaysAgo, self.data_type)
         if len(data) == 0:
             return
 
@@ -821,41 +778,164 @@ class AnalysisRunner:
             values = [results[i+1] for i in range(0, len(results), 2)]
             _d[machine_name]['stats'] = [avg(values), max(values), min(values)]
 
-    def handleSeries(self, s):
-        if self.config.has_option('os', s.os_name):
-            s.os_name = self.config.get('os', s.os_name)
+    def handleSeries(self, s, data=None):
+        if self.skipSeries(s):
+            return
+
+        log.info("Processing %s %s %s", s.branch_name, s.os_name, s.test_name)
+        results, last_good, last_run = self.analyzeSeries(s, data)
+        self.reportSeries(s, results, last_good, last_run)
+
+    def skipSeries(self, s):
+        """Returns whether `s` should be skipped, after giving its OS its
+        friendly name."""
+        s.os_name = self.rules.osName(s.os_name)
 
         # Check if we should skip this test
-        ignore_tests = []
-        if self.config.has_option('main', 'ignore_tests'):
-            for i in self.config.get('main', 'ignore_tests').split(','):
-                i = i.strip()
-                if i:
-                    ignore_tests.append(i)
-
-        if self.config.has_option(s.branch_name, 'ignore_tests'):
-            for i in self.config.get(s.branch_name, 'ignore_tests').split(','):
-                i = i.strip()
-                if i:
-                    ignore_tests.append(i)
-
-        for i in ignore_tests:
-            if re.search(i, s.test_name):
-                log.debug("Skipping %s %s %s", s.branch_name, s.os_name, s.test_name)
-                return
+        if self.rules.ignoreTest(s.branch_name, s.test_name):
+            log.debug("Skipping %s %s %s", s.branch_name, s.os_name, s.test_name)
+            return True
+        return False
 
-        log.info("Processing %s %s %s", s.branch_name, s.os_name, s.test_name)
+    def analyzeSeries(self, s, data=None, state=None):
+        """Fetches (unless `data` was already fetched, from
+        dataStartTime(state) on) and analyzes the data for `s`.  `state` is
+        the cached state of `s` that came with `data`.
+
+        Returns the analyzed points to report on, the last good point before
+        them (if known) and the highest test run id fetched.  This doesn't
+        touch the warning history or send anything, so it can run in a worker
+        process.
+        """
+        if self.series_cache:
+            return self.analyzeNewData(s, data, state)
+        else:
+            return self.analyzeAllData(s, data)
+
+    def loadState(self, s):
+        """Returns the cached SeriesState for `s`, or None."""
+        if self.series_cache:
+            return self.series_cache.load(s)
+        return None
+
+    def dataStartTime(self, state):
+        """Returns the time that analyzeSeries needs the data for a series
+        with the cached `state` (or None) from."""
+        if state is not None:
+            return max(self.options.start_time, state.last_time - LATE_DATA_WINDOW)
+        return self.options.start_time
+
+    def fetchSeriesData(self, series, start_time=None):
+        """Yields (s, data, state) for each of `series`, in (branch_id,
+        os_id, test_id) order, where `state` is the cached state of `s` that
+        `data` was fetched for.
+
+        If the source can, data is fetched for BULK_FETCH_SIZE series at a
+        time, from `start_time` or each series' dataStartTime.  With a
+        fetch_pool, the fetching happens in its threads, a couple of batches
+        ahead of what's been yielded so far.  Otherwise `data` and `state` may
+        be None, and left for analyzeSeries to load.
+        """
+        series = sorted(series, key=lambda s: (s.branch_id, s.os_id, s.test_id))
+        bulk = hasattr(self.source, 'getTestDataForSeries')
+        if not bulk and not self.fetch_pool:
+            for s in series:
+                yield s, None, None
+            return
+
+        size = BULK_FETCH_SIZE if bulk else 1
+        chunks = (series[i:i+size] for i in range(0, len(series), size))
+        if not self.fetch_pool:
+            for chunk in chunks:
+                for fetched in self.fetchChunk(chunk, start_time):
+                    yield fetched
+            return
 
-        # Get all the test data for all machines running this combination
+        pending = deque(self.fetch_pool.apply_async(self.fetchChunk, (chunk, start_time))
+                        for chunk in islice(chunks, 2 * self.fetch_threads))
+        while pending:
+            fetched = pending.popleft().get()
+            for chunk in islice(chunks, 1):
+                pending.append(self.fetch_pool.apply_async(self.fetchChunk, (chunk, start_time)))
+            for f in fetched:
+                yield f
+
+    def fetchChunk(self, chunk, start_time=None):
+        """Returns a list of (s, data, state) for the series in `chunk`; see
+        fetchSeriesData.
+
+        Series whose data is needed from about the same time are fetched
+        together, so that a series that isn't cached yet doesn't make the
+        whole chunk fetched from --start-time on.
+        """
         t = time.time()
-        data = self.source.getTestData(s, options.start_time, self.data_type)
-        log.debug("%.2f to fetch data", time.time() - t)
+        if start_time is None:
+            states = [self.loadState(s) for s in chunk]
+            starts = [self.dataStartTime(state) for state in states]
+        else:
+            states = [None] * len(chunk)
+            starts = [start_time] * len(chunk)
+
+        # Group the series by start time, starting a new group when one would
+        # fetch more than LATE_DATA_WINDOW of data that isn't needed
+        groups = []
+        for since, s in sorted(zip(starts, chunk), key=lambda (since, s): since):
+            if not groups or since - groups[-1][0] > LATE_DATA_WINDOW:
+                groups.append((since, []))
+            groups[-1][1].append(s)
+
+        fetched = {}
+        for since, group in groups:
+            if hasattr(self.source, 'getTestDataForSeries'):
+                group_data = self.source.getTestDataForSeries(group, since, self.data_type)
+            else:
+                group_data = [(s, self.source.getTestData(s, since, self.data_type)) for s in group]
+            for s, data in group_data:
+                fetched[s.branch_id, s.os_id, s.test_id] = data
+        log.debug("%.2f to fetch data for %i series in %i queries", time.time() - t,
+                  len(chunk), len(groups))
+        return [(s, fetched[s.branch_id, s.os_id, s.test_id], state)
+                for s, state in zip(chunk, states)]
+
+    def reportSeries(self, s, results, last_good, last_run):
+        """Warns about the regressions and machine issues in `results`."""
+        self.updateLastRun(last_run)
+
+        warnings = self.warning_history.series(s.branch_name, s.os_name, s.test_name)
+
+        series_data = self.processSeries(results, warnings, last_good)
+        self.prefetchPushRanges(s, series_data)
+        for d, skip, last_good in series_data:
+            self.handleData(s, d, d.state, skip, last_good)
 
-        if data:
-            m = max(d.testrun_id for d in data)
-            if self.last_run < m:
-                log.debug("Setting last_run to %s", m)
-                self.last_run = m
+        if self.config.has_option('main', 'graph_dir'):
+            if self.series_cache:
+                series_data = [(d, False, None) for d in self.series_cache.loadData(s)]
+            self.outputGraphs(s, series_data)
+
+    def prefetchPushRanges(self, s, series_data):
+        """Fetches the pushes for all the warnings handleData is about to send
+        in one go, rather than a range at a time."""
+        if self.options.catchup:
+            return
+        ranges = [(last_good.revision, d.revision) for d, skip, last_good in series_data
+                  if not skip and d.state != "good" and last_good is not None
+                  and last_good.revision and d.revision]
+        if ranges:
+            self.pushlog.prefetchRanges(s.branch_name,
+                    self.config.get(s.branch_name, 'repo_path'), ranges)
+
+    def updateLastRun(self, last_run):
+        if self.last_run < last_run:
+            log.debug("Setting last_run to %s", last_run)
+            self.last_run = last_run
+
+    def analyzeAllData(self, s, data=None):
+        if data is None:
+            # Get all the test data for all machines running this combination
+            t = time.time()
+            data = self.source.getTestData(s, self.options.start_time, self.data_type)
+            log.debug("%.2f to fetch data", time.time() - t)
 
         self.updateTimes(s.branch_name, data)
 
@@ -866,23 +946,37 @@ class AnalysisRunner:
                 self.threshold, machine_threshold=self.machine_threshold,
                 machine_history_size=self.machine_history_size)
 
-        if s.branch_name not in self.warning_history:
-            self.warning_history[s.branch_name] = {}
-        if s.os_name not in self.warning_history[s.branch_name]:
-            self.warning_history[s.branch_name][s.os_name] = {}
-        if s.test_name not in self.warning_history[s.branch_name][s.os_name]:
-            self.warning_history[s.branch_name][s.os_name][s.test_name] = []
-        warnings = self.warning_history[s.branch_name][s.os_name][s.test_name]
+        return analysis_gen, None, max([d.testrun_id for d in data] or [0])
+
+    def analyzeNewData(self, s, data=None, state=None):
+        """Like analyzeAllData, but only fetches and analyzes the data that's
+        new since the last run, picking up from the cached state of `s`.  If
+        `data` is passed, `state` is the cached state it was fetched for."""
+        if data is None:
+            state = self.loadState(s)
+            t = time.time()
+            data = self.source.getTestData(s, self.dataStartTime(state), self.data_type)
+            log.debug("%.2f to fetch data", time.time() - t)
+        if state is None:
+            state = SeriesState(self.newAnalyzer())
+        data = [d for d in data if d.testrun_id > state.last_run]
+        log.debug("%i new data points", len(data))
 
-        series_data = self.processSeries(analysis_gen, warnings)
-        for d, skip, last_good in series_data:
-            self.handleData(s, d, d.state, skip, last_good)
+        if data:
+            state.last_run = max(state.last_run, max(d.testrun_id for d in data))
+            state.last_time = max(state.last_time, max(d.testrun_timestamp for d in data))
+        self.updateTimes(s.branch_name, data)
 
-        if self.config.has_option('main', 'graph_dir'):
-            self.outputGraphs(s, series_data)
+        last_good = state.last_good
+        final = state.analyzer.add(data)
+        for d in final:
+            if d.state == "good":
+                state.last_good = d
 
-    def processSeries(self, analysis_gen, warnings):
-        last_good = None
+        self.series_cache.save(s, state, final, self.options.start_time)
+        return final, last_good, state.last_run
+
+    def processSeries(self, analysis_gen, warnings, last_good=None):
         # Uncomment this for debugging!
         #cutoff = self.options.start_time
         cutoff = time.time() - 7*24*3600
@@ -903,14 +997,12 @@ class AnalysisRunner:
                     warnings.append((d.buildid, d.testrun_timestamp))
                     if d.state == "machine":
                         machine_name = self.source.getMachineName(d.machine_id)
-                        if 'bad_machines' not in self.warning_history:
-                            self.warning_history['bad_machines'] = {}
                         # When did we last warn about this machine?
-                        if self.warning_history['bad_machines'].get(machine_name, 0) > time.time() - 7*24*3600:
+                        if self.warning_history.machineWarned(machine_name, time.time() - 7*24*3600):
                             skip = True
                         else:
                             # If it was over a week ago, then send another warning
-                            self.warning_history['bad_machines'][machine_name] = time.time()
+                            self.warning_history.warnMachine(machine_name, time.time())
 
             series_data.append((d, skip, last_good))
 
@@ -931,11 +1023,7 @@ class AnalysisRunner:
 
     def loadDashboardSeries(self):
         start_time = self.options.start_time
-        importantTests = []
-        for t in re.split(r"(?<!\\),", self.config.get("dashboard", "tests")):
-            t = t.replace("\\,", ",").strip()
-            importantTests.append(t)
-        #importantTests = []
+        importantTests = list(self.rules.dashboard_tests)
         series = self.source.getTestSeries(self.options.branches, start_time, importantTests, 0)
         return series
 
@@ -943,22 +1031,81 @@ class AnalysisRunner:
         log.info("Fetching list of tests")
         series = self.loadSeries()
         self.done = False
+        dashboard = self.config.has_option('main', 'dashboard_dir')
 
-        while not self.done:
-            if not series:
+        if self.options.jobs <= 1 and self.fetch_threads > 0:
+            self.fetch_pool = ThreadPool(self.fetch_threads)
+        try:
+            if dashboard and self.fetch_pool:
+                # Look up the dashboard series while we go through the others
+                dashboard_series = self.fetch_pool.apply_async(self.loadDashboardSeries)
+
+            try:
+                if self.options.jobs > 1:
+                    self.runParallel(series)
+                else:
+                    self.runSerial(series)
+            finally:
+                self.flushWarnings()
+
+            if dashboard:
+                if self.fetch_pool:
+                    dashboard_series = dashboard_series.get()
+                else:
+                    dashboard_series = self.loadDashboardSeries()
+                self.runDashboard(dashboard_series)
+        finally:
+            if self.fetch_pool:
+                self.fetch_pool.terminate()
+                self.fetch_pool = None
+
+    def runSerial(self, series):
+        todo = [s for s in series if not self.skipSeries(s)]
+        for s, data, state in self.fetchSeriesData(todo):
+            if self.done:
                 break
-            s = series.pop()
-            self.handleSeries(s)
-
-        if self.config.has_option('main', 'dashboard_dir'):
-            log.info("Getting dashboard data")
-            dashboard_series = self.loadDashboardSeries()
-            while not self.done:
-                if not dashboard_series:
+            log.info("Processing %s %s %s", s.branch_name, s.os_name, s.test_name)
+            self.reportSeries(s, *self.analyzeSeries(s, data, state))
+
+    def runDashboard(self, dashboard_series):
+        log.info("Getting dashboard data")
+        dashboard_series = [s for s in dashboard_series if self.isDashboardSeries(s)]
+        sevenDaysAgo = time.time() - 7*24*60*60
+        for s, data, state in self.fetchSeriesData(dashboard_series, sevenDaysAgo):
+            if self.done:
+                break
+            self.handleDashboardSeries(s, data)
+        self.outputDashboard()
+
+    def runParallel(self, series):
+        """Fetches and analyzes `series` in worker processes.
+
+        Everything that touches the warning history, pushlog cache or email
+        still happens here, one series at a time and in the same (branch_id,
+        os_id, test_id) order as the serial loop.
+        """
+        global _worker_runner
+        todo = [s for s in series if not self.skipSeries(s)]
+        todo.sort(key=lambda s: (s.branch_id, s.os_id, s.test_id))
+
+        # Don't let the workers inherit open database connections
+        if hasattr(self.source, 'dispose'):
+            self.source.dispose()
+        _worker_runner = self
+        pool = multiprocessing.Pool(self.options.jobs)
+        try:
+            results = pool.imap(_analyzeSeries, todo)
+            for s, (data, last_good, last_run, pushes) in zip(todo, results):
+                if self.done:
                     break
-                s = dashboard_series.pop()
-                self.handleDashboardSeries(s)
-            self.outputDashboard()
+                log.info("Processing %s %s %s", s.branch_name, s.os_name, s.test_name)
+                self.pushlog.addPushes(s.branch_name, pushes)
+                self.reportSeries(s, data, last_good, last_run)
+            pool.close()
+        finally:
+            pool.terminate()
+            pool.join()
+            _worker_runner = None
 
     def save(self, errors=False):
         try:
@@ -971,6 +1118,18 @@ class AnalysisRunner:
         except:
             log.exception("Error saving pushlog")
 
+        if self._bugs:
+            try:
+                self._bugs.save()
+            except:
+                log.exception("Error saving bug cache")
+
+        if self._shortener:
+            try:
+                self._shortener.save()
+            except:
+                log.exception("Error saving short urls")
+
         if not errors:
             try:
                 if self.config.has_option('cache', 'last_run_file'):
@@ -978,6 +1137,17 @@ class AnalysisRunner:
             except:
                 log.exception("Error saving last time")
 
+# The AnalysisRunner that worker processes analyze series with; see runParallel
+_worker_runner = None
+
+def _analyzeSeries(s):
+    runner = _worker_runner
+    data, last_good, last_run = runner.analyzeSeries(s)
+    # Pass along what we learned about the pushes, since only the parent
+    # process saves the pushlog
+    pushes = runner.pushlog.getPushes(s.branch_name, set(d.revision for d in data))
+    return data, last_good, last_run, pushes
+
 def parse_options(args=None):
     from optparse import OptionParser
 
@@ -992,6 +1162,7 @@ def parse_options(args=None):
     parser.add_option("-c", "--config", dest="config", help="config file to read")
     parser.add_option("", "--start-time", dest="start_time", type="int", help="timestamp for when we start looking at data")
     parser.add_option("", "--catchup", dest="catchup", action="store_true", help="Don't output any warnings, just process data")
+    parser.add_option("-j", "--jobs", dest="jobs", type="int", help="number of worker processes to fetch and analyze data with")
 
     parser.set_defaults(
             branches = [],
@@ -1004,6 +1175,7 @@ def parse_options(args=None):
             machine_addresses = [],
             config = "analysis.cfg",
             catchup = False,
+            jobs = 1,
             )
 
     return parser.parse_args(args)
@@ -1015,8 +1187,8 @@ def get_config(options):
     config.add_section('main')
     config.add_section('cache')
     # Set some defaults
-    config.set('cache', 'warning_history', 'warning_history.json')
-    config.set('cache', 'pushlog', 'pushlog.json')
+    config.set('cache', 'warning_history', 'warning_history.log')
+    config.set('cache', 'pushlog', 'pushlog.sqlite')
     config.set('cache', 'last_run_file', 'lastrun.txt')
     config.read([options.config])
 
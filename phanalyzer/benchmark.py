@@ -0,0 +1,383 @@
+# This Source Code Form is subject to the terms of the Mozilla Public
+# License, v. 2.0. If a copy of the MPL was not distributed with this file,
+# You can obtain one at http://mozilla.org/MPL/2.0/.
+"""Times the detection engine, the runner and data loading, and compares
+different ways of doing the same work, on the files in test_data and on
+made up data.
+
+    python benchmark.py [-n REPEAT] [-s SIZES] [-o FILE] [-b BASELINE] [benchmark ...]
+
+Each variant is run in a forked child, which reports the best of REPEAT
+runs and how far the runs raised the peak RSS.  SIZES are the numbers of
+points in the made up series (10000,100000 by default; 1000000 takes a few
+minutes).  -o saves the results as JSON, and -b compares them with results
+saved earlier, flagging anything that got slower.
+"""
+import os, sys, time, random
+import gc
+import resource
+import shutil
+import tempfile
+import traceback
+try:
+    import simplejson as json
+except ImportError:
+    import json
+
+from analyze import PerfDatum, TalosAnalyzer, analyze, calc_t, numpy
+from analyze_graphapi import load_test_runs, GraphAPISource, SeriesCatalog, TestSeries
+
+TEST_DATA = os.path.join(os.path.dirname(os.path.abspath(__file__)), 'test_data')
+# Differences smaller than this many seconds are noise, whatever the ratio
+MIN_SLOWDOWN = 0.001
+
+
+class MeasureError(Exception):
+    """A benchmark variant raised, or its child died without a result."""
+
+
+def measure(fn, repeat):
+    """Returns the fastest of `repeat` calls to `fn` in seconds, and how far
+    the calls raised the peak RSS in kB.  The calls are made in a forked
+    child, so that they start from the same state, and what earlier calls
+    allocated doesn't hide how much memory they need.
+
+    Raises MeasureError if `fn` raises, after the child prints the
+    traceback."""
+    r, w = os.pipe()
+    pid = os.fork()
+    if pid == 0:
+        os.close(r)
+        try:
+            before = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+            # Like timeit, keep the garbage collector from adding noise
+            gc.disable()
+            best = None
+            for i in range(repeat):
+                start = time.time()
+                fn()
+                elapsed = time.time() - start
+                if best is None or elapsed < best:
+                    best = elapsed
+            after = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+            os.write(w, json.dumps([best, after - before]))
+        except:
+            traceback.print_exc()
+            sys.stderr.flush()
+            os.write(w, json.dumps({'error': traceback.format_exc().splitlines()[-1]}))
+        finally:
+            os._exit(0)
+    os.close(w)
+    output = ''
+    while True:
+        chunk = os.read(r, 4096)
+        if not chunk:
+            break
+        output += chunk
+    os.close(r)
+    pid, status = os.waitpid(pid, 0)
+    if not output:
+        raise MeasureError("no result, exit status %i" % status)
+    result = json.loads(output)
+    if isinstance(result, dict):
+        raise MeasureError(result['error'])
+    return result
+
+
+def json_load_runs(filename):
+    """How test/runs payloads used to be read: the whole tree, then a
+    PerfDatum per row."""
+    runs = json.load(open(filename))['test_runs']
+    retval = []
+    for r in runs:
+        if r[3] is None:
+            continue
+        d = PerfDatum(r[2], r[3], testrun_id=r[0], machine_id=r[6],
+                      testrun_timestamp=r[2], buildid=r[1][1],
+                      revision=r[1][2])
+        d.run_number = r[4]
+        retval.append(d)
+    return retval
+
+
+def stream_runs(filename):
+    return load_test_runs(open(filename))
+
+
+def stream_runs_perfdata(filename):
+    return load_test_runs(open(filename)).perfData()
+
+
+def fixtures():
+    """Yields the name and data of each file in test_data."""
+    for fn in sorted(os.listdir(TEST_DATA)):
+        if fn.endswith('.json'):
+            yield fn, load_test_runs(open(os.path.join(TEST_DATA, fn))).perfData()
+
+
+def make_series(num_points, num_machines=50, seed=0):
+    """Returns a made up series over the last six days, with about 20 steps
+    up, on `num_machines` machines of which one in 25 reads high."""
+    rnd = random.Random(seed)
+    bad = set(rnd.sample(range(num_machines), max(1, num_machines // 25)))
+    start = time.time() - 6 * 86400
+    step = 6 * 86400.0 / num_points
+    level = 100.0
+    data = []
+    for i in range(num_points):
+        if rnd.random() < 20.0 / num_points:
+            level *= 1.1
+        machine_id = rnd.randrange(num_machines)
+        value = level + rnd.gauss(0, 2) + (30 if machine_id in bad else 0)
+        t = start + i * step
+        data.append(PerfDatum(t, value, testrun_timestamp=t, buildid="%014i" % i,
+                              testrun_id=i, machine_id=machine_id, revision="%012x" % i))
+    return data
+
+
+def all_series(sizes):
+    for name, data in fixtures():
+        yield name, data
+    for size in sizes:
+        yield "%i points" % size, make_series(size)
+
+
+def engine(sizes):
+    """The detection engine."""
+    for name, data in all_series(sizes):
+        values = [d.value for d in data]
+        analyzer = TalosAnalyzer()
+        analyzer.addData(data)
+        yield name, len(data), [
+            ("analyze", lambda: [analyze(values[i:i+12]) for i in range(0, len(values), 12)]),
+            ("calc_t", lambda: [calc_t(values[i:i+12], values[i+12:i+24])
+                                for i in range(0, len(values) - 23, 24)]),
+            ("TalosAnalyzer.addData", lambda: TalosAnalyzer().addData(data)),
+            ("analyze_t", lambda: analyzer.analyze_t()),
+            ("analyze_t machines", lambda: analyzer.analyze_t(machine_threshold=15,
+                                                              machine_history_size=5)),
+            ]
+
+
+class BenchSource:
+    def getMachineName(self, machine_id):
+        return "machine-%s" % machine_id
+
+
+def runner(sizes):
+    """AnalysisRunner.processSeries on analyzed series."""
+    from analyze_talos import AnalysisRunner, parse_options, get_config
+
+    tmpdir = tempfile.mkdtemp()
+    options, args = parse_options(['--start-time', '0'])
+    options.config = os.path.join(os.path.dirname(os.path.abspath(__file__)), 'analysis.cfg.template')
+    config = get_config(options)
+    config.set('cache', 'warning_history', os.path.join(tmpdir, 'warning_history.log'))
+    r = AnalysisRunner(options, config, 'average')
+    r._source = BenchSource()
+
+    try:
+        # processSeries skips anything over a week old, which is all of
+        # test_data, so only the made up series are any use here
+        for size in sizes:
+            analyzer = TalosAnalyzer()
+            analyzer.addData(make_series(size))
+            results = analyzer.analyze_t(machine_threshold=15, machine_history_size=5)
+            yield "%i points" % size, len(results), [
+                ("processSeries", lambda: r.processSeries(results, [])),
+                ]
+    finally:
+        shutil.rmtree(tmpdir)
+
+
+def ingestion(sizes):
+    """Reading test/runs payloads."""
+    for fn in sorted(os.listdir(TEST_DATA)):
+        if fn.endswith('.json'):
+            filename = os.path.join(TEST_DATA, fn)
+            size = len(load_test_runs(open(filename)))
+            yield fn, size, [
+                ("json.load", lambda: json_load_runs(filename)),
+                ("streaming", lambda: stream_runs(filename)),
+                ("streaming+PerfDatum", lambda: stream_runs_perfdata(filename)),
+                ]
+
+
+def make_tests(num_tests, num_branches, num_platforms, per_test=6, seed=0):
+    """Returns a made up /test catalog, with each test on `per_test` of the
+    branches and platforms."""
+    rnd = random.Random(seed)
+    tests = {
+        'stat': 'ok',
+        'branchMap': dict((str(i), {'name': 'branch-%i' % i}) for i in range(num_branches)),
+        'platformMap': dict((str(i), {'name': 'os-%i' % i}) for i in range(num_platforms)),
+        'testMap': {},
+        }
+    for i in range(num_tests):
+        tests['testMap'][str(i)] = {
+            'name': 'test-%i' % i,
+            'branchIds': rnd.sample(range(num_branches), min(per_test, num_branches)),
+            'platformIds': rnd.sample(range(num_platforms), min(per_test, num_platforms)),
+            }
+    return tests
+
+
+def list_series(tests, branches, test_names):
+    """How GraphAPISource.getTestSeries used to build its list."""
+    retval = []
+    for test_id, test in tests['testMap'].items():
+        test_name = test['name']
+        if test_names and test_name not in test_names:
+            continue
+        for branch_id in test['branchIds']:
+            branch_info = tests['branchMap'][str(branch_id)]
+            if branch_info['name'] not in branches:
+                continue
+            for os_id in test['platformIds']:
+                os_info = tests['platformMap'][str(os_id)]
+                if "NoChrome" in test_name or "Fast Cycle" in test_name:
+                    continue
+                series = TestSeries(branch_id, branch_info['name'],
+                                    os_id, os_info['name'], test_id, test_name)
+                if series not in retval:
+                    retval.append(series)
+    return retval
+
+
+def catalog(sizes):
+    """Building the series list from the /test catalog."""
+    source = GraphAPISource(None)
+    # The old way is quadratic, so only try it on the small catalog
+    for num_tests, num_branches, num_platforms, old in ((50, 12, 8, True),
+                                                        (3000, 36, 24, False)):
+        tests = make_tests(num_tests, num_branches, num_platforms)
+        branches = ['branch-%i' % i for i in range(num_branches)]
+        variants = []
+        if old:
+            variants.append(("list", lambda: list_series(tests, branches, [])))
+        variants.append(("set", lambda: source.seriesFromTests(tests, branches, [])))
+        yield "%i tests x %i branches x %i platforms" % (num_tests, num_branches, num_platforms), None, variants
+
+
+def catalog_lookup(sizes):
+    """Finding the series for each branch and platform."""
+    tests = make_tests(3000, 36, 24)
+    series = GraphAPISource(None).seriesFromTests(
+        tests, ['branch-%i' % i for i in range(36)], [])
+    index = SeriesCatalog(series)
+    pairs = [('branch-%i' % b, 'os-%i' % o) for b in range(0, 36, 3) for o in range(0, 24, 3)]
+
+    def scan():
+        return [[s for s in series if s.branch_name == b and s.os_name == o] for b, o in pairs]
+
+    def find():
+        return [index.find(branch_name=b, os_name=o) for b, o in pairs]
+
+    yield "%i lookups in %i series" % (len(pairs), len(series)), len(pairs), [
+        ("list scan", scan),
+        ("SeriesCatalog.find", find),
+        ]
+
+
+BENCHMARKS = [engine, runner, ingestion, catalog, catalog_lookup]
+
+
+def run(benchmarks, sizes, repeat, out=sys.stdout):
+    """Runs `benchmarks`, printing a line for each variant as it's done, and
+    returns a list with a dict for each.  Variants that fail have an
+    'error' and no timings."""
+    results = []
+    for benchmark in benchmarks:
+        print >>out, "%s: %s" % (benchmark.__name__, benchmark.__doc__)
+        for case, size, variants in benchmark(sizes):
+            print >>out, "  %s" % case
+            for name, fn in variants:
+                result = {
+                    'benchmark': benchmark.__name__,
+                    'case': case,
+                    'variant': name,
+                    'size': size,
+                    }
+                results.append(result)
+                try:
+                    seconds, peak = measure(fn, repeat)
+                except MeasureError, e:
+                    result.update(seconds=None, throughput=None, peak_kb=None, error=str(e))
+                    print >>out, "    %-22s FAILED: %s" % (name, e)
+                    continue
+                result.update(seconds=seconds, peak_kb=peak,
+                              throughput=size / seconds if size and seconds else None)
+                line = "    %-22s %10.2fms %9skB" % (name, seconds * 1000, peak)
+                if result['throughput']:
+                    line += " %12.0f/s" % result['throughput']
+                print >>out, line
+            out.flush()
+    return results
+
+
+def compare(results, baseline, tolerance):
+    """Returns (result, baseline seconds) for each of `results` that took
+    more than `tolerance` (a fraction) and MIN_SLOWDOWN longer than in
+    `baseline`.  Variants that failed in either are skipped."""
+    before = {}
+    for b in baseline:
+        before[(b['benchmark'], b['case'], b['variant'])] = b['seconds']
+
+    slower = []
+    for r in results:
+        old = before.get((r['benchmark'], r['case'], r['variant']))
+        if r.get('error') or not old:
+            continue
+        if r['seconds'] > old * (1 + tolerance) and r['seconds'] - old > MIN_SLOWDOWN:
+            slower.append((r, old))
+    return slower
+
+
+if __name__ == "__main__":
+    from optparse import OptionParser
+
+    parser = OptionParser(usage="%prog [options] [benchmark ...]")
+    parser.add_option("-n", "--repeat", dest="repeat", type="int", default=3,
+                      help="take the best of this many runs")
+    parser.add_option("-s", "--sizes", dest="sizes", default="10000,100000",
+                      help="comma-separated sizes of the made up series")
+    parser.add_option("-o", "--output", dest="output", help="save the results to this JSON file")
+    parser.add_option("-b", "--baseline", dest="baseline",
+                      help="compare with results saved to this JSON file")
+    parser.add_option("-t", "--tolerance", dest="tolerance", type="float", default=0.1,
+                      help="how much slower than the baseline is a slowdown (default 0.1, 10%)")
+    options, args = parser.parse_args()
+
+    benchmarks = BENCHMARKS
+    if args:
+        benchmarks = [b for b in BENCHMARKS if b.__name__ in args]
+        if not benchmarks:
+            parser.error("unknown benchmark; choose from %s" % ", ".join(b.__name__ for b in BENCHMARKS))
+    sizes = [int(s) for s in options.sizes.split(',') if s.strip()]
+
+    results = run(benchmarks, sizes, options.repeat)
+
+    if options.output:
+        json.dump({
+            'date': time.time(),
+            'python': sys.version.split()[0],
+            'numpy': numpy is not None,
+            'repeat': options.repeat,
+            'results': results,
+            }, open(options.output, "w"), indent=2, sort_keys=True)
+
+    if options.baseline:
+        baseline = json.load(open(options.baseline))
+        slower = compare(results, baseline['results'], options.tolerance)
+        for r, old in slower:
+            print "SLOWER: %s %s %s: %.2fms, was %.2fms (%+.0f%%)" % (
+                r['benchmark'], r['case'], r['variant'], r['seconds'] * 1000,
+                old * 1000, (r['seconds'] / old - 1) * 100)
+        if slower:
+            sys.exit(1)
+        print "No slowdowns against %s" % options.baseline
+
+    failed = [r for r in results if r.get('error')]
+    if failed:
+        print "%i variants failed" % len(failed)
+        sys.exit(1)
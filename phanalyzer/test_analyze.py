@@ -4,9 +4,21 @@
 import unittest
 import json
 import os
+import random
 import sys
 
 from analyze import *
+from analyze_graphapi import load_test_runs
+
+try:
+    import numpy
+except ImportError:
+    numpy = None
+
+def load_json(filename):
+    """Parse JSON produced by http://graphs.mozilla.org/api/test/runs"""
+    inputfile = open(os.path.join('test_data', filename))
+    return load_test_runs(inputfile).perfData()
 
 class TestAnalyze(unittest.TestCase):
     def test_analyze(self):
@@ -30,6 +42,39 @@ class TestAnalyze(unittest.TestCase):
         self.assertEqual(calc_t([0.0, 0.0], [0.0, 0.0]), 0.0)
         self.assertEqual(calc_t([0.0, 0.0], [1.0, 1.0]), float('inf'))
 
+    def test_window_stats(self):
+        s = WindowStats(2.5, 4, 5.0/3.0)
+        self.assertEqual((s['avg'], s['n'], s['variance']), (2.5, 4, 5.0/3.0))
+        self.assertRaises(KeyError, lambda: s['stddev'])
+
+    def assertStatsAlmostEqual(self, s1, s2):
+        self.assertEqual(s1['n'], s2['n'])
+        self.assertAlmostEqual(s1['avg'], s2['avg'], places=6)
+        self.assertAlmostEqual(s1['variance'], s2['variance'], places=6)
+
+    def test_rolling_window(self):
+        rnd = random.Random(0)
+        w = RollingWindow()
+        values = []
+        for i in range(500):
+            op = rnd.randint(0, 3)
+            if op < 2 or not values:
+                v = rnd.gauss(1000, 10)
+                if op == 0:
+                    w.append(v)
+                    values.append(v)
+                else:
+                    w.appendleft(v)
+                    values.insert(0, v)
+            elif op == 2:
+                self.assertEqual(w.pop(), values.pop())
+            else:
+                self.assertEqual(w.popleft(), values.pop(0))
+
+            self.assertStatsAlmostEqual(w.stats(), analyze(values))
+            self.assertStatsAlmostEqual(w.stats(linear_weights),
+                                        analyze(values, linear_weights))
+
 class TestTalosAnalyzer(unittest.TestCase):
     def get_data(self):
         times  = [0, 1, 2, 3, 4, 5, 6, 7, 8, 9, 10, 11, 12, 13, 14, 15]
@@ -57,6 +102,58 @@ class TestTalosAnalyzer(unittest.TestCase):
             (9, 'good'),
             (10, 'good')])
 
+    def test_analyze_t_bad_machine(self):
+        # Three machines take turns; from t=30 on machine 2 reports values
+        # that are way off, which shouldn't count as a regression.
+        data = []
+        for t in range(60):
+            machine_id = t % 3
+            value = 10.0 + (t % 2) * 0.5
+            if machine_id == 2 and t >= 30:
+                value += 20.0
+            data.append(PerfDatum(t, value, machine_id=machine_id))
+
+        a = TalosAnalyzer()
+        a.addData(data)
+        results = a.analyze_t(back_window=5, fore_window=5, t_threshold=7,
+                              machine_threshold=15, machine_history_size=3)
+
+        self.assertEqual([d.state for d in results if d.state == 'regression'], [])
+        bad = [d for d in results if d.state == 'machine']
+        self.assertTrue(bad)
+        for d in bad:
+            self.assertEqual(d.machine_id, 2)
+            self.assertTrue(d.push_timestamp >= 30)
+            self.assertNotEqual(d.last_other.machine_id, 2)
+            self.assertTrue(d.last_other.push_timestamp < d.push_timestamp)
+
+    @unittest.skipIf(numpy is None, "numpy is not installed")
+    def test_batch_calc_t(self):
+        data = load_json('runs2.json')
+        a = TalosAnalyzer()
+        a.addData(data)
+        expected = [(d.historical_stats, d.forward_stats, d.t)
+                    for d in a._calc_t(12, 12, None, None)]
+        result = batch_calc_t([d.value for d in a.data], 12, 12)
+        self.assertEqual(len(result), len(expected))
+        for (h1, f1, t1), (h2, f2, t2) in zip(result, expected):
+            for s1, s2 in ((h1, h2), (f1, f2)):
+                self.assertEqual(s1['n'], s2['n'])
+                self.assertAlmostEqual(s1['avg'], s2['avg'], places=6)
+                self.assertAlmostEqual(s1['variance'], s2['variance'], places=6)
+            self.assertAlmostEqual(t1, t2, places=6)
+
+    @unittest.skipIf(numpy is None, "numpy is not installed")
+    def test_json_files_numpy(self):
+        # Without a machine threshold analyze_t takes the vectorized path
+        self.check_json('runs1.json', [1365019665], machine_threshold=None)
+        self.check_json('runs2.json', [1357692289, 1358971894, 1365014104], machine_threshold=None)
+        self.check_json('runs3.json', [1335293827, 1338839958], machine_threshold=None)
+        self.check_json('runs4.json', [1364922838], machine_threshold=None)
+        self.check_json('runs5.json', [], machine_threshold=None)
+        self.check_json('a11y.json', [1366197637, 1367799757], machine_threshold=None)
+        self.check_json('tp5rss.json', [1373413365, 1373424974], machine_threshold=None)
+
     def test_json_files(self):
         self.check_json('runs1.json', [1365019665])
         self.check_json('runs2.json', [1357692289, 1358971894, 1365014104])
@@ -66,29 +163,148 @@ class TestTalosAnalyzer(unittest.TestCase):
         self.check_json('a11y.json', [1366197637, 1367799757])
         self.check_json('tp5rss.json', [1373413365, 1373424974])
 
-    def check_json(self, filename, expected_timestamps):
-        """Parse JSON produced by http://graphs.mozilla.org/api/test/runs"""
+    def check_json(self, filename, expected_timestamps, machine_threshold=15):
         # Configuration for TalosAnalyzer
         FORE_WINDOW = 12
         BACK_WINDOW = 12
         THRESHOLD = 7
-        MACHINE_THRESHOLD = 15
         MACHINE_HISTORY_SIZE = 5
 
-        inputfile = open(os.path.join('test_data', filename))
-        payload = json.load(inputfile)
-        runs = payload['test_runs']
-        data = [PerfDatum(r[2], r[3], testrun_id=r[0], machine_id=r[6],
-                          testrun_timestamp=r[2], buildid=r[1][1],
-                          revision=r[1][2]) for r in runs]
+        data = load_json(filename)
 
         a = TalosAnalyzer()
         a.addData(data)
         results = a.analyze_t(BACK_WINDOW, FORE_WINDOW, THRESHOLD,
-                MACHINE_THRESHOLD, MACHINE_HISTORY_SIZE)
+                machine_threshold, MACHINE_HISTORY_SIZE)
         regression_timestamps = [d.testrun_timestamp for d in results if \
                                  d.state == 'regression']
         self.assertEqual(regression_timestamps, expected_timestamps)
 
+class TestStreamingTalosAnalyzer(unittest.TestCase):
+    def batch_states(self, filename, **kw):
+        a = TalosAnalyzer()
+        a.addData(load_json(filename))
+        return [(d.testrun_id, d.state) for d in a.analyze_t(**kw)]
+
+    def stream_states(self, data, analyzer, chunk_size, save=False):
+        states = {}
+        for i in range(0, len(data), chunk_size):
+            for d in analyzer.add(data[i:i+chunk_size]):
+                states[d.testrun_id] = d.state
+            if save:
+                state = json.loads(json.dumps(analyzer.get_state()))
+                analyzer = StreamingTalosAnalyzer.from_state(state)
+        return states
+
+    def check_stream(self, filename, data, chunk_size, save=False, **kw):
+        expected = self.batch_states(filename, **kw)
+        states = self.stream_states(data, StreamingTalosAnalyzer(**kw),
+                                    chunk_size, save)
+        # Everything but the last couple of points has a final state
+        self.assertTrue(len(states) >= len(expected))
+        self.assertEqual([(i, states[i]) for i, _ in expected], expected)
+
+    def test_in_order(self):
+        for machine_threshold in (None, 15):
+            kw = dict(back_window=12, fore_window=12, t_threshold=7,
+                      machine_threshold=machine_threshold,
+                      machine_history_size=5)
+            for filename in ('runs1.json', 'runs3.json', 'tp5rss.json'):
+                data = sorted(load_json(filename))
+                self.check_stream(filename, data, 1, **kw)
+                self.check_stream(filename, data, 100, **kw)
+
+    def test_save_state(self):
+        kw = dict(back_window=12, fore_window=12, t_threshold=7,
+                  machine_threshold=15, machine_history_size=5)
+        data = sorted(load_json('runs2.json'))
+        self.check_stream('runs2.json', data, 100, save=True, **kw)
+
+    def test_out_of_order(self):
+        kw = dict(back_window=12, fore_window=12, t_threshold=7,
+                  machine_threshold=15, machine_history_size=5)
+        data = sorted(load_json('runs2.json'))
+        # Swap points around within small blocks, so some of them show up
+        # after newer ones have already been scored
+        rnd = random.Random(1)
+        shuffled = []
+        for i in range(0, len(data), 8):
+            block = data[i:i+8]
+            rnd.shuffle(block)
+            shuffled.extend(block)
+        self.check_stream('runs2.json', shuffled, 4, **kw)
+
+    def test_late_points(self):
+        data = [PerfDatum(i, float(i % 7 + (10 if i >= 30 else 0)), testrun_id=i)
+                for i in range(60)]
+        a = TalosAnalyzer()
+        a.addData([PerfDatum.from_dict(d.to_dict()) for d in data])
+        expected = [(d.testrun_id, d.state) for d in a.analyze_t(5, 5, 7)]
+
+        # 20 shows up among points that have already been emitted, and 40
+        # among ones that haven't
+        late = (20, 40)
+        batches = [[d for d in data[:28] if d.testrun_id not in late], [data[20]]]
+        batches += [[d] for d in data[28:] if d.testrun_id not in late]
+        batches.insert(-3, [data[40]])
+        a = StreamingTalosAnalyzer(back_window=5, fore_window=5, t_threshold=7)
+        emitted = []
+        for batch in batches:
+            result = a.add(batch)
+            if batch[0] is data[20]:
+                self.assertEqual([d.testrun_id for d in result], [20])
+            emitted.extend((d.testrun_id, d.state) for d in result)
+
+        # Every point is emitted exactly once, with the state it ends up with
+        # in a batch analysis
+        ids = [i for i, state in emitted]
+        self.assertEqual(len(ids), len(set(ids)))
+        states = dict(emitted)
+        self.assertEqual([(i, states[i]) for i, _ in expected], expected)
+        self.assertTrue('regression' in states.values())
+
+    def test_trim_keeps_emitted(self):
+        data = sorted(load_json('runs2.json'))
+        rnd = random.Random(1)
+        shuffled = []
+        for i in range(0, len(data), 8):
+            block = data[i:i+8]
+            rnd.shuffle(block)
+            shuffled.extend(block)
+        a = StreamingTalosAnalyzer(back_window=12, fore_window=12, t_threshold=7,
+                                   machine_threshold=15, machine_history_size=5,
+                                   history_size=30)
+        emitted = []
+        for i in range(0, len(shuffled), 4):
+            emitted.extend((d, d.t, d.state) for d in a.add(shuffled[i:i+4]))
+        # Trimming the history doesn't touch what was already handed out
+        self.assertTrue(len(emitted) > 1000)
+        self.assertEqual([(d.t, d.state) for d, t, state in emitted],
+                         [(t, state) for d, t, state in emitted])
+
+    def test_trim_keeps_datum_class(self):
+        class LabelledDatum(PerfDatum):
+            __slots__ = ('label',)
+
+        data = []
+        for t in range(100):
+            d = LabelledDatum(t, float(t % 2), testrun_id=t)
+            d.label = "point %i" % t
+            data.append(d)
+        a = StreamingTalosAnalyzer(back_window=5, fore_window=5, history_size=10,
+                                   datum_class=LabelledDatum)
+        for d in data:
+            a.add([d])
+        self.assertTrue(len(a.checkpoint.good_tail) > 0)
+        for d in a.checkpoint.good_tail:
+            self.assertEqual((type(d), d.label), (LabelledDatum, "point %i" % d.testrun_id))
+
+    def test_drop_old_points(self):
+        data = [PerfDatum(t, float(t % 2), testrun_id=t) for t in range(100)]
+        a = StreamingTalosAnalyzer(back_window=5, fore_window=5, history_size=10)
+        a.add(data[1:])
+        self.assertEqual(a.add(data[:1]), [])
+        self.assertTrue(data[0] not in a.history + a.pending)
+
 if __name__ == '__main__':
     unittest.main()
@@ -0,0 +1,144 @@
+# This Source Code Form is subject to the terms of the Mozilla Public
+# License, v. 2.0. If a copy of the MPL was not distributed with this file,
+# You can obtain one at http://mozilla.org/MPL/2.0/.
+import unittest
+import json
+import os
+import shutil
+import sqlite3
+import tempfile
+
+try:
+    import analyze_db
+except ImportError:
+    analyze_db = None
+
+SCHEMA = """
+CREATE TABLE branches (id INTEGER PRIMARY KEY, name TEXT);
+CREATE TABLE os_list (id INTEGER PRIMARY KEY, name TEXT);
+CREATE TABLE tests (id INTEGER PRIMARY KEY, name TEXT, pretty_name TEXT);
+CREATE TABLE machines (id INTEGER PRIMARY KEY, name TEXT, os_id INTEGER, is_active INTEGER);
+CREATE TABLE builds (id INTEGER PRIMARY KEY, ref_build_id TEXT, ref_changeset TEXT,
+                     branch_id INTEGER);
+CREATE TABLE test_runs (id INTEGER PRIMARY KEY, machine_id INTEGER, build_id INTEGER,
+                        test_id INTEGER, date_run INTEGER, average REAL, geomean REAL,
+                        run_number INTEGER);
+"""
+
+@unittest.skipIf(analyze_db is None, "sqlalchemy isn't installed")
+class TestAnalyzeDB(unittest.TestCase):
+    def setUp(self):
+        self.tmpdir = tempfile.mkdtemp()
+        self.filename = os.path.join(self.tmpdir, 'graphs.sqlite')
+        conn = sqlite3.connect(self.filename)
+        conn.executescript(SCHEMA)
+        conn.executemany("INSERT INTO branches VALUES (?, ?)", [(1, 'Firefox'), (2, 'Try')])
+        conn.executemany("INSERT INTO os_list VALUES (?, ?)", [(10, 'WINNT 6.1'), (11, 'Linux')])
+        conn.executemany("INSERT INTO tests VALUES (?, ?, ?)",
+                         [(100, 'tp5', 'Tp5'), (101, 'ts', 'Ts'), (102, 'dromaeo', 'Dromaeo')])
+        conn.executemany("INSERT INTO machines VALUES (?, ?, ?, ?)",
+                         [(1, 'win1', 10, 1), (2, 'linux1', 11, 1), (3, 'win2', 10, 0)])
+        conn.executemany("INSERT INTO builds VALUES (?, ?, ?, ?)",
+                         [(branch_id * 10 + i, 'build%i' % i, 'rev%i' % i, branch_id)
+                          for branch_id in (1, 2) for i in range(5)])
+        runs = []
+        for build_id in [branch_id * 10 + i for branch_id in (1, 2) for i in range(5)]:
+            for machine_id in (1, 2, 3):
+                for test_id in (100, 101, 102):
+                    average = None if build_id % 10 == 3 else float(build_id + test_id)
+                    runs.append((len(runs) + 1, machine_id, build_id, test_id,
+                                 1000 + build_id % 10, average, None, 0))
+        conn.executemany("INSERT INTO test_runs VALUES (?, ?, ?, ?, ?, ?, ?, ?)", runs)
+        conn.commit()
+        conn.close()
+        analyze_db.connect('sqlite:///' + self.filename)
+
+    def tearDown(self):
+        analyze_db.dispose()
+        shutil.rmtree(self.tmpdir)
+
+    def series(self, branch_id, os_id, test_id):
+        return analyze_db.TestSeries(branch_id, None, os_id, None, test_id, None, None)
+
+    def test_getTestDataForSeries(self):
+        wanted = [self.series(2, 11, 101), self.series(1, 10, 102), self.series(1, 10, 100),
+                  self.series(1, 11, 100)]
+        got = list(analyze_db.getTestDataForSeries(wanted, 1000, 'average'))
+        # Only the series that were asked for, in order, and each the same
+        # as fetching it on its own
+        self.assertEqual([s for s, data in got], sorted(wanted,
+                         key=lambda s: (s.branch_id, s.os_id, s.test_id)))
+        for s, data in got:
+            expected = analyze_db.getTestData(s, 1000, 'average')
+            self.assertEqual([(d.testrun_id, d.value) for d in data],
+                             [(d.testrun_id, d.value) for d in expected])
+            # Inactive machines, points without a value and points from
+            # before the start time are left out
+            self.assertEqual(sorted(d.testrun_timestamp for d in data), [1001, 1002, 1004])
+            self.assertEqual(set(d.machine_id for d in data), set([s.os_id - 9]))
+            self.assertEqual(set(d.value for d in data),
+                             set(float(s.branch_id * 10 + i + s.test_id) for i in (1, 2, 4)))
+
+        self.assertEqual(list(analyze_db.getTestDataForSeries([], 0, 'average')), [])
+
+
+    def add_machine(self, machine_id, name):
+        conn = sqlite3.connect(self.filename)
+        conn.execute("INSERT INTO machines VALUES (?, ?, 10, 1)", (machine_id, name))
+        conn.commit()
+        conn.close()
+
+    def test_machines_ttl(self):
+        self.assertEqual(analyze_db.getMachineName(1), 'win1')
+        self.add_machine(4, 'win3')
+        self.add_machine(5, 'win4')
+
+        # Unknown machines make the table reload, but not more than once a
+        # MACHINES_RELOAD_INTERVAL
+        self.assertEqual(analyze_db.getMachineName(4), None)
+        analyze_db._machines_loaded -= analyze_db.MACHINES_RELOAD_INTERVAL + 1
+        self.assertEqual(analyze_db.getMachineName(5), 'win4')
+        self.assertEqual(analyze_db.getMachineName(4), 'win3')
+        self.add_machine(6, 'win5')
+        self.assertEqual(analyze_db.getMachineName(6), None)
+
+        # Everything is picked up once the table expires
+        analyze_db._machines_loaded -= analyze_db.MACHINES_TTL
+        self.assertEqual(analyze_db.getMachineName(6), 'win5')
+
+    def test_machines_snapshot(self):
+        configured = os.path.join(self.tmpdir, 'machines.json')
+        analyze_db.dispose()
+        analyze_db.connect('sqlite:///' + self.filename, configured)
+        snapshot = analyze_db.snapshotFilename(configured, 'sqlite:///' + self.filename)
+        self.assertTrue(os.path.exists(snapshot))
+        self.assertEqual(sorted(os.listdir(self.tmpdir)),
+                         ['graphs.sqlite', os.path.basename(snapshot)])
+
+        # A fresh snapshot is used instead of the database
+        self.add_machine(4, 'win3')
+        analyze_db.dispose()
+        analyze_db.connect('sqlite:///' + self.filename, configured)
+        self.assertEqual(analyze_db._machines.get(4), None)
+        self.assertEqual(analyze_db.getMachineName(2), 'linux1')
+
+        # An old one isn't
+        analyze_db._machines_loaded -= analyze_db.MACHINES_TTL + 1
+        json.dump({'loaded': analyze_db._machines_loaded, 'machines': analyze_db._machines},
+                  open(snapshot, 'w'))
+        analyze_db.dispose()
+        analyze_db.connect('sqlite:///' + self.filename, configured)
+        self.assertEqual(analyze_db._machines[4], ('win3', 10, 1))
+        self.assertEqual(json.load(open(snapshot))['machines']['4'], ['win3', 10, 1])
+
+        # Another database doesn't use it
+        other = os.path.join(self.tmpdir, 'other.sqlite')
+        shutil.copy(self.filename, other)
+        analyze_db.dispose()
+        analyze_db.connect('sqlite:///' + other, configured)
+        self.assertNotEqual(analyze_db._machines_snapshot, snapshot)
+        self.assertTrue(os.path.exists(analyze_db._machines_snapshot))
+
+
+if __name__ == '__main__':
+    unittest.main()
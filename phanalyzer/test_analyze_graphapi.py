@@ -0,0 +1,148 @@
+# This Source Code Form is subject to the terms of the Mozilla Public
+# License, v. 2.0. If a copy of the MPL was not distributed with this file,
+# You can obtain one at http://mozilla.org/MPL/2.0/.
+import unittest
+import json
+import os
+import shutil
+import tempfile
+import threading
+from StringIO import StringIO
+from ConfigParser import RawConfigParser
+
+from analyze_graphapi import GraphAPISource, SeriesCatalog, TestSeries, load_test_runs
+from analyze_http import ConnectionPool, HTTPCache
+from test_analyze_http import FakeGraphAPIHandler, FakeHTTPServer
+
+class TestLoadTestRuns(unittest.TestCase):
+    def test_matches_json_load(self):
+        for filename in sorted(os.listdir('test_data')):
+            inputfile = open(os.path.join('test_data', filename))
+            runs = json.load(inputfile)['test_runs']
+            expected = [(r[0], r[2], r[3], r[6], r[1][1], r[1][2], r[4]) for r in runs]
+            series = load_test_runs(open(os.path.join('test_data', filename)))
+            got = zip(series.testrun_ids, series.timestamps, series.values,
+                      series.machine_ids, series.buildids, series.revisions,
+                      series.run_numbers)
+            self.assertEqual(got, expected, filename)
+
+    def test_small_chunks(self):
+        payload = json.dumps({
+            "stat": "ok",
+            "test_runs": [
+                [1, [10, "20130101000000", "abc"], 100, 5.5, 0, [], 7, 4.5],
+                [2, [11, "20130101000001", "def"], 101, None, 0, [], 7, 4.0],
+                [3, [12, None, None], 102, 6.5, 1, ["note, with [brackets]", "x],[y"], 8, None],
+                ],
+            "more": "stuff",
+            })
+        for chunk_size in (1, 3, 7, 1024):
+            inputfile = StringIO(payload)
+            inputfile.read = lambda n, read=inputfile.read: read(chunk_size)
+            series = load_test_runs(inputfile)
+            self.assertEqual(list(series.testrun_ids), [1, 3])
+            self.assertEqual(list(series.values), [5.5, 6.5])
+            self.assertEqual(series.buildids, ["20130101000000", None])
+            self.assertEqual(list(load_test_runs(StringIO(payload), 'geomean').values), [4.5, 4.0])
+
+    def test_nulls(self):
+        payload = json.dumps({"test_runs": [
+            [1, [10, "20130101000000", "abc"], 100, 5.5, None, [], None],
+            [2, [11, "20130101000001", "def"], 101, 6.5, 0, [], 7],
+            ]})
+        data = load_test_runs(StringIO(payload)).perfData()
+        self.assertEqual([(d.testrun_id, d.machine_id, d.run_number) for d in data],
+                         [(1, None, None), (2, 7, 0)])
+
+    def test_no_runs(self):
+        self.assertEqual(len(load_test_runs(StringIO('{"stat": "fail"}'))), 0)
+        self.assertEqual(len(load_test_runs(StringIO('{"test_runs": []}'))), 0)
+
+class TestGraphAPISource(unittest.TestCase):
+    def setUp(self):
+        self.server = FakeHTTPServer(('127.0.0.1', 0), FakeGraphAPIHandler)
+        self.server.requests = []
+        self.server.docs = {
+            '/api/test/runs?id=3&branchid=1&platformid=2': open('test_data/runs1.json').read(),
+            '/api/test/runs?id=4&branchid=1&platformid=2': '{"stat": "fail"}',
+            }
+        self.thread = threading.Thread(target=self.server.serve_forever)
+        self.thread.start()
+        self.baseurl = "http://127.0.0.1:%i/api" % self.server.server_address[1]
+        self.pool = ConnectionPool()
+        self.cache_dir = tempfile.mkdtemp()
+
+    def tearDown(self):
+        self.pool.close()
+        self.server.shutdown()
+        self.thread.join()
+        self.server.server_close()
+        shutil.rmtree(self.cache_dir)
+
+    def test_getTestData(self):
+        series = TestSeries(1, 'Firefox', 2, 'WINNT 6.1', 3, 'some test')
+        source = GraphAPISource(self.baseurl, HTTPCache(self.cache_dir, self.pool, ttl=60))
+        data = source.getTestData(series)
+        self.assertEqual(len(data), 128)
+        self.assertEqual(data, load_test_runs(open('test_data/runs1.json')).perfData())
+        self.assertEqual(source.getTestData(series), data)
+        self.assertEqual(len(self.server.requests), 1)
+
+        series.test_id = 4
+        self.assertEqual(source.getTestData(series), [])
+
+    def test_from_config(self):
+        config = RawConfigParser()
+        config.add_section('main')
+        config.add_section('cache')
+        config.set('main', 'base_graph_url', 'http://graphs')
+        config.set('cache', 'http_cache', self.cache_dir)
+        source = GraphAPISource.from_config(config)
+        self.assertEqual(source.baseurl, 'http://graphs/api')
+        self.assertEqual(source.http.cache_dir, self.cache_dir)
+
+
+if __name__ == '__main__':
+    unittest.main()
+
+class TestSeriesCatalog(unittest.TestCase):
+    tests = {
+        'stat': 'ok',
+        'branchMap': {'1': {'name': 'Firefox'}, '2': {'name': 'Try'}, '3': {'name': 'Birch'}},
+        'platformMap': {'10': {'name': 'WINNT 6.1'}, '11': {'name': 'Linux'}},
+        'testMap': {
+            '100': {'name': 'Tp5', 'branchIds': [1, 2, 3, 1, 4], 'platformIds': [10, 11, 12]},
+            '101': {'name': 'Ts', 'branchIds': [1], 'platformIds': [11]},
+            '102': {'name': 'Ts NoChrome', 'branchIds': [1], 'platformIds': [10, 11]},
+            '103': {'name': 'Ts Fast Cycle', 'branchIds': [1], 'platformIds': [10, 11]},
+            },
+        }
+
+    def test_series_from_tests(self):
+        source = GraphAPISource(None)
+        series = source.seriesFromTests(self.tests, ['Firefox', 'Birch'], [])
+        self.assertEqual(sorted((s.branch_name, s.os_name, s.test_name) for s in series), [
+            ('Birch', 'Linux', 'Tp5'), ('Birch', 'WINNT 6.1', 'Tp5'),
+            ('Firefox', 'Linux', 'Tp5'), ('Firefox', 'Linux', 'Ts'),
+            ('Firefox', 'WINNT 6.1', 'Tp5'),
+            ])
+        self.assertEqual(len(source.seriesFromTests(self.tests, ['Firefox'], ['Ts'])), 1)
+
+    def test_find(self):
+        series = GraphAPISource(None).seriesFromTests(self.tests, ['Firefox', 'Try', 'Birch'], [])
+        catalog = SeriesCatalog(series + series[:2])
+        self.assertEqual(len(catalog), len(series))
+        self.assertEqual(catalog.names('branch_name'), ['Birch', 'Firefox', 'Try'])
+        self.assertEqual(catalog.find(), series)
+        self.assertEqual(catalog.find(branch_name='Firefox'),
+                         [s for s in series if s.branch_name == 'Firefox'])
+        self.assertEqual([(s.branch_name, s.test_name) for s in
+                          catalog.find(os_name='Linux', test_name='Ts')],
+                         [('Firefox', 'Ts')])
+        self.assertEqual(catalog.find(branch_name='Try', test_name='Ts'), [])
+        self.assertEqual(catalog.find(branch_name='Nope'), [])
+        self.assertTrue(series[0] in catalog)
+
+
+if __name__ == '__main__':
+    unittest.main()
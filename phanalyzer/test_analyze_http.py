@@ -0,0 +1,182 @@
+# This Source Code Form is subject to the terms of the Mozilla Public
+# License, v. 2.0. If a copy of the MPL was not distributed with this file,
+# You can obtain one at http://mozilla.org/MPL/2.0/.
+import unittest
+import gzip
+import hashlib
+import os
+import shutil
+import tempfile
+import threading
+from BaseHTTPServer import HTTPServer, BaseHTTPRequestHandler
+from SocketServer import ThreadingMixIn
+from ConfigParser import RawConfigParser
+from cStringIO import StringIO
+
+from analyze_http import ConnectionPool, HTTPCache, RateLimited, UrlShortener
+
+class TestUrlShortener(unittest.TestCase):
+    def test_shorten(self):
+        requests = []
+        def shorten(url):
+            requests.append(url)
+            if len(requests) == 2:
+                raise RateLimited("RATE_LIMIT_EXCEEDED")
+            return url.replace("long", "short")
+
+        cache_dir = tempfile.mkdtemp()
+        try:
+            filename = os.path.join(cache_dir, 'short_urls.json')
+            shortener = UrlShortener(shorten, filename, rate=100, timeout=5)
+            shortener.RATE_LIMIT_PAUSE = 0.1
+            shortener.prefetch(["http://long/1", "http://long/2"])
+            self.assertEqual(shortener.shorten("http://long/2"), "http://short/2")
+            self.assertEqual(shortener.shorten("http://long/1"), "http://short/1")
+            self.assertEqual(requests, ["http://long/1", "http://long/2", "http://long/2"])
+            shortener.save()
+
+            shortener = UrlShortener(shorten, filename)
+            shortener.load()
+            self.assertEqual(shortener.shorten("http://long/1"), "http://short/1")
+            self.assertEqual(len(requests), 3)
+        finally:
+            shutil.rmtree(cache_dir)
+
+    def test_timeout(self):
+        shortener = UrlShortener(lambda url: url.replace("long", "short"), rate=1, burst=1)
+        self.assertEqual(shortener.shorten("http://long/1"), "http://short/1")
+        # The next one has to wait a second, which is more than we'll give it
+        self.assertEqual(shortener.shorten("http://long/2", timeout=0.1), "http://long/2")
+        self.assertEqual(shortener.shorten("http://long/2", timeout=5), "http://short/2")
+
+class FakeGraphAPIHandler(BaseHTTPRequestHandler):
+    """Serves the documents in `server.docs` by path, with ETags, gzipped
+    if the client asks for it."""
+    protocol_version = "HTTP/1.1"
+
+    def do_GET(self):
+        self.server.requests.append((self.path, self.headers.get('If-None-Match')))
+        body = self.server.docs[self.path]
+        etag = '"%s"' % hashlib.md5(body).hexdigest()
+        if self.headers.get('If-None-Match') == etag:
+            self.send_response(304)
+            self.send_header("Content-Length", "0")
+            self.end_headers()
+            return
+
+        self.send_response(200)
+        self.send_header("ETag", etag)
+        if 'gzip' in self.headers.get('Accept-Encoding', ''):
+            buf = StringIO()
+            f = gzip.GzipFile(fileobj=buf, mode="wb")
+            f.write(body)
+            f.close()
+            body = buf.getvalue()
+            self.send_header("Content-Encoding", "gzip")
+        self.send_header("Content-Length", str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def log_message(self, *args):
+        pass
+
+class FakeHTTPServer(ThreadingMixIn, HTTPServer):
+    daemon_threads = True
+
+class TestHTTPCache(unittest.TestCase):
+    def setUp(self):
+        self.server = FakeHTTPServer(('127.0.0.1', 0), FakeGraphAPIHandler)
+        self.server.requests = []
+        self.server.docs = {
+            '/api/test/runs?id=3&branchid=1&platformid=2': open('test_data/runs1.json').read(),
+            '/api/test/runs?id=4&branchid=1&platformid=2': open('test_data/runs3.json').read(),
+            '/api/test/runs?id=5&branchid=1&platformid=2': open('test_data/runs4.json').read()[:2000],
+            }
+        self.thread = threading.Thread(target=self.server.serve_forever)
+        self.thread.start()
+        self.baseurl = "http://127.0.0.1:%i/api" % self.server.server_address[1]
+        self.pool = ConnectionPool()
+        self.cache_dir = tempfile.mkdtemp()
+
+    def tearDown(self):
+        self.pool.close()
+        self.server.shutdown()
+        self.thread.join()
+        self.server.server_close()
+        shutil.rmtree(self.cache_dir)
+
+    def url(self, test_id=3):
+        return "%s/test/runs?id=%i&branchid=1&platformid=2" % (self.baseurl, test_id)
+
+    def test_ttl(self):
+        body = HTTPCache(self.cache_dir, self.pool, ttl=60).get(self.url())
+        self.assertEqual(body, open('test_data/runs1.json').read())
+        cache = HTTPCache(self.cache_dir, self.pool, ttl=60)
+        self.assertEqual(cache.get(self.url()), body)
+        # Cached bodies are decompressed as they're read
+        fp = cache.open(self.url())
+        self.assertTrue(isinstance(fp, gzip.GzipFile))
+        self.assertEqual(fp.read(), body)
+        self.assertEqual(len(self.server.requests), 1)
+
+    def test_revalidate(self):
+        cache = HTTPCache(self.cache_dir, self.pool, ttl=0)
+        body = cache.get(self.url())
+        self.assertEqual(cache.get(self.url()), body)
+        self.assertEqual(self.server.requests[0][1], None)
+        self.assertNotEqual(self.server.requests[1][1], None)
+
+        path = self.server.requests[0][0]
+        self.server.docs[path] = open('test_data/runs5.json').read()
+        self.assertEqual(cache.get(self.url()), self.server.docs[path])
+        self.assertEqual(len(self.server.requests), 3)
+
+    def test_evict(self):
+        cache = HTTPCache(self.cache_dir, self.pool, max_size=16000)
+        cache.get(self.url(3))
+        cache.get(self.url(4))
+        # Both bodies don't fit, so the first one is gone
+        cache.get(self.url(4))
+        cache.get(self.url(3))
+        self.assertEqual([r[0].split("&")[0][-4:] for r in self.server.requests],
+                         ["id=3", "id=4", "id=3"])
+
+    def test_evict_running_total(self):
+        cache = HTTPCache(self.cache_dir, self.pool, max_size=16000)
+        evicted = []
+        evict = cache.evict
+        def counting_evict():
+            evicted.append(True)
+            evict()
+        cache.evict = counting_evict
+        # Only the first body makes it look at what's in the cache, and the
+        # second one because it goes over max_size
+        cache.get(self.url(3))
+        cache.get(self.url(5))
+        self.assertEqual(len(evicted), 1)
+        cache.get(self.url(4))
+        self.assertEqual(len(evicted), 2)
+        self.assertEqual(cache._size, sum(os.path.getsize(os.path.join(self.cache_dir, fn))
+                                          for fn in os.listdir(self.cache_dir)
+                                          if fn.endswith(".gz")))
+
+    def test_from_config(self):
+        config = RawConfigParser()
+        config.add_section('cache')
+        cache = HTTPCache.from_config(config, self.pool)
+        self.assertEqual((cache.cache_dir, cache.ttl), (None, 1800))
+        config.set('cache', 'http_cache', self.cache_dir)
+        config.set('cache', 'http_cache_ttl', '60')
+        config.set('cache', 'http_cache_size', '2')
+        cache = HTTPCache.from_config(config, self.pool)
+        self.assertEqual((cache.cache_dir, cache.ttl, cache.max_size),
+                         (self.cache_dir, 60, 2 * 1024 * 1024))
+
+    def test_no_cache(self):
+        cache = HTTPCache(pool=self.pool)
+        self.assertEqual(cache.get(self.url()), cache.get(self.url()))
+        self.assertEqual(len(self.server.requests), 2)
+
+
+if __name__ == '__main__':
+    unittest.main()
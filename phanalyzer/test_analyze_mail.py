@@ -0,0 +1,88 @@
+# This Source Code Form is subject to the terms of the Mozilla Public
+# License, v. 2.0. If a copy of the MPL was not distributed with this file,
+# You can obtain one at http://mozilla.org/MPL/2.0/.
+import unittest
+import asyncore
+import os
+import shutil
+import smtpd
+import smtplib
+import tempfile
+import threading
+
+from analyze_mail import Outbox
+
+class FakeSMTPServer(smtpd.SMTPServer):
+    def __init__(self):
+        smtpd.SMTPServer.__init__(self, ('127.0.0.1', 0), None)
+        self.port = self.socket.getsockname()[1]
+        self.received = []
+        self.connections = 0
+
+    def handle_accept(self):
+        self.connections += 1
+        smtpd.SMTPServer.handle_accept(self)
+
+    def process_message(self, peer, mailfrom, rcpttos, data):
+        self.received.append((mailfrom, rcpttos, data))
+
+class TestOutbox(unittest.TestCase):
+    def setUp(self):
+        self.server = FakeSMTPServer()
+        self.thread = threading.Thread(target=asyncore.loop, kwargs={'timeout': 0.1})
+        self.thread.start()
+        self.spool_dir = tempfile.mkdtemp()
+
+    def tearDown(self):
+        self.server.close()
+        self.thread.join()
+        shutil.rmtree(self.spool_dir)
+
+    def test_deliver(self):
+        outbox = Outbox(self.spool_dir, port=self.server.port)
+        outbox.add('from@x', 'Regression', 'body 1', ['a@x', 'b@x'], {'In-Reply-To': '<1>'})
+        outbox.add('from@x', 'Regression', 'body 1', ['b@x', 'c@x'], {'In-Reply-To': '<1>'})
+        outbox.add('from@x', 'Regression', 'body 2', ['a@x'])
+
+        # A run that dies before delivering leaves everything in the spool
+        outbox = Outbox(self.spool_dir, port=self.server.port)
+        outbox.deliver()
+        self.assertEqual([r[:2] for r in self.server.received],
+                         [('from@x', ['a@x', 'b@x', 'c@x']), ('from@x', ['a@x'])])
+        self.assertTrue('In-Reply-To: <1>' in self.server.received[0][2])
+        self.assertEqual(self.server.connections, 1)
+        self.assertEqual(os.listdir(self.spool_dir), [])
+
+        outbox.deliver()
+        self.assertEqual(len(self.server.received), 2)
+
+    def test_died_while_sending(self):
+        outbox = Outbox(self.spool_dir, port=self.server.port)
+        outbox.add('from@x', 'Regression', 'body 1', ['a@x'])
+        outbox.add('from@x', 'Regression', 'body 2', ['a@x'])
+
+        # A run that died in the middle of sending the first message
+        first = outbox.pending()[0]
+        os.rename(outbox._filename(first), outbox._filename(first, ".sending"))
+
+        # It may have gone out, so it isn't sent again, but it's kept
+        outbox = Outbox(self.spool_dir, port=self.server.port)
+        outbox.deliver()
+        self.assertEqual([r[2].split("\n")[-1] for r in self.server.received], ['body 2'])
+        self.assertEqual(os.listdir(self.spool_dir),
+                         [os.path.basename(outbox._filename(first, ".unconfirmed"))])
+        outbox.deliver()
+        self.assertEqual(len(self.server.received), 1)
+
+    def test_refused(self):
+        outbox = Outbox(self.spool_dir, port=self.server.port)
+        outbox.add('from@x', 'Regression', 'body 1', ['a@x'])
+        # smtpd sends back what process_message returns
+        self.server.process_message = lambda *args: "554 Refused"
+        self.assertRaises(smtplib.SMTPDataError, outbox.deliver)
+        # A message that didn't go out is still spooled to be sent
+        self.assertEqual([fn[-5:] for fn in os.listdir(self.spool_dir)], ['.json'])
+
+
+if __name__ == '__main__':
+    unittest.main()
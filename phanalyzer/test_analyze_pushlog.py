@@ -0,0 +1,186 @@
+# This Source Code Form is subject to the terms of the Mozilla Public
+# License, v. 2.0. If a copy of the MPL was not distributed with this file,
+# You can obtain one at http://mozilla.org/MPL/2.0/.
+import unittest
+import json
+import os
+import shutil
+import tempfile
+import threading
+import urlparse
+from BaseHTTPServer import HTTPServer, BaseHTTPRequestHandler
+from SocketServer import ThreadingMixIn
+from time import time
+
+from analyze_pushlog import PushLog
+
+class FakePushLogHandler(BaseHTTPRequestHandler):
+    """Serves json-pushes for the pushes in `server.pushes`."""
+    protocol_version = "HTTP/1.1"
+
+    def do_GET(self):
+        self.server.requests.append(self.path)
+        self.server.connections.add(self.client_address)
+        if self.server.fail_next:
+            self.server.fail_next -= 1
+            return self.respond(503, "try again later")
+
+        args = urlparse.parse_qs(urlparse.urlsplit(self.path).query)
+        result = {}
+        if 'fromchange' in args:
+            first = self.push_id(args['fromchange'][0])
+            last = self.push_id(args['tochange'][0])
+            for push_id in range(first + 1, last + 1):
+                result[str(push_id)] = self.server.pushes[str(push_id)]
+            return self.respond(200, json.dumps(result))
+        if 'startID' in args:
+            for push_id in range(int(args['startID'][0]) + 1, int(args['endID'][0]) + 1):
+                result[str(push_id)] = self.server.pushes[str(push_id)]
+            return self.respond(200, json.dumps(result))
+
+        for c in args['changeset']:
+            for push_id, push in self.server.pushes.items():
+                if push['changesets'][0]['node'].startswith(c):
+                    result[push_id] = push
+                    break
+            else:
+                return self.respond(404, "unknown revision '%s'" % c)
+        self.respond(200, json.dumps(result))
+
+    def push_id(self, rev):
+        for push_id, push in self.server.pushes.items():
+            if push['changesets'][0]['node'].startswith(rev):
+                return int(push_id)
+
+    def respond(self, code, body):
+        self.send_response(code)
+        self.send_header("Content-Length", str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def log_message(self, *args):
+        pass
+
+class FakeHTTPServer(ThreadingMixIn, HTTPServer):
+    daemon_threads = True
+
+class TestPushLog(unittest.TestCase):
+    def setUp(self):
+        self.server = FakeHTTPServer(('127.0.0.1', 0), FakePushLogHandler)
+        self.server.requests = []
+        self.server.connections = set()
+        self.server.fail_next = 0
+        self.server.pushes = {}
+        for i in range(120):
+            self.server.pushes[str(i)] = {
+                'date': 1000 + i,
+                'user': 'pusher',
+                'changesets': [{'node': "%012x" % i + "0" * 28, 'desc': 'change %i' % i, 'author': 'author'}],
+                }
+        self.thread = threading.Thread(target=self.server.serve_forever)
+        self.thread.start()
+
+        self.tmpdir = tempfile.mkdtemp()
+        self.pushlog = self.create_pushlog()
+
+    def tearDown(self):
+        self.pushlog.http.close()
+        self.server.shutdown()
+        self.thread.join()
+        self.server.server_close()
+        shutil.rmtree(self.tmpdir)
+
+    def create_pushlog(self, filename='pushlog.sqlite'):
+        pushlog = PushLog(os.path.join(self.tmpdir, filename),
+                          "http://127.0.0.1:%i" % self.server.server_port)
+        pushlog.http.backoff = 0
+        pushlog.load()
+        return pushlog
+
+    def test_getPushDates(self):
+        revs = ["%012x" % i for i in range(120)] + ["%012x" % 1000]
+        self.server.fail_next = 1
+        dates = self.pushlog.getPushDates('b', 'repo', revs)
+        self.assertEqual(dates, dict(("%012x" % i, 1000 + i) for i in range(120)))
+        self.assertTrue("%012x" % 1000 in self.pushlog.new_missing['b'])
+        # Connections were reused
+        self.assertTrue(len(self.server.connections) < len(self.server.requests))
+
+        # Everything is cached now, including the unknown revision, and
+        # still is after saving and loading again
+        count = len(self.server.requests)
+        self.assertEqual(self.pushlog.getPushDates('b', 'repo', revs), dates)
+        self.pushlog.save()
+        pushlog = self.create_pushlog()
+        self.assertEqual(pushlog.getPushDates('b', 'repo', revs), dates)
+        self.assertEqual(pushlog.getPushDates('other', 'repo', []), {})
+        self.assertEqual(len(self.server.requests), count)
+
+    def test_getPushRange(self):
+        revs = self.pushlog.getPushRange('b', 'repo', "%012x" % 10, "%012x" % 15)
+        self.assertEqual(revs, ["%012x" % i for i in range(11, 16)])
+        self.assertEqual(self.pushlog.getChange('b', revs[0])['comments'], 'change 11')
+
+        count = len(self.server.requests)
+        self.pushlog.save()
+        pushlog = self.create_pushlog()
+        self.assertEqual(pushlog.getPushRange('b', 'repo', "%012x" % 10, "%012x" % 15), revs)
+        self.assertEqual(pushlog.getChange('b', revs[-1])['date'], 1015)
+        self.assertEqual(len(self.server.requests), count)
+
+    def test_prefetchRanges(self):
+        self.pushlog.getPushDates('b', 'repo', ["%012x" % i for i in range(0, 120, 10)])
+        self.pushlog.getPushDates('b', 'repo', ["%012x" % i for i in range(31, 35)])
+        self.pushlog.save()
+
+        self.server.requests = []
+        ranges = [("%012x" % 10, "%012x" % 40), ("%012x" % 20, "%012x" % 50)]
+        self.pushlog.prefetchRanges('b', 'repo', ranges)
+        # Only the pushes we didn't have were fetched, once each
+        self.assertEqual(sorted(self.server.requests), sorted(
+            ["/repo/json-pushes?full=1&startID=%i&endID=%i" % (a - 1, b)
+             for a, b in [(11, 19), (21, 29), (35, 39), (41, 49)]]))
+
+        self.server.requests = []
+        for from_, to_ in ranges:
+            self.assertEqual(self.pushlog.getPushRange('b', 'repo', from_, to_),
+                             ["%012x" % i for i in range(int(from_, 16) + 1, int(to_, 16) + 1)])
+        self.assertEqual(self.server.requests, [])
+
+    def test_import_json(self):
+        pushes = {'b': {
+            "%012x" % 1: {'date': 1001, 'comments': 'change 1', 'author': 'a', 'pusher': 'p'},
+            'ranges': {"a-b": []},
+            'missing': {"%012x" % 1000: time()},
+            }}
+        json.dump(pushes, open(os.path.join(self.tmpdir, 'pushlog.json'), 'w'))
+
+        pushlog = self.create_pushlog('pushlog.json')
+        self.assertEqual(pushlog.filename, os.path.join(self.tmpdir, 'pushlog.sqlite'))
+        self.assertEqual(pushlog.getPushDates('b', 'repo', ["%012x" % 1, "%012x" % 1000]),
+                         {"%012x" % 1: 1001})
+        self.assertEqual(pushlog.getChange('b', "%012x" % 1)['author'], 'a')
+        self.assertEqual(self.server.requests, [])
+
+    def test_import_json_upgrade(self):
+        # The config names the new database, but only the old JSON file is
+        # there yet
+        pushes = {'b': {"%012x" % 1: {'date': 1001, 'comments': 'change 1',
+                                      'author': 'a', 'pusher': 'p'}}}
+        json.dump(pushes, open(os.path.join(self.tmpdir, 'pushlog.json'), 'w'))
+
+        pushlog = self.create_pushlog('cache.sqlite')
+        self.assertEqual(pushlog.getPushDates('b', 'repo', ["%012x" % 1]), {"%012x" % 1: 1001})
+        self.assertEqual(self.server.requests, [])
+
+        # Once the database has something in it, the JSON file is left alone
+        pushlog.http.close()
+        pushes['b']["%012x" % 1]['date'] = 2002
+        json.dump(pushes, open(os.path.join(self.tmpdir, 'pushlog.json'), 'w'))
+        pushlog = self.create_pushlog('cache.sqlite')
+        self.assertEqual(pushlog.getPushDates('b', 'repo', ["%012x" % 1]), {"%012x" % 1: 1001})
+        pushlog.http.close()
+
+
+if __name__ == '__main__':
+    unittest.main()
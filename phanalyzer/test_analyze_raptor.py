@@ -0,0 +1,210 @@
+# This Source Code Form is subject to the terms of the Mozilla Public
+# License, v. 2.0. If a copy of the MPL was not distributed with this file,
+# You can obtain one at http://mozilla.org/MPL/2.0/.
+import unittest
+import json
+import logging
+import os
+import re
+import shutil
+import tempfile
+import threading
+import urlparse
+from BaseHTTPServer import HTTPServer, BaseHTTPRequestHandler
+from SocketServer import ThreadingMixIn
+
+try:
+    import analyze_raptor
+    from influxdb.influxdb08 import InfluxDBClient
+except ImportError:
+    analyze_raptor = None
+
+class FakeInfluxDBHandler(BaseHTTPRequestHandler):
+    """Answers the queries analyze_raptor makes, like the InfluxDB 0.8 http
+    api would, from the (events, points) in `server.configs` for the
+    query's device, branch and memory."""
+
+    def do_GET(self):
+        query = urlparse.parse_qs(urlparse.urlsplit(self.path).query)['q'][0]
+        self.server.queries.append(query)
+        config = re.search("device='(.*?)' and branch='(.*?)' and memory='(.*?)'", query).groups()
+        if config[0] == 'broken':
+            self.send_response(500)
+            self.send_header("Content-Length", "0")
+            self.end_headers()
+            return
+        events, all_points = self.server.configs.get(config, ({}, {}))
+        if "from events" in query:
+            since = re.search(r"time > (\d+)s", query)
+            since = int(since.group(1)) if since else 0
+            result = [{"name": "events", "columns": ["time", "sequence_number", "text"],
+                       "points": [[t, 1, text] for t, text in sorted(events.items())
+                                  if t > since]}]
+        elif "appName, context" in query:
+            points = []
+            for (app, context), app_points in sorted(all_points.items()):
+                points.extend([t, v, app, context] for t, v in app_points)
+            # Not sorted by time, which is up to the client
+            points.reverse()
+            result = [{"name": "coldlaunch.visuallyLoaded",
+                       "columns": ["time", "percentile", "appName", "context"],
+                       "points": points}]
+        else:
+            app, context = re.search("appName = '(.*)' and context = '(.*?)'", query).groups()
+            app_points = all_points.get((app, context))
+            result = []
+            if app_points:
+                result = [{"name": "coldlaunch.visuallyLoaded",
+                           "columns": ["time", "percentile"],
+                           "points": [[t, v] for t, v in app_points]}]
+
+        body = json.dumps(result)
+        self.send_response(200)
+        self.send_header("Content-Type", "application/json")
+        self.send_header("Content-Length", str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def log_message(self, *args):
+        pass
+
+class FakeHTTPServer(ThreadingMixIn, HTTPServer):
+    daemon_threads = True
+
+@unittest.skipIf(analyze_raptor is None, "influxdb isn't installed")
+class TestRaptor(unittest.TestCase):
+    def setUp(self):
+        self.server = FakeHTTPServer(('127.0.0.1', 0), FakeInfluxDBHandler)
+        self.server.queries = []
+        self.server.configs = {}
+        self.server.events, self.server.points = self.add_config(('flame-kk', 'master', '319'), 20)
+        self.thread = threading.Thread(target=self.server.serve_forever)
+        self.thread.start()
+        self.client = InfluxDBClient('127.0.0.1', self.server.server_address[1],
+                                     'user', 'pass', 'raptor')
+
+    def add_config(self, config, regression_at):
+        """Makes up data for `config`, with Clock regressing at the
+        `regression_at`th point."""
+        events = {}
+        points = {}
+        for i in range(40):
+            t = 1000 + i
+            events[t] = "Gaia: gaia%i<br/>Gecko: gecko%i" % (i, i)
+            noise = (i % 3) * 0.5
+            points.setdefault(('Clock', 'clock.gaiamobile.org'), []).append(
+                (t, (100 if i < regression_at else 150) + noise))
+            points.setdefault(('Phone', 'communications.gaiamobile.org'), []).append(
+                (t, 200 + noise))
+        self.server.configs[config] = (events, points)
+        return events, points
+
+    def tearDown(self):
+        self.server.shutdown()
+        self.thread.join()
+        self.server.server_close()
+
+    def test_get_results(self):
+        apps = ['clock', 'phone', 'contacts']
+        results = analyze_raptor.get_results(self.client, apps, jobs=2)
+        # The revision info, then every app's data at once
+        self.assertEqual(len(self.server.queries), 2)
+
+        self.assertEqual(sorted(results), sorted(apps))
+        self.assertEqual([a['gaia_revision'] for a in results['clock']], ['gaia20'])
+        self.assertEqual(results['clock'][0]['prev_gecko_revision'], 'gecko19')
+        self.assertEqual(results['phone'], [])
+        self.assertEqual(results['contacts'], [])
+
+        # Same answers as querying each app on its own
+        revinfo = analyze_raptor.get_revinfo(self.client)
+        for appname, context, app in (('Clock', 'clock.gaiamobile.org', 'clock'),
+                                      ('Phone', 'communications.gaiamobile.org', 'phone'),
+                                      ('Contacts', 'communications.gaiamobile.org', 'contacts')):
+            self.assertEqual(analyze_raptor.get_alerts(self.client, revinfo, appname, context),
+                             results[app])
+
+        self.assertEqual(analyze_raptor.get_results(self.client, apps, jobs=1), results)
+
+    def test_nearest_event(self):
+        # Points between events belong to the revisions of the event before
+        for t in range(1001, 1040, 2):
+            del self.server.events[t]
+        results = analyze_raptor.get_results(self.client, ['clock'], jobs=1)
+        self.assertEqual([(a['gaia_revision'], a['prev_gaia_revision']) for a in results['clock']],
+                         [('gaia20', 'gaia18')])
+
+        revinfo = analyze_raptor.get_revinfo(self.client)
+        self.assertEqual(revinfo.lookup(999), None)
+        self.assertEqual(revinfo.lookup(1000), ('gaia0', 'gecko0'))
+        self.assertEqual(revinfo.lookup(1003), ('gaia2', 'gecko2'))
+        self.assertEqual(revinfo.lookup(5000), ('gaia38', 'gecko38'))
+
+    def test_revinfo_cache(self):
+        tmpdir = tempfile.mkdtemp()
+        try:
+            filename = os.path.join(tmpdir, 'revinfo.json')
+            cache = analyze_raptor.RevInfoCache(filename)
+            self.assertEqual(len(analyze_raptor.get_revinfo(self.client, cache)), 40)
+            self.server.events[1040] = "Gaia: gaia40<br/>Gecko: gecko40"
+            revinfo = analyze_raptor.get_revinfo(self.client, cache)
+            self.assertEqual(len(revinfo), 41)
+            self.assertTrue("time > 1039s" in self.server.queries[-1])
+            cache.save()
+
+            cache = analyze_raptor.RevInfoCache(filename)
+            cache.load()
+            other = analyze_raptor.get_revinfo(self.client, cache, device='other')
+            self.assertTrue("time > now() - 7d" in self.server.queries[-1])
+            self.assertEqual(sorted(cache.configs), ['flame-kk/master/319', 'other/master/319'])
+            self.assertEqual(analyze_raptor.get_revinfo(self.client, cache).revisions,
+                             revinfo.revisions)
+            self.assertTrue("time > 1040s" in self.server.queries[-1])
+        finally:
+            shutil.rmtree(tmpdir)
+
+    def test_sweep(self):
+        configs = [('flame-kk', 'master', '319'), ('flame-kk', 'v2.2', '319'),
+                   ('flame-kk', 'master', '512')]
+        self.add_config(configs[1], 15)
+        self.add_config(configs[2], 25)
+        cache = analyze_raptor.RevInfoCache()
+        results = analyze_raptor.get_sweep_results(self.client, configs, ['clock', 'phone'],
+                                                   jobs=2, revinfo_cache=cache)
+        self.assertEqual(len(self.server.queries), 2 * len(configs))
+        self.assertEqual([(r['device'], r['branch'], r['memory']) for r in results], configs)
+        self.assertEqual([[a['gaia_revision'] for a in r['results']['clock']] for r in results],
+                         [['gaia20'], ['gaia15'], ['gaia25']])
+        self.assertEqual([r['results']['phone'] for r in results], [[], [], []])
+        self.assertEqual(len(cache.configs), 3)
+
+        for config, result in zip(configs, results):
+            device, branch, memory = config
+            self.assertEqual(analyze_raptor.get_results(self.client, ['clock', 'phone'], jobs=1,
+                                                        device=device, branch=branch, memory=memory),
+                             result['results'])
+
+    def test_sweep_error(self):
+        configs = [('broken', 'master', '319'), ('flame-kk', 'master', '319')]
+        logging.disable(logging.ERROR)
+        try:
+            results = analyze_raptor.get_sweep_results(self.client, configs, ['clock'], jobs=1)
+        finally:
+            logging.disable(logging.NOTSET)
+        # The configuration that couldn't be fetched doesn't stop the others
+        self.assertEqual(results[0]['results'], {})
+        self.assertTrue(results[0]['error'])
+        self.assertFalse('error' in results[1])
+        self.assertEqual([a['gaia_revision'] for a in results[1]['results']['clock']], ['gaia20'])
+
+    def test_prune(self):
+        revinfo = analyze_raptor.RevInfo()
+        for day in range(10):
+            revinfo.add(day * 86400, 'gaia%i' % day, 'gecko%i' % day)
+        revinfo.prune(7)
+        # Day 2 is the last event before the window starts
+        self.assertEqual(revinfo.timestamps[0], 2 * 86400)
+        self.assertEqual(revinfo.lookup(3 * 86400 - 1), ('gaia2', 'gecko2'))
+
+if __name__ == '__main__':
+    unittest.main()
@@ -2,12 +2,56 @@
 # License, v. 2.0. If a copy of the MPL was not distributed with this file,
 # You can obtain one at http://mozilla.org/MPL/2.0/.
 import unittest
+import json
+import os
+import shutil
+import tempfile
 
-from analyze import PerfDatum
-from analyze_talos import *
+from analyze import PerfDatum, TalosAnalyzer
+from analyze_cache import SeriesCache, BugCache, WarningStore
+import analyze_cache
+import analyze_talos
+from analyze_talos import AnalysisRunner, get_config, parse_options
 from ConfigParser import RawConfigParser
 from time import time
 
+class FakeSeries:
+    def __init__(self, branch_id=1, os_id=2, test_id=3):
+        self.branch_id = branch_id
+        self.branch_name = 'Firefox'
+        self.os_id = os_id
+        self.os_name = 'WINNT 6.1'
+        self.test_id = test_id
+        self.test_name = 'some test'
+
+class FakeSource:
+    def __init__(self, data):
+        self.data = data
+        self.fetched = []
+
+    def getTestData(self, series, start_time, data_type):
+        if isinstance(self.data, dict):
+            data = self.data[series.test_id]
+        else:
+            data = self.data
+        retval = [PerfDatum.from_dict(d.to_dict()) for d in data
+                  if d.testrun_timestamp > start_time]
+        self.fetched.append(len(retval))
+        return retval
+
+    def getTestSeries(self, branches, start_date, test_names, last_run=None):
+        return [FakeSeries(test_id=test_id) for test_id in sorted(self.data)]
+
+class FakeBulkSource(FakeSource):
+    def __init__(self, data):
+        FakeSource.__init__(self, data)
+        self.queries = []
+
+    def getTestDataForSeries(self, series_list, start_time, data_type):
+        self.queries.append((start_time, sorted(s.test_id for s in series_list)))
+        for s in sorted(series_list, key=lambda s: (s.branch_id, s.os_id, s.test_id)):
+            yield s, self.getTestData(s, start_time, data_type)
+
 class TestAnalysisRunner(unittest.TestCase):
     def create_runner(self):
         options, args = parse_options(['--start-time', '0'])
@@ -41,6 +85,14 @@ class TestAnalysisRunner(unittest.TestCase):
         self.assertEqual(results[4], (data[4], False, data[3]))
         self.assertEqual(results[5], (data[5], False, data[5]))
 
+        # The second time around, the warnings have already been sent
+        warnings = runner.warning_history.series('b', 'o', 't')
+        first = runner.processSeries(data, warnings)
+        second = runner.processSeries(data, warnings)
+        self.assertEqual([skip for d, skip, last_good in first], [False] * 8)
+        self.assertEqual([skip for d, skip, last_good in second],
+                         [d.state != 'good' for d in data])
+
     def test_isTestReversed(self):
         runner = self.create_runner()
 
@@ -73,6 +125,28 @@ class TestAnalysisRunner(unittest.TestCase):
         self.assertFalse(runner.ignorePercentageForTest('LibXUL something else'))
         self.assertFalse(runner.ignorePercentageForTest('V8'))
 
+    def test_skipSeries(self):
+        options, args = parse_options(['--start-time', '0'])
+        options.config = 'analysis.cfg.template'
+        config = get_config(options)
+        config.set('Firefox', 'ignore_tests', 'Tp5, ,^Ts$')
+        runner = AnalysisRunner(options, config, 'average')
+
+        s = FakeSeries()
+        self.assertFalse(runner.skipSeries(s))
+        self.assertEqual(s.os_name, 'Win7')
+        for test_name, skip in (('Nokia 1', True), ('Tp5 (RSS)', True), ('Ts', True),
+                                ('Ts Paint', False), ('Tp4', False)):
+            s.test_name = test_name
+            self.assertEqual(runner.skipSeries(s), skip)
+        s.branch_name = 'Other'
+        s.test_name = 'Tp5'
+        self.assertFalse(runner.skipSeries(s))
+
+        self.assertTrue(runner.isDashboardSeries(FakeSeries()) is False)
+        s.test_name = 'Ts, Cold'
+        self.assertTrue(runner.isDashboardSeries(s))
+
     def test_shouldSendWarning(self):
         runner = self.create_runner()
         d = PerfDatum(0, 0, time() + 0, 0.0, 0, 0)
@@ -98,6 +172,273 @@ class TestAnalysisRunner(unittest.TestCase):
         d.forward_stats = { 'avg': 101.0 }
         self.assertTrue(runner.shouldSendWarning(d, 'LibXUL Memory during link'))
 
+    def get_series_data(self):
+        start = time() - 3*24*3600
+        data = []
+        for i in range(60):
+            value = 10.0 + (i % 2) * 0.5
+            if i >= 30:
+                value += 5.0
+            data.append(PerfDatum(start + i*60, value, start + i*60,
+                                  testrun_id=i+1, machine_id=i % 3))
+        return data
+
+    def test_analyzeNewData(self):
+        cache_dir = tempfile.mkdtemp()
+        try:
+            data = self.get_series_data()
+            s = FakeSeries()
+            states = {}
+
+            for n in (40, 50, 60):
+                runner = self.create_runner()
+                runner.config.set('cache', 'series_cache', cache_dir)
+                runner.updateTimes = lambda branch, data: None
+                runner._source = FakeSource(data[:n])
+                results, last_good, last_run = runner.analyzeNewData(s)
+                for d in results:
+                    # Each point is only reported once
+                    self.assertTrue(d.testrun_id not in states)
+                    states[d.testrun_id] = d.state
+                self.assertEqual(last_run, n)
+
+            # We got the same answers as analyzing everything in one go
+            a = TalosAnalyzer()
+            a.addData(data)
+            expected = [(d.testrun_id, d.state) for d in
+                        a.analyze_t(12, 12, 7, 15, 5)]
+            self.assertEqual([(i, states[i]) for i, _ in expected], expected)
+            self.assertEqual([i for i, state in expected if state == 'regression'], [31])
+
+            # All the final points were logged
+            logged = runner.series_cache.loadData(s)
+            self.assertEqual(sorted(d.testrun_id for d in logged), sorted(states))
+        finally:
+            shutil.rmtree(cache_dir)
+
+    def run_series(self, data, jobs, source_class=FakeSource, fetch_threads=2):
+        runner = self.create_runner()
+        runner.options.jobs = jobs
+        runner.fetch_threads = fetch_threads
+        runner.updateTimes = lambda branch, data: None
+        runner._source = source_class(data)
+        reported = []
+        def handleData(s, d, state, skip, last_good):
+            reported.append((s.test_id, d.testrun_id, state, skip))
+        runner.handleData = handleData
+        runner.run()
+        return reported, runner.warning_history, runner.last_run
+
+    def test_parallel_run(self):
+        data = {}
+        for test_id in range(6):
+            data[test_id] = self.get_series_data()
+            for d in data[test_id]:
+                d.testrun_id += 100 * test_id
+                d.value *= test_id + 1
+
+        serial = self.run_series(data, 1)
+        self.assertEqual(len([r for r in serial[0] if r[2] == 'regression']), 6)
+        self.assertEqual(self.run_series(data, 3), serial)
+
+    def test_bulk_fetch(self):
+        data = {}
+        for test_id in range(5):
+            data[test_id] = self.get_series_data()
+            for d in data[test_id]:
+                d.testrun_id += 100 * test_id
+
+        serial = self.run_series(data, 1)
+        self.assertEqual(self.run_series(data, 1, fetch_threads=0), serial)
+        old_size = analyze_talos.BULK_FETCH_SIZE
+        analyze_talos.BULK_FETCH_SIZE = 2
+        try:
+            self.assertEqual(self.run_series(data, 1, FakeBulkSource), serial)
+            self.assertEqual(self.run_series(data, 1, FakeBulkSource, 0), serial)
+        finally:
+            analyze_talos.BULK_FETCH_SIZE = old_size
+
+        runner = self.create_runner()
+        runner._source = FakeBulkSource(data)
+        fetched = list(runner.fetchSeriesData(runner.source.getTestSeries(None, None, None)))
+        self.assertEqual([s.test_id for s, d, state in fetched], range(5))
+        self.assertEqual(len(runner.source.queries), 1)
+
+    def test_fetch_start_times(self):
+        cache_dir = tempfile.mkdtemp()
+        try:
+            data = {}
+            for test_id in range(4):
+                data[test_id] = self.get_series_data()
+            runner = self.create_runner()
+            runner.config.set('cache', 'series_cache', cache_dir)
+            runner.updateTimes = lambda branch, data: None
+            runner._source = FakeBulkSource(data)
+            for test_id in (1, 2):
+                runner.analyzeNewData(FakeSeries(test_id=test_id))
+
+            # The cached series are fetched from where they left off, and
+            # only the others from the start time
+            series = runner.source.getTestSeries(None, None, None)
+            fetched = runner.fetchChunk(series)
+            last_time = data[1][-1].testrun_timestamp
+            self.assertEqual(runner.source.queries,
+                             [(0, [0, 3]), (last_time - analyze_talos.LATE_DATA_WINDOW, [1, 2])])
+            self.assertEqual([s.test_id for s, d, state in fetched], range(4))
+            self.assertEqual([state is not None for s, d, state in fetched],
+                             [False, True, True, False])
+
+            # The states that came with the data are the ones carried on from
+            runner.series_cache.load = None
+            for s, d, state in fetched:
+                results, last_good, last_run = runner.analyzeSeries(s, d, state)
+                self.assertEqual(last_run, 60)
+        finally:
+            shutil.rmtree(cache_dir)
+
+    def test_series_cache_params(self):
+        cache_dir = tempfile.mkdtemp()
+        try:
+            runner = self.create_runner()
+            runner.config.set('cache', 'series_cache', cache_dir)
+            runner.updateTimes = lambda branch, data: None
+            runner._source = FakeSource(self.get_series_data())
+            s = FakeSeries()
+            runner.analyzeNewData(s)
+
+            self.assertNotEqual(runner.series_cache.load(s), None)
+            self.assertEqual(runner.series_cache.load(FakeSeries(test_id=4)), None)
+
+            # Changing the analysis settings invalidates the cache
+            params = dict(runner.series_cache.params, fore_window=5)
+            self.assertEqual(SeriesCache(cache_dir, params).load(s), None)
+            self.assertEqual(runner.series_cache.load(s), None)
+        finally:
+            shutil.rmtree(cache_dir)
+
+    def test_bug_cache(self):
+        cache_dir = tempfile.mkdtemp()
+        try:
+            requests = []
+            def fetch(bug_nums):
+                requests.append(bug_nums)
+                return dict((b, {'id': int(b), 'summary': 'bug %s' % b, 'comments': []})
+                            for b in bug_nums if int(b) % 10)
+
+            filename = os.path.join(cache_dir, 'bugs.json')
+            bugs = BugCache(filename, fetch)
+            bugs.prefetch(range(1, 121))
+            self.assertEqual(len(requests), 3)
+            self.assertEqual(bugs.get(11), {'id': 11, 'summary': 'bug 11'})
+            self.assertEqual(bugs.get(10), None)
+            self.assertEqual(len(requests), 3)
+            bugs.save()
+
+            # Only the bugs that weren't found are looked for again, once
+            # they've been missing for long enough
+            bugs = BugCache(filename, fetch)
+            bugs.load()
+            self.assertEqual(bugs.get("12"), {'id': 12, 'summary': 'bug 12'})
+            for b in ("10", "11", "20"):
+                fetched, bug = bugs.bugs[b]
+                bugs.bugs[b] = (fetched - analyze_cache.BUG_MISSING_TTL - 1, bug)
+            bugs.prefetch(range(1, 121))
+            self.assertEqual(requests[3:], [["10", "20"]])
+        finally:
+            shutil.rmtree(cache_dir)
+
+    def test_warning_store(self):
+        cache_dir = tempfile.mkdtemp()
+        try:
+            filename = os.path.join(cache_dir, 'warning_history.log')
+            store = WarningStore(filename)
+            warnings = store.series('b', 'o', 't')
+            for i in range(10):
+                warnings.append(("build%i" % i, 1000 + i))
+            warnings.append(("build0", 1000))
+            store.warnMachine('m1', time())
+            store.save()
+            self.assertEqual(len(open(filename).readlines()), 11)
+
+            # Only the warnings from the cutoff on are kept
+            store2 = WarningStore(filename)
+            store2.load(1005)
+            self.assertEqual(sorted(store2.series('b', 'o', 't')),
+                             [("build%i" % i, 1000 + i) for i in range(5, 10)])
+            self.assertTrue(("build7", 1007) in store2.series('b', 'o', 't'))
+            self.assertFalse(("build1", 1001) in store2.series('b', 'o', 't'))
+            self.assertTrue(store2.machineWarned('m1', time() - 60))
+
+            # New warnings are appended, and the log is compacted once it's
+            # mostly expired entries
+            store2.series('b', 'o', 't2').append(("build20", 1020))
+            store2.save()
+            self.assertEqual(len(open(filename).readlines()), 12)
+            store2.compact()
+            self.assertEqual(len(open(filename).readlines()), 7)
+            store3 = WarningStore(filename)
+            store3.load(0)
+            self.assertEqual(store3, store2)
+
+            # Warnings in the old format can be imported
+            history = {
+                'b': {'o': {'t': [["build1", 1001], ["build2", 2002]]}},
+                'bad_machines': {'m2': 1000},
+                }
+            json_filename = os.path.join(cache_dir, 'warning_history.json')
+            json.dump(history, open(json_filename, 'w'))
+            store4 = WarningStore(os.path.join(cache_dir, 'other.log'))
+            store4.importJson(json_filename, 2000)
+            self.assertEqual(list(store4.series('b', 'o', 't')), [("build2", 2002)])
+            self.assertEqual(store4.bad_machines, {'m2': 1000})
+        finally:
+            shutil.rmtree(cache_dir)
+
+    def test_warning_history_upgrade(self):
+        cache_dir = tempfile.mkdtemp()
+        try:
+            history = {
+                'b': {'o': {'t': [["build1", 1001], ["build2", time()]]}},
+                'bad_machines': {'m2': 1000},
+                }
+            json.dump(history, open(os.path.join(cache_dir, 'warning_history.json'), 'w'))
+
+            # Only the old JSON file is there, so it's imported into the
+            # log the config now asks for
+            filename = os.path.join(cache_dir, 'warning_history.log')
+            runner = self.create_runner()
+            runner.options.start_time = 2000
+            runner.config.set('cache', 'warning_history', filename)
+            runner.loadWarningHistory()
+            self.assertEqual([w[0] for w in runner.warning_history.series('b', 'o', 't')],
+                             ["build2"])
+            self.assertEqual(runner.warning_history.bad_machines, {'m2': 1000})
+            self.assertTrue(os.path.exists(filename))
+
+            # From then on the log is what's loaded
+            runner.warning_history.series('b', 'o', 't').append(("build3", time()))
+            runner.saveWarningHistory()
+            runner.loadWarningHistory()
+            self.assertEqual(sorted(w[0] for w in runner.warning_history.series('b', 'o', 't')),
+                             ["build2", "build3"])
+        finally:
+            shutil.rmtree(cache_dir)
+
+    def test_flushWarnings(self):
+        runner = self.create_runner()
+        sent = []
+        runner.printWarning = lambda series, d, state, last_good: sent.append(d)
+        runner.emailWarning = lambda series, d, state, last_good: None
+
+        data = self.get_data()
+        runner.handleData(FakeSeries(), data[1], 'regression', False, data[0])
+        runner.handleData(FakeSeries(), data[2], 'regression', True, data[0])
+        runner.handleData(FakeSeries(), data[3], 'good', False, data[0])
+        self.assertEqual(sent, [])
+        runner.flushWarnings()
+        self.assertEqual(sent, [data[1]])
+        self.assertEqual(runner.pending_warnings, [])
+
 
 if __name__ == '__main__':
     unittest.main()
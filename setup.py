@@ -21,5 +21,6 @@ setup(name='phanalyzer',
       license='MPL',
       packages=['phanalyzer'],
       zip_safe=False,
-      install_requires=['influxdb', 'requests'] # for raptor
+      install_requires=['influxdb', 'requests'], # for raptor
+      extras_require={'numpy': ['numpy']} # vectorized analyze_t
       )